@@ -20,6 +20,11 @@ class POITypes(Enum):
    def get_index(cls, type):
       return list(cls).index(type)
 
+# Parts whose LTSPICE symbol has an orientation, and those of them whose
+# terminals are not interchangeable.
+ORIENTED_TYPES = (POITypes.Resistor, POITypes.Capacitor, POITypes.Inductor, POITypes.Diode)
+POLARIZED_TYPES = (POITypes.Diode,)
+
 class POI:
    def __init__(self):
       self.type = None
@@ -37,6 +42,7 @@ class POI:
       self.text = None
       self.marker = False
       self.name = None
+      self.rotationInferred = False
 
    def __init__(self, val, pos, typ, name):
       self.type = typ
@@ -55,6 +61,7 @@ class POI:
       self.marker = False
       self.name = name
       self.confidence = 0
+      self.rotationInferred = False
 
    def printType(self):
       print("My type is " + str(self.type))
@@ -72,4 +79,15 @@ def isValidPOI(classList):
 
 def pred2Type(POI):
    s = np.argmax(POI)
-   return POITypes(s)
\ No newline at end of file
+   return POITypes(s)
+# POIs are labelled by the line end point they were found at (`{i}A`/`{i}B`)
+# or, for symbol blobs without any line end point, by their position.
+def proposalLabel(x, y):
+   return f"P{int(x)}_{int(y)}"
+
+def isProposalLabel(label):
+   return label.startswith("P")
+
+def proposalPosition(label):
+   x, y = label[1:].split("_")
+   return (int(x), int(y))
@@ -0,0 +1,547 @@
+"""
+This submodule of **png2spice** benchmarks every stage of the analysis over
+the bundled `testSchematicsPNG` images and compares the result against a
+stored baseline. It reports latency percentiles and throughput per stage and
+exits with a non-zero code if a stage got slower than the baseline allows,
+so that a speed-up in one stage cannot silently slow down another.
+
+Usage:
+    python benchmark.py                          # compare against the baseline
+    python benchmark.py --update-baseline        # store a new baseline
+    python benchmark.py --model ../SPICEnet      # use the real SPICEnet
+    python benchmark.py --no-ocr --repeat 10
+    python benchmark.py --model ../SPICEnet --check-dense
+
+Without `--model`, SPICEnet is replaced by `CStubSPICEnet`, which reads the
+snapshots like the real model but returns deterministic predictions, so that
+the graph and parser stages get a stable workload without `tensorflow`.
+Baselines are only meaningful on the machine they were recorded on, so
+none is shipped; without a baseline, the report is printed with a warning
+and the check passes.
+
+`--check-dense` instead compares the dense SPICEnet pass with the per-crop
+inference on every image (agreement of the most likely class, probability
+differences and seconds of both paths), see
+`png2spice.inference.CSPICEnet.compareDense`.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import CancelledError
+from os.path import join, dirname, abspath, exists, basename, splitext
+
+import numpy as np
+
+import lines
+import pipeline
+from graphing import CGraph
+from parsing import CParser
+from POI import POITypes
+from ocrtools import read_part_OCR
+from parameters import P2SParameters
+from tuning import findImages
+
+STAGES = ("scaling", "normalize", "hough", "prune", "cluster", "crops", "predict",
+          "graph.build", "graph.rmDuplicates", "graph.link", "graph.analyzeRotations",
+          "graph.snapToGrid", "graph.alignToGrid", "asc")
+
+GRAPH_STEPS = ("rmDuplicates", "link", "analyzeRotations", "snapToGrid", "alignToGrid")
+
+DEFAULT_IMAGES = join(dirname(abspath(__file__)), "..", "testSchematicsPNG")
+DEFAULT_BASELINE = join(dirname(abspath(__file__)), "..", "tests", "benchmark_baseline.json")
+DEFAULT_SCALING = 0.05
+
+
+class CStubSPICEnet:
+    def __init__(self, confident: float=0.7) -> None:
+        """
+        BRIEF
+        -----
+        Stand-in for `png2spice.inference.CSPICEnet` without `tensorflow`.
+        Snapshots are read from disk like `flow_from_directory` does, but the
+        predictions are derived from a checksum of the pixels.
+
+        PARAMETERS
+        ----------
+        `confident`:
+            `float`. Share of snapshots that get a valid (> 0.95) prediction.
+            The others are left below the threshold of `isValidPOI`.
+        """
+        self.path = None
+        self.classlist = [t.name for t in POITypes]
+        self.confident = confident
+
+    def __predictOne(self, img) -> np.ndarray:
+        h = zlib.crc32(np.ascontiguousarray(img).tobytes())
+        pred = np.full(len(self.classlist), 0.01, np.float32)
+        peak = 0.97 if (h % 1000) < self.confident * 1000 else 0.5
+        pred[(h // 1000) % len(self.classlist)] = peak
+        return pred
+
+    def inputSize(self, imgResize: int) -> tuple:
+        """
+        BRIEF
+        -----
+        Same signature and return values as
+        `png2spice.inference.CSPICEnet.inputSize`. The stub has no fixed
+        input shape.
+        """
+        return (imgResize, imgResize)
+
+    def predictArrays(self, crops: list, imgResize: int=None, batchSize: int=32, cancel=None) -> np.ndarray:
+        """
+        BRIEF
+        -----
+        Same signature and return values as
+        `png2spice.inference.CSPICEnet.predictArrays`.
+        """
+        preds = np.zeros((len(crops), len(self.classlist)), np.float32)
+        for i, crop in enumerate(crops):
+            if cancel is not None and cancel.is_set():
+                raise CancelledError()
+            preds[i] = self.__predictOne(crop)
+        return preds
+
+    def predictRotations(self, crops: list, imgResize: int=None, batchSize: int=32, cancel=None) -> tuple:
+        """
+        BRIEF
+        -----
+        Same signature and return values as
+        `png2spice.inference.CSPICEnet.predictRotations`.
+        """
+        variants = [np.rot90(np.asarray(crop), k) for crop in crops for k in range(4)]
+        raw = self.predictArrays(variants, imgResize, 4 * batchSize, cancel)
+        raw = raw.reshape(len(crops), 4, len(self.classlist))
+        best = np.argmax(raw.max(axis=2), axis=1)
+        return raw[np.arange(len(crops)), best], [int(k) * 90 for k in best]
+
+    def predictDense(self, img, points: list, winSize: int, imgResize: int=None, tileSize: int=1024,
+                     batchSize: int=32, cancel=None) -> np.ndarray:
+        """
+        BRIEF
+        -----
+        Same signature and return values as
+        `png2spice.inference.CSPICEnet.predictDense`. There is no backbone
+        to share, so the snapshots are cropped around `points`.
+        """
+        crops = [lines.cropImageAtPos(img, x, y, winSize) for x, y in points]
+        return self.predictArrays(crops, imgResize, batchSize, cancel)
+
+    def predictStore(self, store, ocr: bool=True, params=None, cancel=None, batchSize: int=32,
+                     source: str=None):
+        """
+        BRIEF
+        -----
+        Same signature and return values as
+        `png2spice.inference.CSPICEnet.predictStore`.
+        """
+        selected = store.select(source)
+        labels = [store.index[i]["label"] for i in selected]
+        crops = [store.crop(i) for i in selected]
+        predDict = self.predsToDict(self.predictArrays(crops, cancel=cancel), labels)
+        if not ocr:
+            return predDict
+        ocrs = dict()
+        for label, crop in zip(labels, crops):
+            partOcr = read_part_OCR(crop)
+            if partOcr != None:
+                ocrs[label] = partOcr
+        return predDict, ocrs
+
+    def predsToDict(self, preds: np.ndarray, labels: list) -> dict:
+        """
+        BRIEF
+        -----
+        Same signature and return values as
+        `png2spice.inference.CSPICEnet.predsToDict`.
+        """
+        return {label: dict(zip(self.classlist, pred)) for pred, label in zip(preds, labels)}
+
+    def predict(self, path: str, ocr: bool=True, show: bool=False, params=None, cancel=None):
+        """
+        BRIEF
+        -----
+        Same signature and return values as
+        `png2spice.inference.CSPICEnet.predict`.
+        """
+        files = list()
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(join(root, n) for n in sorted(names) if n.endswith(".png"))
+        predDict, ocrs = dict(), dict()
+        for file in files:
+            label = splitext(basename(file))[0]
+            img = lines.imageDataFromPath(file)
+            predDict[label] = dict(zip(self.classlist, self.__predictOne(img)))
+            if ocr:
+                partOcr = read_part_OCR(img)
+                if partOcr != None:
+                    ocrs[label] = partOcr
+        if ocr:
+            return predDict, ocrs
+        return predDict
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    BRIEF
+    -----
+    Get the `q`-th percentile (0 to 100) of `values` by the nearest-rank
+    method.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(1, int(np.ceil(q / 100 * len(ordered))))
+    return ordered[rank - 1]
+
+
+def summarize(samples: dict) -> dict:
+    """
+    BRIEF
+    -----
+    Reduce the latency samples of every stage.
+
+    PARAMETERS
+    ----------
+    `samples`:
+        `dict`. Stage name to list of latencies in seconds.
+
+    RETURNS
+    -------
+    `dict`. Stage name to `n`, `mean`, `min`, `p50`, `p90`, `p99`, `max`
+    (seconds) and `throughput` (calls per second, from the mean).
+    """
+    summary = dict()
+    for stage, values in samples.items():
+        mean = float(np.mean(values)) if values else 0.0
+        summary[stage] = {
+            "n": len(values),
+            "mean": mean,
+            "min": min(values) if values else 0.0,
+            "p50": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "p99": percentile(values, 99),
+            "max": max(values) if values else 0.0,
+            "throughput": 1 / mean if mean > 0 else 0.0,
+        }
+    return summary
+
+
+def runStages(imagePath: str, model, workDir: str, ocr: bool=True, scaling: float=None) -> dict:
+    """
+    BRIEF
+    -----
+    Run all stages once on one image and time them individually.
+
+    PARAMETERS
+    ----------
+    `imagePath`:
+        `str`. Path to the schematic image.
+    `model`:
+        `CSPICEnet` or `CStubSPICEnet`.
+    `workDir`:
+        `str`. Folder for the POI snapshots.
+    `ocr`:
+        `bool`. Estimate the scaling and read part names by OCR.
+    `scaling`:
+        `float`. Scaling factor to use instead of the OCR estimate. Required
+        if `ocr` is `False`.
+
+    RETURNS
+    -------
+    `dict`. Stage name to seconds.
+    """
+    timings = dict()
+
+    def timed(stage, func, *args, **kwargs):
+        t = time.perf_counter()
+        res = func(*args, **kwargs)
+        timings[stage] = time.perf_counter() - t
+        return res
+
+    gray = lines.imageDataFromPath(imagePath)
+    if scaling is None:
+        scaling = timed("scaling", pipeline.estimateScalingFactor, gray)
+    params = P2SParameters.freeze(scalingFactor=scaling)
+
+    img = timed("normalize", lines.normalizeImageData, gray, params)
+    HLs = timed("hough", lines.detectLines, img, False, params)
+    HLs = timed("prune", lines.pruneLines, HLs, params)
+
+    poiDir, snapshotDir = pipeline.snapshotDirs(workDir)
+    if exists(snapshotDir):
+        shutil.rmtree(snapshotDir)
+    os.makedirs(snapshotDir)
+    clusters = timed("cluster", lines.clusterEndpoints, img, HLs, params)
+    timed("crops", lines.saveLineCrops, img, HLs, params.imageSliceSizeScaled, snapshotDir, clusters)
+
+    if ocr:
+        preds, ocrs = timed("predict", model.predict, poiDir, params=params)
+    else:
+        preds, ocrs = timed("predict", model.predict, poiDir, ocr=False, params=params), None
+    preds, ocrs = lines.expandClusters(preds, clusters), lines.expandClusters(ocrs, clusters)
+
+    graph = timed("graph.build", CGraph, HLs, preds, ocrs, params)
+    for step in GRAPH_STEPS:
+        timed("graph." + step, getattr(graph, step))
+    timed("asc", CParser(graph).Graph2Asc, join(workDir, "output.asc"))
+    return timings
+
+
+def benchmark(images: list, model, repeat: int=5, warmup: int=1, ocr: bool=True,
+              scaling: float=None) -> dict:
+    """
+    BRIEF
+    -----
+    Benchmark all stages over a set of images.
+
+    PARAMETERS
+    ----------
+    `images`:
+        `list`. Paths to schematic images.
+    `model`:
+        `CSPICEnet` or `CStubSPICEnet`.
+    `repeat`:
+        `int`. Timed runs per image.
+    `warmup`:
+        `int`. Untimed runs per image before the timed ones.
+    `ocr`, `scaling`:
+        See `runStages()`.
+
+    RETURNS
+    -------
+    `dict`. `stages` (see `summarize()`), `images`, `repeat`, `wallSeconds`
+    and `environment`.
+    """
+    samples = {stage: list() for stage in STAGES}
+    workDir = tempfile.mkdtemp(prefix="p2s-bench-")
+    t = time.perf_counter()
+    try:
+        for image in images:
+            for i in range(warmup + repeat):
+                timings = runStages(image, model, workDir, ocr, scaling)
+                if i >= warmup:
+                    for stage, seconds in timings.items():
+                        samples[stage].append(seconds)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    return {
+        "stages": summarize({s: v for s, v in samples.items() if v}),
+        "images": [basename(i) for i in images],
+        "repeat": repeat,
+        "wallSeconds": time.perf_counter() - t,
+        "environment": environment(model, ocr),
+    }
+
+
+def environment(model, ocr: bool) -> dict:
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "node": platform.node(),
+        "cpus": os.cpu_count(),
+        "model": "stub" if isinstance(model, CStubSPICEnet) else pipeline.modelVersion(model),
+        "ocr": ocr,
+    }
+
+
+def compare(report: dict, baseline: dict, threshold: float=0.25, minDelta: float=0.002) -> list:
+    """
+    BRIEF
+    -----
+    Find the stages which got slower than the baseline allows.
+
+    PARAMETERS
+    ----------
+    `report`:
+        `dict`. Result of `benchmark()`.
+    `baseline`:
+        `dict`. Result of an earlier `benchmark()`.
+    `threshold`:
+        `float`. Allowed relative slow-down of the median and the 90th
+        percentile, e.g. 0.25 for 25 %.
+    `minDelta`:
+        `float`. Slow-downs smaller than this many seconds are ignored, so
+        that sub-millisecond stages do not fail on timer noise.
+
+    RETURNS
+    -------
+    `list`. One `dict` per regression with `stage`, `metric`, `baseline`,
+    `current` and `ratio`.
+    """
+    regressions = list()
+    for stage, base in baseline.get("stages", {}).items():
+        current = report["stages"].get(stage)
+        if current is None:
+            continue
+        for metric in ("p50", "p90"):
+            b, c = base[metric], current[metric]
+            if c - b > minDelta and c > b * (1 + threshold):
+                regressions.append({"stage": stage, "metric": metric, "baseline": b,
+                                    "current": c, "ratio": c / b if b else float("inf")})
+    return regressions
+
+
+def checkDense(images: list, model, scaling: float=None, tileSize: int=1024) -> dict:
+    """
+    BRIEF
+    -----
+    Compare the dense SPICEnet pass with the per-crop inference at the end
+    points the pipeline would classify.
+
+    PARAMETERS
+    ----------
+    `images`:
+        `list`. Paths to schematic images.
+    `model`:
+        `png2spice.inference.CSPICEnet`. Loaded model.
+    `scaling`:
+        `float`. Fixed scaling factor. Default is the OCR estimate.
+    `tileSize`:
+        `int`. See `png2spice.inference.CSPICEnet.predictDense`.
+
+    RETURNS
+    -------
+    `dict`. Image name to the result of `CSPICEnet.compareDense`, plus
+    `total` over all images (with the agreement weighted by points).
+    """
+    results = dict()
+    for imagePath in images:
+        gray = lines.imageDataFromPath(imagePath)
+        params = P2SParameters.freeze(scalingFactor=scaling or pipeline.estimateScalingFactor(gray))
+        img = lines.normalizeImageData(gray, params)
+        HLs = lines.detectLines(img, True, params)
+        clusters = lines.clusterEndpoints(img, HLs, params)
+        points = [(x, y) for _, x, y in lines.cropCenters(HLs, clusters)]
+        results[basename(imagePath)] = model.compareDense(img, points, params.imageSliceSizeScaled,
+                                                          params.imgResize, tileSize=tileSize)
+    n = sum(r["points"] for r in results.values())
+    results["total"] = {
+        "points": n,
+        "agreement": sum(r["agreement"] * r["points"] for r in results.values()) / n if n else 1.0,
+        "maxAbsDiff": max((r["maxAbsDiff"] for r in results.values()), default=0.0),
+        "meanAbsDiff": sum(r["meanAbsDiff"] * r["points"] for r in results.values()) / n if n else 0.0,
+        "cropSeconds": sum(r["cropSeconds"] for r in results.values()),
+        "denseSeconds": sum(r["denseSeconds"] for r in results.values()),
+    }
+    return results
+
+
+def printReport(report: dict, baseline: dict=None):
+    base = baseline["stages"] if baseline else dict()
+    print(f"{'stage':<24}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'calls/s':>10}{'vs base':>10}")
+    for stage in STAGES:
+        s = report["stages"].get(stage)
+        if s is None:
+            continue
+        delta = ""
+        if stage in base and base[stage]["p50"] > 0:
+            delta = f"{s['p50'] / base[stage]['p50'] - 1:+.0%}"
+        print(f"{stage:<24}{s['p50'] * 1e3:>10.1f}{s['p90'] * 1e3:>10.1f}{s['p99'] * 1e3:>10.1f}"
+              f"{s['throughput']:>10.1f}{delta:>10}")
+
+
+def main(argv: list=None) -> int:
+    ap = argparse.ArgumentParser(description="Benchmark the png2spice stages against a stored baseline.")
+    ap.add_argument("--images", default=DEFAULT_IMAGES, help="Folder of schematic images.")
+    ap.add_argument("--model", default=None, help="Folder containing SPICEnet.h5 and CLASSLIST.json. Default is a stub.")
+    ap.add_argument("--repeat", type=int, default=5, help="Timed runs per image.")
+    ap.add_argument("--warmup", type=int, default=1, help="Untimed runs per image.")
+    ap.add_argument("--no-ocr", action="store_true", help="Skip OCR; the scaling factor is taken from --scaling.")
+    ap.add_argument("--scaling", type=float, default=None,
+                    help=f"Fixed scaling factor. Default is the OCR estimate, or {DEFAULT_SCALING} with --no-ocr.")
+    ap.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline file.")
+    ap.add_argument("--update-baseline", action="store_true", help="Store the results as the new baseline.")
+    ap.add_argument("--threshold", type=float, default=0.25, help="Allowed relative slow-down per stage.")
+    ap.add_argument("--min-delta-ms", type=float, default=2.0, help="Slow-downs below this are ignored.")
+    ap.add_argument("--output", default=None, help="Write the full report to this file.")
+    ap.add_argument("--check-dense", action="store_true",
+                    help="Compare the dense SPICEnet pass with the per-crop inference instead. Needs --model.")
+    ap.add_argument("--min-agreement", type=float, default=0.95,
+                    help="Share of points the dense pass has to classify like the per-crop inference.")
+    ap.add_argument("--tile-size", type=int, default=1024, help="Tile edge of the dense pass in network pixels.")
+    ap.add_argument("--inference-workers", type=int, default=None,
+                    help="Shard SPICEnet over this many worker processes, see executor.py. Needs --model.")
+    ap.add_argument("--threads", type=int, default=None, help="tensorflow and OpenCV threads per inference worker.")
+    args = ap.parse_args(argv)
+
+    images = findImages(args.images)
+    if not images:
+        print(f"No images in {args.images}", file=sys.stderr)
+        return 2
+    if args.model is None:
+        model = CStubSPICEnet()
+    elif args.inference_workers and not args.check_dense:
+        from executor import CInferenceExecutor
+        model = CInferenceExecutor(args.model, args.inference_workers, args.threads)
+    else:
+        from inference import CSPICEnet
+        model = CSPICEnet(args.model)
+    scaling = args.scaling
+    if scaling is None and args.no_ocr:
+        scaling = DEFAULT_SCALING
+
+    if args.check_dense:
+        if args.model is None:
+            print("--check-dense needs the real SPICEnet, pass --model.", file=sys.stderr)
+            return 2
+        results = checkDense(images, model, scaling, args.tile_size)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        print(f"{'image':<24}{'points':>8}{'agree':>8}{'max diff':>10}{'crops s':>10}{'dense s':>10}")
+        for name, r in results.items():
+            print(f"{name[:23]:<24}{r['points']:>8}{r['agreement']:>8.1%}{r['maxAbsDiff']:>10.3f}"
+                  f"{r['cropSeconds']:>10.2f}{r['denseSeconds']:>10.2f}")
+        return 1 if results["total"]["agreement"] < args.min_agreement else 0
+
+    report = benchmark(images, model, args.repeat, args.warmup, not args.no_ocr, scaling)
+    if hasattr(model, "stats"):
+        report["inferenceWorkers"] = model.stats()
+        model.close()
+        for pid, s in sorted(report["inferenceWorkers"]["perWorker"].items()):
+            print(f"[INFERENCE WORKER {pid}]: {s['crops']} crops in {s['shards']} shards, "
+                  f"busy {s['busySeconds']:.1f}s ({s['utilization']:.0%})")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        os.makedirs(dirname(abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        printReport(report)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not exists(args.baseline):
+        printReport(report)
+        # Baselines are per machine and not part of the repository, the first
+        # run on a machine has nothing to compare against
+        print(f"[BENCHMARK WARN]: No baseline at {args.baseline}, nothing to compare against. "
+              f"Run with --update-baseline to store one.", file=sys.stderr)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    printReport(report, baseline)
+    if baseline.get("environment") != report["environment"]:
+        print("[BENCHMARK WARN]: Baseline was recorded in a different environment", file=sys.stderr)
+
+    regressions = compare(report, baseline, args.threshold, args.min_delta_ms / 1000)
+    for r in regressions:
+        print(f"[REGRESSION]: {r['stage']} {r['metric']} {r['baseline'] * 1e3:.1f} ms -> "
+              f"{r['current'] * 1e3:.1f} ms ({r['ratio']:.2f}x)")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,316 @@
+"""
+This submodule of **png2spice** is the headless batch entry point. It
+converts a directory or glob of schematic images in parallel. Every worker
+process loads SPICEnet once and reuses it for all images it is handed.
+Results go to one folder per image, together with a `summary.json` listing
+timings and failures.
+
+Usage:
+    png2spice "archive/*.png" -o converted -j 8
+    png2spice schematic.png --trace --profile stage.lines
+    png2spice "archive/*.png" --stream
+
+With `--trace`, every image folder additionally gets `trace.json` and
+`trace.chrome.json` (see `png2spice.tracing`), and `--profile` dumps
+`cProfile` captures of the named spans next to them. `--stream` converts in
+a single process instead, with the stages of consecutive images overlapping
+(see `png2spice.streaming`); `summary.json` then also holds the queue depth
+and occupancy of every stage. The streaming stages do not support the
+options of the per-image pipeline (dense inference, crop archives, memory
+budgets, rotations, graph workers and tracing), combining them is an error. `--validate` runs every `output.cir` through
+`ngspice` in batch mode and marks the netlists it rejects.
+"""
+
+import os
+import sys
+
+# The submodules import each other by their plain names.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import argparse
+import glob
+import hashlib
+import json
+import shutil
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os.path import join, isdir, basename, splitext, abspath
+
+import executor
+import lines
+import memory
+import parsing
+import pipeline
+import streaming
+import tracing
+from parameters import P2SParameters
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+_model = None
+_ocr = True
+_trace = None
+_budget = None
+_dense = False
+_cropStore = False
+_rotations = "off"
+_graphWorkers = 0
+_proposals = "endpoints"
+
+
+def collectImages(inputs: list) -> list:
+    """
+    BRIEF
+    -----
+    Expand directories, globs and plain paths into a sorted list of image
+    files.
+
+    PARAMETERS
+    ----------
+    `inputs`:
+        `list`. Directories (searched non-recursively), glob patterns or
+        image paths.
+
+    RETURNS
+    -------
+    `list`. Absolute image paths without duplicates.
+    """
+    found = set()
+    for item in inputs:
+        if isdir(item):
+            candidates = [join(item, f) for f in os.listdir(item)]
+        else:
+            candidates = glob.glob(item, recursive=True)
+        for c in candidates:
+            if splitext(c)[1].lower() in IMAGE_EXTENSIONS and os.path.isfile(c):
+                found.add(abspath(c))
+    return sorted(found)
+
+
+def outputNames(images: list) -> dict:
+    """
+    BRIEF
+    -----
+    Get a unique output folder name per image. Images sharing a file stem
+    get a short hash of their path appended.
+    """
+    stems = dict()
+    for image in images:
+        stems.setdefault(splitext(basename(image))[0], []).append(image)
+    names = dict()
+    for stem, members in stems.items():
+        for image in members:
+            if len(members) == 1:
+                names[image] = stem
+            else:
+                names[image] = stem + "-" + hashlib.sha1(image.encode()).hexdigest()[:8]
+    return names
+
+
+def _initWorker(modelPath: str, ocr: bool, trace: dict=None, budget: int=None, dense: bool=False,
+                threads: int=None, cropStore: bool=False, proposals: str="endpoints", rotations: str="off",
+                graphWorkers: int=0):
+    global _model, _ocr, _trace, _budget, _dense, _cropStore, _rotations, _graphWorkers, _proposals
+    if threads is not None:
+        executor.configureThreads(threads)
+    from inference import CSPICEnet
+    _model = CSPICEnet(modelPath)
+    _ocr = ocr
+    _trace = trace
+    _budget = budget
+    _dense = dense
+    _cropStore = cropStore
+    _rotations = rotations
+    _graphWorkers = graphWorkers
+    _proposals = proposals
+
+
+def _convert(image: str, outDir: str) -> dict:
+    """
+    BRIEF
+    -----
+    Convert a single image in a worker process. Failures are reported,
+    not raised.
+    """
+    t = time.perf_counter()
+    record = {"image": image, "output": outDir, "error": None, "timings": dict()}
+    tracer = tracing.CTracer(**_trace) if _trace is not None else tracing.NULL_TRACER
+    try:
+        with tracing.use(tracer), tracer.span("image"):
+            budget = memory.CMemoryBudget(_budget) if _budget is not None else None
+            res = pipeline.runImage(image, outDir, _model, P2SParameters.freeze(POIProposals=_proposals), outDir, _ocr,
+                                    budget=budget, dense=_dense, cropStore=_cropStore,
+                                    rotations=_rotations, graphWorkers=_graphWorkers)
+        record["timings"] = res["timings"]
+        record["memory"] = res["memory"]
+        record["scalingFactor"] = res["params"].scalingFactor
+        record["lines"] = int(len(res["lines"]))
+        record["pois"] = len(res["graph"].looseGraph)
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        record["traceback"] = traceback.format_exc()
+    if _trace is not None:
+        os.makedirs(outDir, exist_ok=True)
+        tracer.writeJSON(join(outDir, "trace.json"))
+        tracer.writeChromeTrace(join(outDir, "trace.chrome.json"))
+        tracer.writeProfiles(outDir)
+        tracer.close()
+        record["trace"] = tracer.summary()
+    record["seconds"] = time.perf_counter() - t
+    return record
+
+
+def _convertStream(images: list, outDirs: dict, args, workers: int, threads: int) -> tuple:
+    """
+    BRIEF
+    -----
+    Convert all images in this process with the stages running
+    concurrently, see `png2spice.streaming`.
+
+    RETURNS
+    -------
+    `tuple`. Records like the ones of `_convert()` and the stream metrics.
+    """
+    executor.configureThreads(threads)
+    from inference import CSPICEnet
+    stream = streaming.CStreamingPipeline(CSPICEnet(args.model), P2SParameters.freeze(POIProposals=args.proposals),
+                                          not args.no_ocr,
+                                          prepareWorkers=workers, ocrWorkers=workers)
+    records = list()
+    for i, job in enumerate(stream.process(images, [outDirs[image] for image in images]), 1):
+        record = {"image": job["image"], "output": job["outDir"], "error": job["error"],
+                  "timings": job["timings"], "seconds": sum(job["timings"].values())}
+        if job["error"] is None:
+            record["scalingFactor"] = job["params"].scalingFactor
+            record["lines"] = int(len(job["lines"]))
+            record["pois"] = len(job["graph"].looseGraph)
+        else:
+            record["traceback"] = job.get("traceback")
+        records.append(record)
+        state = "FAILED " + record["error"] if record["error"] else f"{record['seconds']:.1f}s"
+        print(f"[{i}/{len(images)}] {basename(record['image'])}: {state}")
+    return records, stream.stats()
+
+
+def main(argv: list=None) -> int:
+    ap = argparse.ArgumentParser(prog="png2spice", description="Convert schematic images to LTSPICE .asc and SPICE .cir files.")
+    ap.add_argument("inputs", nargs="+", help="Image files, directories or glob patterns.")
+    ap.add_argument("-o", "--output", default="png2spice-output", help="Folder for the per-image output folders.")
+    ap.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes.")
+    ap.add_argument("--model", default=join(os.getcwd(), "SPICEnet"), help="Folder containing SPICEnet.h5 and CLASSLIST.json.")
+    ap.add_argument("--no-ocr", action="store_true", help="Skip OCR of part names.")
+    ap.add_argument("--crop-store", action="store_true",
+                    help="Keep the POI snapshots of an image in one crop archive instead of .png files.")
+    ap.add_argument("--threads", type=int, default=None,
+                    help="tensorflow and OpenCV threads per worker. Default is an equal share of the CPUs.")
+    ap.add_argument("--dense", action="store_true",
+                    help="Run SPICEnet once over the whole image instead of once per snapshot.")
+    ap.add_argument("--proposals", choices=lines.POI_PROPOSAL_MODES, default=P2SParameters.POIProposals,
+                    help="Where POI snapshots are taken: at line end points only, or additionally at the symbol "
+                         "blobs found by connected components, which the end points at a symbol share.")
+    ap.add_argument("--rotations", choices=pipeline.ROTATION_MODES, default="off",
+                    help="Let SPICEnet find the orientation of all parts or only of polarized ones (diodes), "
+                         "by classifying every snapshot in four rotations at once.")
+    ap.add_argument("--graph-workers", type=int, default=0, metavar="N",
+                    help="Split the graph of each image into independent regions and process them in N extra "
+                         "processes per worker. Grid alignment then stays within a region.")
+    ap.add_argument("--validate", action="store_true",
+                    help="Run every output.cir through ngspice in batch mode and report the ones it rejects. "
+                         "Part values are placeholders, OCR only reads the part names.")
+    ap.add_argument("--summary", default=None, help="Path of the summary file. Default is <output>/summary.json.")
+    ap.add_argument("--memory-budget", type=memory.parseSize, default=None, metavar="SIZE",
+                    help="Memory budget per image, e.g. 2G. Images are downscaled and inference batches shrunk to fit.")
+    ap.add_argument("--trace", action="store_true", help="Write per-image traces of all stages and sub-steps.")
+    ap.add_argument("--trace-memory", action="store_true", help="Record the peak of Python allocations per span (slow).")
+    ap.add_argument("--profile", action="append", default=[], metavar="SPAN",
+                    help="Capture the named span with cProfile, e.g. stage.lines. Implies --trace. Repeatable.")
+    ap.add_argument("--stream", action="store_true",
+                    help="Convert in this process with lines, SPICEnet, OCR and export running concurrently "
+                         "on consecutive images. -j sets the threads of the line and OCR stages. Cannot be "
+                         "combined with --dense, --crop-store, --memory-budget, --rotations, --graph-workers "
+                         "or tracing.")
+    args = ap.parse_args(argv)
+    if args.stream:
+        unsupported = [flag for flag, used in (
+            ("--dense", args.dense), ("--crop-store", args.crop_store),
+            ("--memory-budget", args.memory_budget is not None), ("--rotations", args.rotations != "off"),
+            ("--graph-workers", args.graph_workers > 0), ("--trace", args.trace),
+            ("--trace-memory", args.trace_memory), ("--profile", bool(args.profile))) if used]
+        if unsupported:
+            ap.error(f"{', '.join(unsupported)} cannot be combined with --stream")
+    if args.validate and shutil.which("ngspice") is None:
+        ap.error("--validate needs ngspice in the PATH")
+
+    images = collectImages(args.inputs)
+    if not images:
+        print("No images found.", file=sys.stderr)
+        return 2
+    os.makedirs(args.output, exist_ok=True)
+    names = outputNames(images)
+
+    t = time.perf_counter()
+    records = list()
+    workers = max(1, min(args.workers, len(images)))
+    threads = args.threads or max(1, (os.cpu_count() or 1) // workers)
+    trace = None
+    if args.trace or args.trace_memory or args.profile:
+        trace = {"memory": args.trace_memory, "profile": tuple(args.profile)}
+    stream = None
+    if args.stream:
+        outDirs = {image: join(args.output, names[image]) for image in images}
+        records, stream = _convertStream(images, outDirs, args, workers, args.threads or os.cpu_count() or 1)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker,
+                                 initargs=(args.model, not args.no_ocr, trace, args.memory_budget, args.dense,
+                                           threads, args.crop_store, args.proposals,
+                                           args.rotations, args.graph_workers)) as pool:
+            futures = {pool.submit(_convert, image, join(args.output, names[image])): image for image in images}
+            for i, future in enumerate(as_completed(futures), 1):
+                record = future.result()
+                records.append(record)
+                state = "FAILED " + record["error"] if record["error"] else f"{record['seconds']:.1f}s"
+                print(f"[{i}/{len(images)}] {basename(record['image'])}: {state}")
+    wall = time.perf_counter() - t
+
+    failures = [r for r in records if r["error"]]
+    invalid = list()
+    if args.validate:
+        for r in records:
+            if r["error"]:
+                continue
+            ok, output = parsing.validateCir(join(r["output"], "output.cir"))
+            r["cirValid"] = ok
+            if not ok:
+                r["cirOutput"] = output
+                invalid.append(r)
+                print(f"{basename(r['image'])}: output.cir rejected by ngspice")
+    stageTotals, stagePeaks = dict(), dict()
+    for r in records:
+        for stage, seconds in r["timings"].items():
+            stageTotals[stage] = stageTotals.get(stage, 0.0) + seconds
+        for stage, mem in r.get("memory", {}).items():
+            if mem["rssPeak"] is not None:
+                stagePeaks[stage] = max(stagePeaks.get(stage, 0), mem["rssPeak"])
+    summary = {
+        "images": len(images),
+        "succeeded": len(images) - len(failures),
+        "failed": len(failures),
+        "invalidNetlists": len(invalid) if args.validate else None,
+        "workers": workers,
+        "wallSeconds": wall,
+        "stageSeconds": stageTotals,
+        "stagePeakRSS": stagePeaks,
+        "results": sorted(records, key=lambda r: r["image"]),
+    }
+    if stream is not None:
+        summary["stream"] = stream
+    summaryPath = args.summary or join(args.output, "summary.json")
+    with open(summaryPath, "w") as f:
+        json.dump(summary, f, indent=2)
+    print(f"Converted {summary['succeeded']}/{len(images)} images in {wall:.1f}s, summary in {summaryPath}")
+    return 1 if failures or invalid else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
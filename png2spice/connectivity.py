@@ -0,0 +1,215 @@
+"""
+This submodule of **png2spice** extracts the electrical nets of the virtual
+graph. The graph itself only knows direct neighbours (`terminalA` and
+`terminalB`), which is enough for drawing wires but not for any netlist-level
+operation. Here, every terminal of every POI is assigned a net ID by
+union-find over the wires and the pure wiring POIs (corners, junctions and
+crosses), which share a single electrical node.
+"""
+
+from POI import POI, POITypes
+from typing import Dict, List, Tuple
+
+WIRING_TYPES = (POITypes.Corner, POITypes.Junction, POITypes.Cross)
+GROUND_NET = 0
+
+
+class CUnionFind:
+    def __init__(self) -> None:
+        """
+        BRIEF
+        -----
+        Disjoint-set forest with path halving and union by size. Elements
+        can be any hashable object and are registered on first use.
+        """
+        self.parent = dict()
+        self.size = dict()
+
+    def add(self, item) -> None:
+        """
+        BRIEF
+        -----
+        Register `item` as its own set if it is not known yet.
+        """
+        if item not in self.parent:
+            self.parent[item] = item
+            self.size[item] = 1
+
+    def find(self, item):
+        """
+        BRIEF
+        -----
+        Get the representative of the set containing `item`.
+        """
+        self.add(item)
+        while self.parent[item] != item:
+            self.parent[item] = self.parent[self.parent[item]]
+            item = self.parent[item]
+        return item
+
+    def union(self, a, b):
+        """
+        BRIEF
+        -----
+        Merge the sets containing `a` and `b`.
+
+        RETURNS
+        -------
+        The representative of the merged set.
+        """
+        ra = self.find(a)
+        rb = self.find(b)
+        if ra == rb:
+            return ra
+        if self.size[ra] < self.size[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        self.size[ra] += self.size[rb]
+        return ra
+
+
+def terminalsOf(poi: POI) -> Tuple[str, ...]:
+    """
+    BRIEF
+    -----
+    Get the terminal names of a POI as used by the graph and the parser.
+
+    PARAMETERS
+    ----------
+    `poi`: `png2spice.POI.POI`
+        POI to be inspected.
+
+    RETURNS
+    -------
+    `tuple`. `("A",)` for GND, `("A", "B")` for everything else. Wiring POIs
+    report both terminals even though they form a single node.
+    """
+    if poi.type == POITypes.GND:
+        return ("A",)
+    return ("A", "B")
+
+
+def terminalNode(poi: POI, terminal: str) -> Tuple[POI, str]:
+    """
+    BRIEF
+    -----
+    Get the `(POI, terminal)` node a wire attaches to. Wires which the
+    parser draws from terminal B of a single-terminal POI (GND) attach
+    to its terminal A.
+    """
+    return (poi, terminal if terminal in terminalsOf(poi) else "A")
+
+
+class CNets:
+    def __init__(self, graph) -> None:
+        """
+        BRIEF
+        -----
+        Assign a net ID to every terminal of a linked graph.
+
+        PARAMETERS
+        ----------
+        `graph`: `Union[CGraph, List[POI]]`
+            Linked graph or list of POIs (loose graph). Linking has to be
+            done beforehand, see `png2spice.graphing.CGraph.link`.
+
+        NOTES
+        -----
+        A wire of the graph connects terminal A of a POI with terminal A of
+        its `terminalA` neighbour and terminal B with terminal B of its
+        `terminalB` neighbour, exactly as `png2spice.parsing.CParser` draws
+        it. Corners, junctions and crosses short their terminals together.
+        All GND POIs share the net `GROUND_NET` (0), all other nets are
+        numbered from 1 in order of first appearance in the graph.
+        """
+        pois = graph.looseGraph if hasattr(graph, "looseGraph") else graph
+        self.pois = list(pois)
+        self.edges = list()
+        uf = CUnionFind()
+
+        gndRoot = None
+        for poi in self.pois:
+            for t in terminalsOf(poi):
+                uf.add((poi, t))
+            if poi.type in WIRING_TYPES:
+                uf.union((poi, "A"), (poi, "B"))
+            elif poi.type == POITypes.GND:
+                gndRoot = (poi, "A") if gndRoot is None else uf.union(gndRoot, (poi, "A"))
+
+        seen = set()
+        for poi in self.pois:
+            for t, other in (("A", poi.terminalA), ("B", poi.terminalB)):
+                if other is None:
+                    continue
+                a, b = terminalNode(poi, t), terminalNode(other, t)
+                if a == b:
+                    continue
+                key = frozenset((a, b))
+                if key in seen:
+                    continue
+                seen.add(key)
+                self.edges.append((a, b))
+                uf.union(a, b)
+
+        self.netOfTerminal = dict()
+        self.table: Dict[int, List[Tuple[POI, str]]] = dict()
+        rootIds = dict()
+        if gndRoot is not None:
+            rootIds[uf.find(gndRoot)] = GROUND_NET
+        for poi in self.pois:
+            for t in terminalsOf(poi):
+                root = uf.find((poi, t))
+                if root not in rootIds:
+                    rootIds[root] = len(rootIds) + (0 if gndRoot is not None else 1)
+                netId = rootIds[root]
+                self.netOfTerminal[(poi, t)] = netId
+                self.table.setdefault(netId, []).append((poi, t))
+
+    def netOf(self, poi: POI, terminal: str) -> int:
+        """
+        BRIEF
+        -----
+        Get the net ID of a terminal.
+
+        PARAMETERS
+        ----------
+        `poi`: `png2spice.POI.POI`
+            POI owning the terminal.
+        `terminal`: `str`
+            Terminal name, `"A"` or `"B"`.
+
+        RETURNS
+        -------
+        `int`. Net ID, `GROUND_NET` for ground.
+        """
+        return self.netOfTerminal[(poi, terminal)]
+
+    def components(self) -> List[POI]:
+        """
+        BRIEF
+        -----
+        Get all POIs which are actual parts, i.e. neither wiring nor GND.
+        """
+        return [p for p in self.pois if p.type not in WIRING_TYPES and p.type != POITypes.GND]
+
+    def componentTable(self) -> Dict[int, List[Tuple[POI, str]]]:
+        """
+        BRIEF
+        -----
+        Get the net table reduced to part terminals, i.e. without wiring
+        POIs and GND flags.
+
+        RETURNS
+        -------
+        `dict`. Net ID to list of `(POI, terminal)`.
+        """
+        reduced = dict()
+        for netId, members in self.table.items():
+            parts = [(p, t) for p, t in members if p.type not in WIRING_TYPES and p.type != POITypes.GND]
+            if parts:
+                reduced[netId] = parts
+        return reduced
+
+    def printInfo(self):
+        for netId, members in sorted(self.table.items()):
+            print(f"Net {netId}: " + ", ".join(f"{p.value}.{t} ({p.type.name})" for p, t in members))
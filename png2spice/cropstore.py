@@ -0,0 +1,317 @@
+"""
+This submodule of **png2spice** keeps POI snapshots in a single crop archive
+instead of one `.png` file per snapshot. An archive is one file holding a
+small header, all crops as a fixed-stride `uint8` array and an index with the
+label, source image, coordinates and scaling factor of every crop. Reading
+maps the array into memory, so SPICEnet, OCR and debugging tools get views
+of the crops without decoding or copying anything. Moving, deleting or
+re-classifying the crops of one or many runs is a single file operation.
+
+Usage:
+    python cropstore.py list work/POIs/crops.p2s
+    python cropstore.py export work/POIs/crops.p2s -o pngs --label 3A 7B
+    python cropstore.py merge all.p2s run1/POIs/crops.p2s run2/POIs/crops.p2s
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+from os.path import join, exists
+
+import cv2
+import numpy as np
+
+import tracing
+from lines import cropCenters, cropImageAtPos
+
+MAGIC = b"P2SCROPS"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQ")
+HEADER_SIZE = 64
+CROP_STORE_NAME = "crops.p2s"
+
+
+class CCropStore:
+    def __init__(self, path: str, cropSize: int=None, mode: str="r") -> None:
+        """
+        BRIEF
+        -----
+        Open a crop archive. Use it as a context manager to have it closed
+        (and, when writing, its index stored) automatically.
+
+        PARAMETERS
+        ----------
+        `path`:
+            `str`. Path of the archive file.
+        `cropSize`:
+            `int`. Edge length of a slot in pixels. Required when a new
+            archive is created; smaller crops are stored in the top left
+            corner of their slot, larger ones are rejected.
+        `mode`:
+            `str`. `"r"` to read, `"w"` to create (an existing archive is
+            replaced) or `"a"` to append (the archive is created if it does
+            not exist).
+
+        NOTES
+        -----
+        The file consists of a header of `HEADER_SIZE` bytes, `len(store)`
+        slots of `cropSize * cropSize` bytes and the index as JSON. Crops
+        added to an open archive can be read right away; the index is
+        written on `flush()` and `close()`.
+        """
+        if mode not in ("r", "w", "a"):
+            raise ValueError(f"Invalid crop store mode '{mode}'")
+        self.path = path
+        self.mode = mode
+        self.index = list()
+        self.__file = None
+        self.__data = None
+        if mode == "w" or (mode == "a" and not exists(path)):
+            if not cropSize:
+                raise ValueError("A new crop store needs a crop size")
+            self.cropSize = int(cropSize)
+            self.__file = open(path, "w+b")
+            self.__file.write(b"\0" * HEADER_SIZE)
+            self.__writeHeader()
+        else:
+            with open(path, "rb") as f:
+                magic, version, self.cropSize, count = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC or version != VERSION:
+                    raise ValueError(f"{path} is not a crop store of version {VERSION}")
+                f.seek(self.__dataEnd(count))
+                self.index = json.loads(f.read().decode())
+            if len(self.index) != count:
+                raise ValueError(f"Index of {path} does not match its header")
+            if mode == "a":
+                self.__file = open(path, "r+b")
+                self.__file.truncate(self.__dataEnd(count))
+
+    def __dataEnd(self, count: int) -> int:
+        return HEADER_SIZE + count * self.cropSize * self.cropSize
+
+    def __writeHeader(self):
+        self.__file.seek(0)
+        self.__file.write(HEADER.pack(MAGIC, VERSION, self.cropSize, len(self.index)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.close()
+        return False
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, i: int):
+        return self.crop(i)
+
+    def add(self, crop, label: str, source: str=None, x: int=None, y: int=None, scale: float=None) -> int:
+        """
+        BRIEF
+        -----
+        Append a crop.
+
+        PARAMETERS
+        ----------
+        `crop`:
+            `cv2.typing.MatLike`. Grayscale crop of at most `cropSize` pixels
+            in either direction.
+        `label`:
+            `str`. Label of the crop, e.g. `3A`.
+        `source`:
+            `str`. Image the crop was taken from.
+        `x`, `y`:
+            `int`. Center of the crop in the normalized image.
+        `scale`:
+            `float`. Scaling factor of the run.
+
+        RETURNS
+        -------
+        `int`. Position of the crop in the archive.
+        """
+        if self.__file is None:
+            raise ValueError("Crop store is not open for writing")
+        crop = np.asarray(crop, np.uint8)
+        h, w = crop.shape[:2]
+        if h > self.cropSize or w > self.cropSize:
+            raise ValueError(f"Crop of {w}x{h} does not fit into slots of {self.cropSize}x{self.cropSize}")
+        slot = np.full((self.cropSize, self.cropSize), 255, np.uint8)
+        slot[:h, :w] = crop
+        self.__file.seek(self.__dataEnd(len(self.index)))
+        self.__file.write(slot.tobytes())
+        self.index.append({"label": label, "source": source, "x": x, "y": y,
+                           "scale": scale, "height": h, "width": w})
+        self.__data = None
+        return len(self.index) - 1
+
+    def addLines(self, img, lines: np.ndarray, winSize: int, source: str=None, scale: float=None,
+                 clusters: dict=None) -> int:
+        """
+        BRIEF
+        -----
+        Append the POI snapshots around both end points of every line, like
+        `png2spice.lines.saveLineCrops` does for `.png` files.
+
+        PARAMETERS
+        ----------
+        `img`:
+            `cv2.typing.MatLike`. Normalized image data matrix.
+        `lines`:
+            `np.ndarray`. Lines of shape `(n_lines, 4)`.
+        `winSize`:
+            `int`. Size of the square snapshots in pixels.
+        `source`, `scale`:
+            See `add()`.
+        `clusters`:
+            `png2spice.lines.CEndpointClusters`. End point clusters, see
+            `png2spice.lines.clusterEndpoints`. Only representatives are
+            stored if given.
+
+        RETURNS
+        -------
+        `int`. Number of crops added.
+        """
+        added = 0
+        with tracing.span("lines.storeCrops", lines=len(lines)) as sp:
+            for label, x, y in cropCenters(lines, clusters):
+                crop = cropImageAtPos(img, x, y, winSize)
+                if crop is not None:
+                    self.add(crop, label, source, x, y, scale)
+                    added += 1
+            sp.count("crops", added)
+        return added
+
+    def __array(self) -> np.ndarray:
+        if self.__data is None:
+            if self.__file is not None:
+                self.__file.flush()
+            if not self.index:
+                return np.zeros((0, self.cropSize, self.cropSize), np.uint8)
+            self.__data = np.memmap(self.path, np.uint8, "r", HEADER_SIZE,
+                                    (len(self.index), self.cropSize, self.cropSize))
+        return self.__data
+
+    def crop(self, i: int) -> np.ndarray:
+        """
+        BRIEF
+        -----
+        Get crop `i` as a read-only view into the mapped archive.
+        """
+        entry = self.index[i]
+        return self.__array()[i, :entry["height"], :entry["width"]]
+
+    def find(self, label: str, source: str=None) -> int:
+        """
+        BRIEF
+        -----
+        Get the position of the crop `label` (of `source`, if given).
+        Raises a `KeyError` if there is none.
+        """
+        for i, entry in enumerate(self.index):
+            if entry["label"] == label and (source is None or entry["source"] == source):
+                return i
+        raise KeyError(label)
+
+    def select(self, source: str=None) -> list:
+        """
+        BRIEF
+        -----
+        Get the positions of all crops, or of those taken from `source`.
+        """
+        return [i for i, e in enumerate(self.index) if source is None or e["source"] == source]
+
+    def sources(self) -> list:
+        return sorted({e["source"] for e in self.index}, key=str)
+
+    def flush(self):
+        """
+        BRIEF
+        -----
+        Write the index and header, so that other readers see all crops
+        added so far.
+        """
+        if self.__file is None:
+            return
+        self.__file.seek(self.__dataEnd(len(self.index)))
+        self.__file.write(json.dumps(self.index).encode())
+        self.__file.truncate()
+        self.__writeHeader()
+        self.__file.flush()
+
+    def close(self):
+        self.flush()
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        self.__data = None
+
+    def extend(self, other: "CCropStore") -> int:
+        """
+        BRIEF
+        -----
+        Append all crops of another archive with their index entries.
+
+        RETURNS
+        -------
+        `int`. Number of crops added.
+        """
+        for i, entry in enumerate(other.index):
+            self.add(other.crop(i), entry["label"], entry["source"], entry["x"], entry["y"], entry["scale"])
+        return len(other)
+
+
+def storePath(poiDir: str) -> str:
+    """
+    BRIEF
+    -----
+    Get the path of the crop archive of a run, next to where the snapshot
+    folder would be.
+    """
+    return join(poiDir, CROP_STORE_NAME)
+
+
+def main(argv: list=None) -> int:
+    ap = argparse.ArgumentParser(description="Inspect, export and merge png2spice crop archives.")
+    sub = ap.add_subparsers(dest="command", required=True)
+    ls = sub.add_parser("list", help="List the crops of an archive.")
+    ls.add_argument("store")
+    ex = sub.add_parser("export", help="Write crops as .png files.")
+    ex.add_argument("store")
+    ex.add_argument("-o", "--output", default=".", help="Destination folder.")
+    ex.add_argument("--label", nargs="*", default=None, help="Labels to export. Default is all.")
+    mg = sub.add_parser("merge", help="Merge archives into one.")
+    mg.add_argument("dest")
+    mg.add_argument("stores", nargs="+")
+    args = ap.parse_args(argv)
+
+    if args.command == "list":
+        with CCropStore(args.store) as store:
+            print(f"{len(store)} crops of {store.cropSize}x{store.cropSize} from {len(store.sources())} image(s)")
+            for e in store.index:
+                print(f"{e['label']:>8} {e['width']:>4}x{e['height']:<4} at ({e['x']}, {e['y']}) "
+                      f"scale {e['scale']} from {e['source']}")
+    elif args.command == "export":
+        os.makedirs(args.output, exist_ok=True)
+        with CCropStore(args.store) as store:
+            for i, e in enumerate(store.index):
+                if args.label is None or e["label"] in args.label:
+                    cv2.imwrite(join(args.output, e["label"] + ".png"), store.crop(i))
+    else:
+        stores = [CCropStore(path) for path in args.stores]
+        size = max(s.cropSize for s in stores)
+        with CCropStore(args.dest, size, "a") as dest:
+            if dest.cropSize < size:
+                print(f"{args.dest} has slots of {dest.cropSize} pixels, the crops need {size}", file=sys.stderr)
+                return 1
+            for store in stores:
+                dest.extend(store)
+                store.close()
+        print(f"Merged {len(stores)} archive(s) into {args.dest}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
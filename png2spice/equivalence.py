@@ -0,0 +1,477 @@
+"""
+This submodule of **png2spice** checks that a faster configuration of the
+pipeline produces the same results as a reference configuration. Both run
+over a corpus of images; their lines, classifications, POIs, links and
+exported `.asc` are brought into a canonical, order-independent form and
+matched within tolerances. The report lists the differences per stage
+together with the speed ratio, so that performance work can land with
+evidence that the output did not change.
+
+Usage:
+    python equivalence.py --model ../SPICEnet --candidate '{"options": {"dense": true}}'
+    python equivalence.py --candidate cand.json --reference ref.json --scaling 0.05 --no-ocr
+    python equivalence.py --save-results before.json         # on the old code
+    python equivalence.py --reference-results before.json    # on the new code
+
+A configuration is a JSON object, inline or as a file, with the optional
+keys `name`, `params` (**P2S parameters** to override, see
+`png2spice.parameters`), `options` (`dense`, `cropStore`, `rotations`,
+`graphWorkers`) and `model` (folder of another SPICEnet, e.g. a quantized one). The empty
+configuration is the default pipeline. Without `--model`, SPICEnet is replaced by
+`png2spice.benchmark.CStubSPICEnet`, which supports all of these options.
+"""
+
+import argparse
+import json
+import math
+import sys
+import tempfile
+import time
+import traceback
+from os.path import basename, exists
+
+import numpy as np
+
+import pipeline
+from benchmark import CStubSPICEnet, DEFAULT_IMAGES, DEFAULT_SCALING
+from parameters import P2SParameters
+from POI import isProposalLabel, proposalPosition
+from parsing import parseAsc
+from spatial import CSpatialIndex
+from tuning import findImages
+
+COMPARED_STAGES = ("lines", "classify", "pois", "links", "asc")
+
+CONFIG_KEYS = ("name", "params", "options", "model")
+CONFIG_OPTIONS = ("dense", "cropStore", "rotations", "graphWorkers")
+
+DEFAULT_TOLERANCES = {"lines": 2, "classify": 1e-3, "pois": 0, "links": 0, "asc": 0}
+
+MAX_EXAMPLES = 10
+
+
+def loadConfig(text: str) -> dict:
+    """
+    BRIEF
+    -----
+    Read a configuration from a JSON file or an inline JSON object.
+
+    RETURNS
+    -------
+    `dict`. The configuration with all keys of `CONFIG_KEYS` present.
+    """
+    if exists(text):
+        with open(text) as f:
+            config = json.load(f)
+    else:
+        config = json.loads(text)
+    if not isinstance(config, dict):
+        raise ValueError("A configuration has to be a JSON object")
+    unknown = set(config) - set(CONFIG_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown configuration keys: {', '.join(sorted(unknown))}")
+    unknown = set(config.get("options") or {}) - set(CONFIG_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown configuration options: {', '.join(sorted(unknown))}")
+    return {"name": config.get("name"), "params": dict(config.get("params") or {}),
+            "options": dict(config.get("options") or {}), "model": config.get("model")}
+
+
+def canonicalResult(res: dict) -> dict:
+    """
+    BRIEF
+    -----
+    Bring the result of `png2spice.pipeline.runImage` into a canonical,
+    order-independent and JSON-serializable form.
+
+    RETURNS
+    -------
+    `dict`. Sorted lists of
+    `lines`: `[x1, y1, x2, y2]` with the smaller end point first,
+    `classify`: `[x, y, {class: probability}]` per classified end point
+    and symbol proposal,
+    `pois`: `[type, x, y, name]`,
+    `links`: `[terminal, type, x, y, targetType, targetX, targetY]`,
+    plus the `asc` content.
+    """
+    HLs = np.asarray(res["lines"]).reshape(-1, 4)
+    canonLines = list()
+    for line in HLs:
+        a, b = (int(line[0]), int(line[1])), (int(line[2]), int(line[3]))
+        canonLines.append(list(a + b if a <= b else b + a))
+
+    classify = list()
+    for label, pred in res["preds"].items():
+        if isProposalLabel(label):
+            x, y = proposalPosition(label)
+        else:
+            i, end = int(label[:-1]), label[-1]
+            x, y = HLs[i][0:2] if end == "A" else HLs[i][2:4]
+        classify.append([int(x), int(y), {str(k): float(v) for k, v in pred.items()}])
+
+    pois, links = list(), list()
+    for poi in res["graph"].looseGraph:
+        x, y = (int(v) for v in poi.position)
+        pois.append([poi.type.name, x, y, None if poi.name is None else str(poi.name)])
+        for terminal in ("A", "B"):
+            target = getattr(poi, "terminal" + terminal)
+            if target is not None:
+                tx, ty = (int(v) for v in target.position)
+                links.append([terminal, poi.type.name, x, y, target.type.name, tx, ty])
+
+    return {"lines": sorted(canonLines), "classify": sorted(classify, key=lambda c: c[:2]),
+            "pois": sorted(pois, key=lambda p: (p[0], p[1], p[2], p[3] or "")),
+            "links": sorted(links), "asc": res["asc"]}
+
+
+def matchItems(candidates: list, references: list, points, dist, tolerance: float) -> tuple:
+    """
+    BRIEF
+    -----
+    Greedily match candidates to references, every reference at most once.
+
+    PARAMETERS
+    ----------
+    `candidates`, `references`:
+        `list`. Items in canonical form.
+    `points`:
+        Function giving the positions of an item. References are found by
+        their first position near any position of a candidate.
+    `dist`:
+        Function giving the distance of a candidate and a reference, or
+        `None` if they cannot match at all (e.g. different types).
+    `tolerance`:
+        `float`. Largest distance of a match (inclusive).
+
+    RETURNS
+    -------
+    `tuple`. `(pairs, missing, extra)`: matched `(candidate, reference)`
+    pairs, unmatched references and unmatched candidates.
+    """
+    index = CSpatialIndex(max(tolerance, 1))
+    for i, r in enumerate(references):
+        index.insert(i, points(r)[0])
+    pairs, extra = list(), list()
+    used = set()
+    for c in candidates:
+        best, bestDist = None, None
+        for pos in points(c):
+            for i in index.query(pos, tolerance + 1):
+                if i in used:
+                    continue
+                d = dist(c, references[i])
+                if d is not None and d <= tolerance and (bestDist is None or d < bestDist):
+                    best, bestDist = i, d
+        if best is None:
+            extra.append(c)
+        else:
+            used.add(best)
+            pairs.append((c, references[best]))
+    missing = [r for i, r in enumerate(references) if i not in used]
+    return pairs, missing, extra
+
+
+def _diff(pairs: list, missing: list, extra: list, **extraFields) -> dict:
+    out = {"reference": len(pairs) + len(missing), "candidate": len(pairs) + len(extra),
+           "matched": len(pairs), "missing": missing[:MAX_EXAMPLES], "extra": extra[:MAX_EXAMPLES]}
+    out.update(extraFields)
+    out["equal"] = not missing and not extra and not extraFields.get("differing")
+    return out
+
+
+def _lineDist(a, b):
+    return max(math.dist(a[0:2], b[0:2]), math.dist(a[2:4], b[2:4]))
+
+
+def compareResults(candidate: dict, reference: dict, tolerances: dict=None) -> dict:
+    """
+    BRIEF
+    -----
+    Compare two canonical results (see `canonicalResult()`) of one image.
+
+    PARAMETERS
+    ----------
+    `tolerances`:
+        `dict`. Per stage of `COMPARED_STAGES`, the largest position
+        difference at which two items still match, in pixels (`asc`: in
+        LTSPICE units). For `classify`, it is the largest allowed
+        probability difference instead; its end points match with the
+        tolerance of `lines`. Missing stages fall back to
+        `DEFAULT_TOLERANCES`.
+
+    RETURNS
+    -------
+    `dict`. Stage name to `reference`, `candidate` and `matched` counts,
+    examples of `missing` and `extra` items and `equal`. `classify` adds
+    `agreement` (share of matched end points with the same most likely
+    class), `maxAbsDiff` and `differing` (matched end points beyond the
+    tolerance); `pois` adds `differing` for differing part names; `asc`
+    adds `identical` (byte-for-byte).
+    """
+    tol = dict(DEFAULT_TOLERANCES)
+    tol.update(tolerances or {})
+    report = dict()
+
+    pairs, missing, extra = matchItems(candidate["lines"], reference["lines"],
+                                       lambda l: (l[0:2], l[2:4]), _lineDist, tol["lines"])
+    report["lines"] = _diff(pairs, missing, extra)
+
+    # End points move with their lines, so they match with the line tolerance
+    pairs, missing, extra = matchItems(candidate["classify"], reference["classify"], lambda c: (c[0:2],),
+                                       lambda a, b: math.dist(a[0:2], b[0:2]), tol["lines"])
+    agree, maxDiff, differing = 0, 0.0, list()
+    for c, r in pairs:
+        cp, rp = c[2], r[2]
+        agree += max(cp, key=cp.get) == max(rp, key=rp.get)
+        d = max((abs(cp.get(k, 0.0) - v) for k, v in rp.items()), default=0.0)
+        maxDiff = max(maxDiff, d)
+        if d > tol["classify"]:
+            differing.append(r[0:2])
+    report["classify"] = _diff(pairs, missing, extra, agreement=agree / len(pairs) if pairs else 1.0,
+                               maxAbsDiff=maxDiff, differing=differing[:MAX_EXAMPLES])
+
+    pairs, missing, extra = matchItems(candidate["pois"], reference["pois"], lambda p: (p[1:3],),
+                                       lambda a, b: math.dist(a[1:3], b[1:3]) if a[0] == b[0] else None,
+                                       tol["pois"])
+    renamed = [[r, c[3]] for c, r in pairs if c[3] != r[3]]
+    report["pois"] = _diff(pairs, missing, extra, differing=renamed[:MAX_EXAMPLES])
+
+    pairs, missing, extra = matchItems(
+        candidate["links"], reference["links"], lambda l: (l[2:4], l[5:7]),
+        lambda a, b: max(math.dist(a[2:4], b[2:4]), math.dist(a[5:7], b[5:7]))
+        if (a[0], a[1], a[4]) == (b[0], b[1], b[4]) else None, tol["links"])
+    report["links"] = _diff(pairs, missing, extra)
+
+    c, r = parseAsc(candidate["asc"]), parseAsc(reference["asc"])
+    ascC = [["SYMBOL", s[0], s[1], s[2], s[3]] for s in c["symbols"]] + \
+           [["FLAG", f[0], f[1], f[2], None] for f in c["flags"]] + [["WIRE", *w] for w in c["wires"]]
+    ascR = [["SYMBOL", s[0], s[1], s[2], s[3]] for s in r["symbols"]] + \
+           [["FLAG", f[0], f[1], f[2], None] for f in r["flags"]] + [["WIRE", *w] for w in r["wires"]]
+
+    def ascDist(a, b):
+        if a[0] != b[0]:
+            return None
+        if a[0] == "WIRE":
+            return _lineDist(a[1:5], b[1:5])
+        if a[1] != b[1] or a[4] != b[4]:
+            return None
+        return math.dist(a[2:4], b[2:4])
+
+    pairs, missing, extra = matchItems(ascC, ascR, lambda a: (a[1:3], a[3:5]) if a[0] == "WIRE" else (a[2:4],),
+                                       ascDist, tol["asc"])
+    report["asc"] = _diff(pairs, missing, extra, identical=candidate["asc"] == reference["asc"])
+    return report
+
+
+def runConfig(images: list, config: dict, model, ocr: bool=True, scalings: dict=None, repeat: int=1) -> dict:
+    """
+    BRIEF
+    -----
+    Run one configuration over all images from scratch (without
+    checkpoints) and keep the canonical results.
+
+    PARAMETERS
+    ----------
+    `images`:
+        `list`. Paths of the schematic images.
+    `config`:
+        `dict`. Configuration, see `loadConfig()`.
+    `model`:
+        `CSPICEnet` or `png2spice.benchmark.CStubSPICEnet`.
+    `ocr`:
+        `bool`. Read part names by OCR.
+    `scalings`:
+        `dict`. Image name to the scaling factor, so that both
+        configurations work at the same scale. Images without one have it
+        estimated by OCR in every run.
+    `repeat`:
+        `int`. Runs per image; the timings of the fastest are kept.
+
+    RETURNS
+    -------
+    `dict`. Image name to `result` (see `canonicalResult()`), `seconds`,
+    `timings` (seconds per stage) and `error` (`None` or the message).
+    """
+    scalings = scalings or dict()
+    options = {"dense": False, "cropStore": False, "rotations": "off", "graphWorkers": 0}
+    options.update(config["options"])
+    runs = dict()
+    for image in images:
+        name = basename(image)
+        overrides = dict(config["params"])
+        if scalings.get(name) and "scalingFactor" not in overrides:
+            overrides["scalingFactor"] = scalings[name]
+        params = P2SParameters.freeze(**overrides)
+        best = {"result": None, "seconds": None, "timings": dict(), "error": None}
+        for _ in range(max(1, repeat)):
+            with tempfile.TemporaryDirectory(prefix="p2s-equivalence-") as workDir:
+                t = time.perf_counter()
+                try:
+                    res = pipeline.runImage(image, workDir, model, params, None, ocr, **options)
+                except Exception as e:
+                    best = {"result": None, "seconds": None, "timings": dict(),
+                            "error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc()}
+                    break
+                seconds = time.perf_counter() - t
+            if best["seconds"] is None or seconds < best["seconds"]:
+                best = {"result": canonicalResult(res), "seconds": seconds, "timings": res["timings"],
+                        "error": None}
+        runs[name] = best
+    return runs
+
+
+def _ratio(reference: float, candidate: float) -> float:
+    return reference / candidate if candidate else None
+
+
+def compareRuns(candidate: dict, reference: dict, tolerances: dict=None) -> dict:
+    """
+    BRIEF
+    -----
+    Compare the runs of two configurations (see `runConfig()`) image by
+    image.
+
+    RETURNS
+    -------
+    `dict`. `equal` (all stages of all images equal and no failures),
+    `speedup` (total reference seconds over total candidate seconds),
+    `stages`: stage name to the number of `images` compared, how many of
+    them are `equal` and the `speedup` of the pipeline stage of that name
+    where there is one, and `images`: image name to `equal`, `speedup`,
+    `error` and `stages` (see `compareResults()`).
+    """
+    images, stages = dict(), {s: {"images": 0, "equal": 0} for s in COMPARED_STAGES}
+    seconds = {"reference": 0.0, "candidate": 0.0}
+    timings = {"reference": dict(), "candidate": dict()}
+    for name in sorted(set(candidate) | set(reference)):
+        c, r = candidate.get(name), reference.get(name)
+        if c is None or r is None or c["error"] or r["error"]:
+            error = "missing" if c is None or r is None else c["error"] or r["error"]
+            images[name] = {"equal": False, "speedup": None, "error": error, "stages": dict()}
+            continue
+        diff = compareResults(c["result"], r["result"], tolerances)
+        for stage, d in diff.items():
+            stages[stage]["images"] += 1
+            stages[stage]["equal"] += d["equal"]
+        for which, run in (("reference", r), ("candidate", c)):
+            seconds[which] += run["seconds"]
+            for stage, s in run["timings"].items():
+                timings[which][stage] = timings[which].get(stage, 0.0) + s
+        images[name] = {"equal": all(d["equal"] for d in diff.values()),
+                        "speedup": _ratio(r["seconds"], c["seconds"]), "error": None, "stages": diff}
+    for stage, s in stages.items():
+        if stage in timings["reference"] and stage in timings["candidate"]:
+            s["speedup"] = _ratio(timings["reference"][stage], timings["candidate"][stage])
+    return {"equal": all(i["equal"] for i in images.values()),
+            "speedup": _ratio(seconds["reference"], seconds["candidate"]),
+            "seconds": seconds, "stages": stages, "images": images}
+
+
+def printReport(report: dict):
+    print(f"{'image':<24}" + "".join(f"{s:>10}" for s in COMPARED_STAGES) + f"{'speedup':>10}")
+    for name, img in report["images"].items():
+        if img["error"]:
+            print(f"{name[:23]:<24}FAILED {img['error']}")
+            continue
+        cells = ""
+        for stage in COMPARED_STAGES:
+            d = img["stages"][stage]
+            if d["equal"]:
+                cell = "="
+            elif d["missing"] or d["extra"]:
+                cell = f"+{len(d['extra'])}/-{len(d['missing'])}"
+            else:
+                cell = f"~{len(d['differing'])}"
+            cells += f"{cell:>10}"
+        print(f"{name[:23]:<24}{cells}{img['speedup'] or 0:>9.2f}x")
+    speedup = report["speedup"]
+    print(f"{'total':<24}" + "".join(f"{'%d/%d' % (s['equal'], s['images']):>10}"
+                                      for s in report["stages"].values())
+          + (f"{speedup:>9.2f}x" if speedup else f"{'-':>10}"))
+
+
+def main(argv: list=None) -> int:
+    ap = argparse.ArgumentParser(description="Check that a pipeline configuration gives the same results as a reference.")
+    ap.add_argument("--images", default=DEFAULT_IMAGES, help="Folder of schematic images.")
+    ap.add_argument("--model", default=None, help="Folder containing SPICEnet.h5 and CLASSLIST.json. Default is a stub.")
+    ap.add_argument("--candidate", default="{}", help="Candidate configuration as JSON or a JSON file.")
+    ap.add_argument("--reference", default="{}", help="Reference configuration as JSON or a JSON file.")
+    ap.add_argument("--reference-results", default=None,
+                    help="Compare against results stored by --save-results instead of running the reference.")
+    ap.add_argument("--save-results", default=None,
+                    help="Run only the reference configuration and store its results in this file.")
+    ap.add_argument("--no-ocr", action="store_true", help="Skip OCR; the scaling factor is taken from --scaling.")
+    ap.add_argument("--scaling", type=float, default=None,
+                    help="Fixed scaling factor. Default is one OCR estimate per image, shared by both configurations.")
+    ap.add_argument("--repeat", type=int, default=1, help="Runs per image and configuration; the fastest counts.")
+    ap.add_argument("--tolerance", action="append", default=[], metavar="STAGE=VALUE",
+                    help=f"Tolerance of a stage, e.g. lines=4. Defaults: {DEFAULT_TOLERANCES}. Repeatable.")
+    ap.add_argument("--output", default=None, help="Write the full report to this file.")
+    args = ap.parse_args(argv)
+
+    tolerances = dict()
+    for item in args.tolerance:
+        stage, _, value = item.partition("=")
+        if stage not in COMPARED_STAGES:
+            print(f"Unknown stage '{stage}', expected one of {', '.join(COMPARED_STAGES)}", file=sys.stderr)
+            return 2
+        tolerances[stage] = float(value)
+    images = findImages(args.images)
+    if not images:
+        print(f"No images in {args.images}", file=sys.stderr)
+        return 2
+    reference, candidate = loadConfig(args.reference), loadConfig(args.candidate)
+
+    models = dict()
+
+    def loadModel(path):
+        path = path or args.model
+        if path not in models:
+            if path is None:
+                models[path] = CStubSPICEnet()
+            else:
+                from inference import CSPICEnet
+                models[path] = CSPICEnet(path)
+        return models[path]
+
+    stored = None
+    if args.reference_results:
+        with open(args.reference_results) as f:
+            stored = json.load(f)
+        scalings = stored["scalings"]
+    elif args.scaling is not None or args.no_ocr:
+        scalings = {basename(image): args.scaling or DEFAULT_SCALING for image in images}
+    else:
+        scalings = {basename(image): pipeline.estimateScalingFactor(image) for image in images}
+
+    if stored is not None:
+        referenceRuns = stored["runs"]
+    else:
+        referenceRuns = runConfig(images, reference, loadModel(reference["model"]), not args.no_ocr, scalings,
+                                  args.repeat)
+    if args.save_results:
+        with open(args.save_results, "w") as f:
+            json.dump({"config": reference, "scalings": scalings, "runs": referenceRuns}, f)
+        failed = [name for name, run in referenceRuns.items() if run["error"]]
+        for name in failed:
+            print(f"{name}: FAILED {referenceRuns[name]['error']}", file=sys.stderr)
+        print(f"Results of {len(referenceRuns)} image(s) written to {args.save_results}")
+        return 1 if failed else 0
+
+    candidateRuns = runConfig(images, candidate, loadModel(candidate["model"]), not args.no_ocr, scalings,
+                              args.repeat)
+    report = compareRuns(candidateRuns, referenceRuns, tolerances)
+    report["reference"] = stored["config"] if stored is not None else reference
+    report["candidate"] = candidate
+    report["tolerances"] = dict(DEFAULT_TOLERANCES, **tolerances)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    printReport(report)
+    if not report["equal"]:
+        print("[EQUIVALENCE]: The candidate differs from the reference", file=sys.stderr)
+    return 0 if report["equal"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,409 @@
+"""
+This submodule of **png2spice** spreads SPICEnet inference over several
+worker processes. Every worker loads SPICEnet once and is limited to a fixed
+number of `tensorflow` intra-/inter-op threads and `cv2` threads (see
+`configureThreads()`), so that the workers neither oversubscribe the CPU among
+themselves nor fight with the threads of tesseract. The snapshots of a
+`predict()` call are split into shards, which the workers take in turn, and
+the busy time of every worker is recorded.
+
+`CInferenceExecutor` has the same prediction methods as
+`png2spice.inference.CSPICEnet` (`predict()`, `predictStore()`,
+`predictArrays()`, `predictRotations()`, `predictDense()`), so it can be
+handed to the pipeline, the streaming pipeline, the conversion server or an
+incremental session as the model:
+
+    with CInferenceExecutor("../SPICEnet", workers=4, threads=4) as model:
+        pipeline.runImage("schematic.png", "work", model)
+        print(model.stats())
+"""
+
+import json
+import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from os.path import join, basename, splitext
+
+import numpy as np
+
+import lines
+import tracing
+from cropstore import CCropStore
+from ocrtools import read_part_OCR
+from parameters import CP2SContext, getContext
+
+_model = None
+_stores = dict()
+
+
+def configureThreads(intraOp: int, interOp: int=1, cv2Threads: int=None):
+    """
+    BRIEF
+    -----
+    Limit the threads `tensorflow`, `cv2` and OpenMP (used by tesseract)
+    start in this process.
+
+    PARAMETERS
+    ----------
+    `intraOp`:
+        `int`. Threads `tensorflow` uses within a single operation.
+    `interOp`:
+        `int`. Operations `tensorflow` runs concurrently.
+    `cv2Threads`:
+        `int`. Threads of `cv2`. Default is `intraOp`.
+
+    NOTES
+    -----
+    Has to be called before `tensorflow` runs anything in this process.
+    Afterwards, its thread pools are fixed and only the `cv2` setting
+    takes effect.
+    """
+    cv2Threads = intraOp if cv2Threads is None else cv2Threads
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(intraOp)
+    os.environ["TF_NUM_INTEROP_THREADS"] = str(interOp)
+    os.environ["OMP_NUM_THREADS"] = str(intraOp)
+    import cv2
+    cv2.setNumThreads(cv2Threads)
+    import tensorflow as tf
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(intraOp)
+        tf.config.threading.set_inter_op_parallelism_threads(interOp)
+    except RuntimeError:
+        print("[EXECUTOR WARN]: tensorflow is already initialized, its thread settings are unchanged")
+
+
+def _initWorker(modelPath: str, intraOp: int, interOp: int, cv2Threads: int):
+    global _model
+    configureThreads(intraOp, interOp, cv2Threads)
+    from inference import CSPICEnet
+    _model = CSPICEnet(modelPath)
+
+
+def _openStore(path: str) -> CCropStore:
+    """
+    BRIEF
+    -----
+    Get the crop archive at `path`, opened once per worker and file state.
+    """
+    state = (path, os.path.getmtime(path), os.path.getsize(path))
+    if state not in _stores:
+        _stores.clear()
+        _stores[state] = CCropStore(path)
+    return _stores[state]
+
+
+def _inputSize(imgResize: int) -> tuple:
+    return _model.inputSize(imgResize)
+
+
+def _runShard(items: list, imgResize: int, batchSize: int, ocr: bool, storePath: str=None) -> tuple:
+    """
+    BRIEF
+    -----
+    Classify (and read by OCR) one shard of snapshots in a worker.
+
+    PARAMETERS
+    ----------
+    `items`:
+        `list`. `(label, file)` pairs, `(label, crop)` pairs of crops sent
+        along as `np.ndarray`, or `(label, position)` pairs of crops in the
+        archive at `storePath`.
+
+    RETURNS
+    -------
+    `tuple`. `(pid, busySeconds, preds, ocrs)`, `ocrs` keyed by label.
+    """
+    t = time.perf_counter()
+    if storePath is None:
+        crops = [f if isinstance(f, np.ndarray) else lines.imageDataFromPath(f) for _, f in items]
+    else:
+        store = _openStore(storePath)
+        crops = [store.crop(i) for _, i in items]
+    preds = _model.predictArrays(crops, imgResize, batchSize)
+    ocrs = dict()
+    if ocr:
+        for (label, _), crop in zip(items, crops):
+            partOcr = read_part_OCR(crop)
+            if partOcr != None:
+                ocrs[label] = partOcr
+    return os.getpid(), time.perf_counter() - t, preds, ocrs
+
+
+def _rotateShard(crops: list, imgResize: int, batchSize: int) -> tuple:
+    """
+    BRIEF
+    -----
+    Estimate the orientation of one shard of crops in a worker, see
+    `png2spice.inference.CSPICEnet.predictRotations`.
+
+    RETURNS
+    -------
+    `tuple`. `(pid, busySeconds, preds, rotations)`.
+    """
+    t = time.perf_counter()
+    preds, rotations = _model.predictRotations(crops, imgResize, batchSize)
+    return os.getpid(), time.perf_counter() - t, preds, rotations
+
+
+def _denseShard(points: list, img, winSize: int, imgResize: int, tileSize: int, batchSize: int) -> tuple:
+    """
+    BRIEF
+    -----
+    Run the dense SPICEnet pass for one shard of points in a worker, see
+    `png2spice.inference.CSPICEnet.predictDense`.
+
+    RETURNS
+    -------
+    `tuple`. `(pid, busySeconds, preds)`.
+    """
+    t = time.perf_counter()
+    preds = _model.predictDense(img, points, winSize, imgResize, tileSize, batchSize)
+    return os.getpid(), time.perf_counter() - t, preds
+
+
+class CInferenceExecutor:
+    def __init__(self, path: str, workers: int=None, threads: int=None, interOpThreads: int=1,
+                 cv2Threads: int=None, shardSize: int=64, params: CP2SContext=None) -> None:
+        """
+        BRIEF
+        -----
+        Pool of worker processes running SPICEnet on shards of snapshots.
+
+        PARAMETERS
+        ----------
+        `path`:
+            `str`. Folder containing `SPICEnet.h5` and `CLASSLIST.json`.
+        `workers`:
+            `int`. Number of worker processes. Default is the number of CPUs.
+        `threads`:
+            `int`. `tensorflow` intra-op threads per worker. Default is an
+            equal share of the CPUs.
+        `interOpThreads`:
+            `int`. `tensorflow` inter-op threads per worker.
+        `cv2Threads`:
+            `int`. `cv2` threads per worker. Default is `threads`.
+        `shardSize`:
+            `int`. Largest number of snapshots per shard. Smaller shards
+            balance better, larger ones have less overhead.
+        `params`:
+            `png2spice.parameters.CP2SContext`. Default parameters for
+            predictions. Default is a snapshot of the global `P2SParameters`.
+
+        NOTES
+        -----
+        Workers are spawned, not forked, so that they do not inherit an
+        initialized `tensorflow` runtime. Loading SPICEnet in every worker
+        takes a while; reuse the executor for as many images as possible.
+        """
+        self.path = path
+        self.workers = workers or os.cpu_count()
+        self.threads = threads or max(1, os.cpu_count() // self.workers)
+        self.shardSize = shardSize
+        self.params = getContext(params)
+        self.imgResize = self.params.imgResize
+        with open(join(path, "CLASSLIST.json")) as f:
+            self.classlist = json.load(f)["class_list"]
+        self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                        mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_initWorker,
+                                        initargs=(path, self.threads, interOpThreads, cv2Threads))
+        self.lock = threading.Lock()
+        self.workerStats = dict()
+        self.wallSeconds = 0.0
+        self.inputSizes = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+    def inputSize(self, imgResize: int) -> tuple:
+        """
+        BRIEF
+        -----
+        Same as `png2spice.inference.CSPICEnet.inputSize`, asked from a
+        worker once per `imgResize`.
+        """
+        if imgResize not in self.inputSizes:
+            self.inputSizes[imgResize] = self.pool.submit(_inputSize, imgResize).result()
+        return self.inputSizes[imgResize]
+
+    def predict(self, path: str, ocr: bool=True, show: bool=False, params: CP2SContext=None, cancel=None,
+                batchSize: int=32):
+        """
+        BRIEF
+        -----
+        Get the predictions (and OCR results) for all snapshots below
+        `path`. Same signature and return values as
+        `png2spice.inference.CSPICEnet.predict`; `show` is not supported.
+
+        PARAMETERS
+        ----------
+        `batchSize`:
+            `int`. Number of snapshots per forward pass within a worker.
+        """
+        files = list()
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(join(root, n) for n in sorted(names) if n.endswith(".png"))
+        items = [(splitext(basename(f))[0], f) for f in files]
+        return self.__run(items, params, ocr, cancel, batchSize)
+
+    def predictStore(self, store: CCropStore, ocr: bool=True, params: CP2SContext=None, cancel=None,
+                     batchSize: int=32, source: str=None):
+        """
+        BRIEF
+        -----
+        Same as `png2spice.inference.CSPICEnet.predictStore`. The workers
+        map the archive themselves, only positions are sent to them.
+        """
+        store.flush()
+        items = [(store.index[i]["label"], i) for i in store.select(source)]
+        return self.__run(items, params, ocr, cancel, batchSize, store.path)
+
+    def predictArrays(self, crops: list, imgResize: int=None, batchSize: int=32, cancel=None) -> np.ndarray:
+        """
+        BRIEF
+        -----
+        Same as `png2spice.inference.CSPICEnet.predictArrays`. The crops are
+        sent to the workers in shards.
+        """
+        imgResize = self.imgResize if imgResize is None else imgResize
+        items = [(i, np.asarray(crop)) for i, crop in enumerate(crops)]
+        results = self.__dispatch("inference.predictArrays", self.__shards(items), _runShard,
+                                  (imgResize, batchSize, False), cancel)
+        return self.__concat([preds for _, _, preds, _ in results])
+
+    def predictRotations(self, crops: list, imgResize: int=None, batchSize: int=32, cancel=None) -> tuple:
+        """
+        BRIEF
+        -----
+        Same as `png2spice.inference.CSPICEnet.predictRotations`. The crops
+        are sent to the workers in shards.
+        """
+        imgResize = self.imgResize if imgResize is None else imgResize
+        crops = [np.asarray(crop) for crop in crops]
+        results = self.__dispatch("inference.rotations", self.__shards(crops), _rotateShard,
+                                  (imgResize, batchSize), cancel)
+        return self.__concat([preds for _, _, preds, _ in results]), \
+            [degrees for _, _, _, rotations in results for degrees in rotations]
+
+    def predictDense(self, img, points: list, winSize: int, imgResize: int=None, tileSize: int=1024,
+                     batchSize: int=32, cancel=None) -> np.ndarray:
+        """
+        BRIEF
+        -----
+        Same as `png2spice.inference.CSPICEnet.predictDense`. The points are
+        sorted by position and split into one shard per worker, so that
+        every worker runs the backbone on a band of tiles; each worker gets
+        its own copy of `img`.
+
+        NOTES
+        -----
+        The tiles are aligned to the image, not to the shard, so the results
+        are the same as the ones of a single `CSPICEnet`.
+        """
+        imgResize = self.imgResize if imgResize is None else imgResize
+        order = sorted(range(len(points)), key=lambda i: (points[i][1], points[i][0]))
+        size = max(1, math.ceil(len(order) / self.workers))
+        shards = [[points[i] for i in order[start:start + size]] for start in range(0, len(order), size)]
+        img = np.asarray(img)
+        results = self.__dispatch("inference.dense", shards, _denseShard,
+                                  (img, winSize, imgResize, tileSize, batchSize), cancel)
+        sortedPreds = self.__concat([preds for _, _, preds in results])
+        preds = np.empty_like(sortedPreds)
+        preds[order] = sortedPreds
+        return preds
+
+    def predsToDict(self, preds: np.ndarray, labels: list) -> dict:
+        """
+        BRIEF
+        -----
+        Same as `png2spice.inference.CSPICEnet.predsToDict`.
+        """
+        return {label: dict(zip(self.classlist, pred)) for pred, label in zip(preds, labels)}
+
+    def __shards(self, items: list) -> list:
+        size = max(1, min(self.shardSize, math.ceil(len(items) / self.workers)))
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    def __concat(self, preds: list) -> np.ndarray:
+        if not preds:
+            return np.zeros((0, len(self.classlist)))
+        return np.concatenate(preds)
+
+    def __dispatch(self, span: str, shards: list, func, args: tuple, cancel) -> list:
+        """
+        BRIEF
+        -----
+        Run `func(shard, *args)` for every shard in the workers and record
+        their busy time.
+
+        RETURNS
+        -------
+        `list`. Results of `func` in the order of `shards`, each starting
+        with `(pid, busySeconds)`.
+        """
+        t = time.perf_counter()
+        with tracing.span(span, crops=sum(len(shard) for shard in shards), shards=len(shards)):
+            futures = [self.pool.submit(func, shard, *args) for shard in shards]
+            pending = set(futures)
+            while pending:
+                _, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                if cancel is not None and cancel.is_set():
+                    for future in pending:
+                        future.cancel()
+                    raise CancelledError()
+            results = [future.result() for future in futures]
+        wall = time.perf_counter() - t
+
+        with self.lock:
+            self.wallSeconds += wall
+            for shard, (pid, busy, *_) in zip(shards, results):
+                s = self.workerStats.setdefault(pid, {"busySeconds": 0.0, "shards": 0, "crops": 0})
+                s["busySeconds"] += busy
+                s["shards"] += 1
+                s["crops"] += len(shard)
+        return results
+
+    def __run(self, items: list, params: CP2SContext, ocr: bool, cancel, batchSize: int,
+              storePath: str=None):
+        imgResize = self.imgResize if params is None else params.imgResize
+        results = self.__dispatch("inference.classify", self.__shards(items), _runShard,
+                                  (imgResize, batchSize, ocr, storePath), cancel)
+        predDict, ocrs = dict(), dict()
+        for _, _, _, shardOcrs in results:
+            ocrs.update(shardOcrs)
+        for (label, _), pred in zip(items, (p for _, _, preds, _ in results for p in preds)):
+            predDict[label] = dict(zip(self.classlist, pred))
+        if ocr:
+            return predDict, ocrs
+        return predDict
+
+    def stats(self) -> dict:
+        """
+        BRIEF
+        -----
+        Get how busy the workers were during the predictions so far.
+
+        RETURNS
+        -------
+        `dict`. `workers`, `threads`, `wallSeconds` (time spent in the
+        prediction methods) and `perWorker`: process ID to `busySeconds`, `shards`,
+        `crops` and `utilization` (busy share of `wallSeconds`).
+        """
+        with self.lock:
+            perWorker = {pid: dict(s) for pid, s in self.workerStats.items()}
+            wall = self.wallSeconds
+        for s in perWorker.values():
+            s["utilization"] = s["busySeconds"] / wall if wall else 0.0
+        return {"workers": self.workers, "threads": self.threads, "wallSeconds": wall,
+                "perWorker": perWorker}
@@ -6,12 +6,16 @@ visible in `png2spice.parameters.py`.
 """
 
 import numpy as np
-from POI import POI, POITypes, isValidPOI, pred2Type
+from POI import POI, POITypes, isProposalLabel, isValidPOI, pred2Type, proposalPosition
 import math
-from parameters import P2SParameters
+from parameters import CP2SContext, getContext
+from connectivity import CNets
+from spatial import CSpatialIndex
+import tracing
 
 class CGraph:
-    def __init__(self, lines: np.ndarray, preds: dict, ocrs: dict) -> None:
+    def __init__(self, lines: np.ndarray, preds: dict, ocrs: dict, params: CP2SContext=None,
+                 rotations: dict=None) -> None:
         """
         BRIEF
         -----
@@ -22,9 +26,18 @@ class CGraph:
         `lines`:
             `np.ndarray`. Line coordinates obtained from `png2spice.lines.getHoughLines`.
         `preds`:
-            `dict`. Dictionary of predictions obtained from `png2spice.inference.CSPICEnet.predict`.
+            `dict`. Dictionary of predictions obtained from `png2spice.inference.CSPICEnet.predict`,
+            per line end point label. Symbol proposals without a line end point (see
+            `png2spice.lines.clusterEndpoints`) become POIs at the position in their label.
         `ocrs`:
             `dict`. Dictionary of OCR detections obtained from `png2spice.inference.CSPICEnet.predict`.
+        `params`:
+            `png2spice.parameters.CP2SContext`. Parameters of this run. Default is a
+            snapshot of the global `P2SParameters`.
+        `rotations`:
+            `dict`. LTSPICE rotations in degrees obtained from
+            `png2spice.inference.CSPICEnet.predictRotations`, per label. These
+            POIs keep their rotation in `analyzeRotations()`.
 
         NOTES
         -----
@@ -32,29 +45,39 @@ class CGraph:
         x/y coordinates is done in `png2spice.parsing.CParser`.
         """
         self.lines = lines
+        self.params = getContext(params)
         self.looseGraph = list()
-        for i, line in enumerate(lines):
-            classifications = list(preds[f"{i}A"].values())
-            ocr = None
-            if ocrs:
-                if f"{i}A" in ocrs.keys():
-                    ocr = ocrs[f"{i}A"]
-            if isValidPOI(classifications):
-                self.looseGraph.append(POI(f"{i}A",
-                                           line[0:2],
-                                           pred2Type(classifications),
-                                           ocr))
-            
-            classifications = list(preds[f"{i}B"].values())
-            ocr = None
-            if ocrs:
-                if f"{i}B" in ocrs.keys():
-                    ocr = ocrs[f"{i}B"]
-            if isValidPOI(classifications):
-                self.looseGraph.append(POI(f"{i}B",
-                                           line[2:4],
-                                           pred2Type(classifications),
-                                           ocr))
+        self.nets = None
+        self.index = None
+        with tracing.span("graph.build", predictions=len(preds)) as sp:
+            for i, line in enumerate(lines):
+                for label, position in ((f"{i}A", line[0:2]), (f"{i}B", line[2:4])):
+                    # End points too close to the image border have no snapshot
+                    if label not in preds:
+                        continue
+                    self.__addPrediction(label, position, preds, ocrs, rotations)
+            for label in sorted(l for l in preds if isProposalLabel(l)):
+                self.__addPrediction(label, proposalPosition(label), preds, ocrs, rotations)
+            sp.count("validPOIs", len(self.looseGraph))
+
+    def __addPrediction(self, label: str, position, preds: dict, ocrs: dict, rotations: dict):
+        """
+        BRIEF
+        -----
+        Append a POI for the prediction of `label` if it is confident
+        enough, see `__init__()`.
+        """
+        classifications = list(preds[label].values())
+        ocr = None
+        if ocrs:
+            if label in ocrs.keys():
+                ocr = ocrs[label]
+        if isValidPOI(classifications):
+            poi = POI(label, position, pred2Type(classifications), ocr)
+            if rotations and label in rotations:
+                poi.rotation = rotations[label]
+                poi.rotationInferred = True
+            self.looseGraph.append(poi)
 
 
     def rmDuplicates(self):
@@ -68,12 +91,15 @@ class CGraph:
         -----
         Modifies the graph's contents in place. Contains **P2S parameters** `DuplicateVariance` and `scalingFactor`.
         """
-        v = int(P2SParameters.DuplicateVariance * P2SParameters.scalingFactor)
-        for poi1 in self.looseGraph:
-            for i, poi2 in enumerate(self.looseGraph):
-                dist = math.dist(tuple(poi1.position),tuple(poi2.position))
-                if(poi1 != poi2 and dist < v and poi1.type == poi2.type):
-                    del self.looseGraph[i]
+        with tracing.span("graph.rmDuplicates") as sp:
+            v = self.params.DuplicateVarianceScaled
+            for poi1 in self.looseGraph:
+                for i, poi2 in enumerate(self.looseGraph):
+                    dist = math.dist(tuple(poi1.position),tuple(poi2.position))
+                    if(poi1 != poi2 and dist < v and poi1.type == poi2.type):
+                        del self.looseGraph[i]
+            self.index = None
+            sp.count("pois", len(self.looseGraph))
     
 
     def link(self):
@@ -86,24 +112,27 @@ class CGraph:
         -----
         Modifies the graph's contents in place. Contains **P2S parameters** `ComponentTerminalAVariance` and `ComponentTerminalBVariance`.
         """
-        ComponentTerminalAVariance = int(P2SParameters.ComponentTerminalAVariance * P2SParameters.scalingFactor)
-        ComponentTerminalBVariance = int(P2SParameters.ComponentTerminalBVariance * P2SParameters.scalingFactor)
-        for lG in self.looseGraph:
-            for line in self.lines:
-                if(math.dist(lG.position, line[0:2]) < ComponentTerminalBVariance):
-                    if(lG.terminalBLine is None):
-                        lG.terminalBLine = line[2:4]
-                    elif(lG.terminalALine is None):
-                        lG.terminalALine = line[2:4]
-
-        for lG1 in self.looseGraph:
-            for lG2 in self.looseGraph:
-                if(lG1.terminalALine is not None and lG1.terminalA is None and (math.dist(lG2.position, lG1.terminalALine) < ComponentTerminalAVariance)):
-                    if(lG1.terminalA is None):
-                        lG1.terminalA = lG2
-                elif(lG1.terminalBLine is not None and lG1.terminalB is None and (math.dist(lG2.position, lG1.terminalBLine) < ComponentTerminalBVariance)):
-                    if(lG1.terminalB is None):
-                        lG1.terminalB = lG2
+        with tracing.span("graph.link") as sp:
+            ComponentTerminalAVariance = self.params.ComponentTerminalAVarianceScaled
+            ComponentTerminalBVariance = self.params.ComponentTerminalBVarianceScaled
+            for lG in self.looseGraph:
+                for line in self.lines:
+                    if(math.dist(lG.position, line[0:2]) < ComponentTerminalBVariance):
+                        if(lG.terminalBLine is None):
+                            lG.terminalBLine = line[2:4]
+                        elif(lG.terminalALine is None):
+                            lG.terminalALine = line[2:4]
+
+            for lG1 in self.looseGraph:
+                for lG2 in self.looseGraph:
+                    if(lG1.terminalALine is not None and lG1.terminalA is None and (math.dist(lG2.position, lG1.terminalALine) < ComponentTerminalAVariance)):
+                        if(lG1.terminalA is None):
+                            lG1.terminalA = lG2
+                    elif(lG1.terminalBLine is not None and lG1.terminalB is None and (math.dist(lG2.position, lG1.terminalBLine) < ComponentTerminalBVariance)):
+                        if(lG1.terminalB is None):
+                            lG1.terminalB = lG2
+            self.index = None
+            sp.count("links", sum((p.terminalA is not None) + (p.terminalB is not None) for p in self.looseGraph))
     
     def angle_of_line(self, p1: tuple, p2: tuple):
         """
@@ -133,21 +162,33 @@ class CGraph:
 
         NOTES
         -----
-        Modifies the graph's contents in place. 
-        """
-        skipped = [POITypes.Corner, POITypes.Junction, POITypes.Diode]
-        for lG in self.looseGraph:
-            if(lG.terminalALine is not None):
-                if(abs(self.angle_of_line(lG.terminalALine, lG.position)) > 45 and abs(self.angle_of_line(lG.terminalALine, lG.position)) < 165):
-                    lG.rotation = 0
-                else:
-                    lG.rotation = 90 # COMPENTS LAY
-                
-            if(lG.terminalBLine is not None):
-                if(abs(self.angle_of_line(lG.terminalBLine, lG.position)) > 45 and abs(self.angle_of_line(lG.terminalBLine, lG.position)) < 165):
-                    lG.rotation = 0
-                else:
-                    lG.rotation = 90 # COMPENTS LAY
+        Modifies the graph's contents in place. POIs whose rotation was
+        inferred by SPICEnet are left as they are.
+        """
+        with tracing.span("graph.analyzeRotations", pois=len(self.looseGraph)):
+            skipped = [POITypes.Corner, POITypes.Junction, POITypes.Diode]
+            for lG in self.looseGraph:
+                self.__analyzeRotation(lG)
+
+    def __analyzeRotation(self, lG: POI):
+        """
+        BRIEF
+        -----
+        Analyze the rotation of a single component, see `analyzeRotations()`.
+        """
+        if lG.rotationInferred:
+            return
+        if(lG.terminalALine is not None):
+            if(abs(self.angle_of_line(lG.terminalALine, lG.position)) > 45 and abs(self.angle_of_line(lG.terminalALine, lG.position)) < 165):
+                lG.rotation = 0
+            else:
+                lG.rotation = 90 # COMPENTS LAY
+
+        if(lG.terminalBLine is not None):
+            if(abs(self.angle_of_line(lG.terminalBLine, lG.position)) > 45 and abs(self.angle_of_line(lG.terminalBLine, lG.position)) < 165):
+                lG.rotation = 0
+            else:
+                lG.rotation = 90 # COMPENTS LAY
     
     def snapToGrid(self):
         """
@@ -159,10 +200,20 @@ class CGraph:
         -----
         Modifies the graph's contents in place. Contains **P2S parameters** `minGridStep`.
         """
-        d = P2SParameters.minGridStep
-        for poi in self.looseGraph:
-            x, y = tuple(poi.position)
-            poi.position = tuple(((x + d//2) // d * d, (y + d//2) // d * d))
+        with tracing.span("graph.snapToGrid", pois=len(self.looseGraph)):
+            for poi in self.looseGraph:
+                poi.position = self.__snapPosition(poi.position)
+            self.index = None
+
+    def __snapPosition(self, position) -> tuple:
+        """
+        BRIEF
+        -----
+        Snap a single position to the grid, see `snapToGrid()`.
+        """
+        d = self.params.minGridStep
+        x, y = tuple(position)
+        return tuple(((x + d//2) // d * d, (y + d//2) // d * d))
 
 
     def alignToGrid(self):
@@ -177,23 +228,333 @@ class CGraph:
         -----
         Modifies the graph's contents in place. Contains **P2S parameters** `minGridStep`.
         """
-        d = P2SParameters.minGridStep
-        margin = (d*2, d*2)
-        for poi1 in self.looseGraph:
-            for poi2 in self.looseGraph:
-                if(poi1.rotation == poi2.rotation):
-                    if(poi1.rotation == 0):
-                        # snap to same x-axis
+        with tracing.span("graph.alignToGrid", pois=len(self.looseGraph)):
+            d = self.params.minGridStep
+            margin = (d*2, d*2)
+            for poi1 in self.looseGraph:
+                for poi2 in self.looseGraph:
+                    # Turned upside down, a part still lies on the same axis
+                    if(poi1.rotation % 180 == poi2.rotation % 180):
+                        if(poi1.rotation % 180 == 0):
+                            # snap to same x-axis
+                            if abs(poi1.position[0] - poi2.position[0]) < margin[0]:
+                                poi2.position = (poi1.position[0], poi2.position[1])
+                        elif poi1.rotation % 180 == 90:
+                            # snap to same y-axis
+                            if abs(poi1.position[1] - poi2.position[1]) < margin[1]:
+                                poi2.position = (poi2.position[0], poi1.position[1])
+                        else:
+                            print("[GRID ALIGN WARN]: Rotation is not a multiple of 90°")
+                    if(poi1.type == POITypes.Corner or poi1.type == POITypes.Junction or poi1.type == POITypes.GND):
                         if abs(poi1.position[0] - poi2.position[0]) < margin[0]:
                             poi2.position = (poi1.position[0], poi2.position[1])
-                    elif poi1.rotation == 90:
-                        # snap to same y-axis
                         if abs(poi1.position[1] - poi2.position[1]) < margin[1]:
                             poi2.position = (poi2.position[0], poi1.position[1])
-                    else:
-                        print("[GRID ALIGN WARN]: Rotation is higher than 90°")
-                if(poi1.type == POITypes.Corner or poi1.type == POITypes.Junction or poi1.type == POITypes.GND):
-                    if abs(poi1.position[0] - poi2.position[0]) < margin[0]:
-                        poi2.position = (poi1.position[0], poi2.position[1])
-                    if abs(poi1.position[1] - poi2.position[1]) < margin[1]:
-                        poi2.position = (poi2.position[0], poi1.position[1])
\ No newline at end of file
+            self.index = None
+
+
+    def __radii(self) -> tuple:
+        """
+        BRIEF
+        -----
+        Get the scaled duplicate and terminal thresholds as used by
+        `rmDuplicates()` and `link()`.
+        """
+        return (self.params.DuplicateVarianceScaled,
+                self.params.ComponentTerminalAVarianceScaled,
+                self.params.ComponentTerminalBVarianceScaled)
+
+    def __buildIndex(self):
+        """
+        BRIEF
+        -----
+        Build the spatial indices over POI positions, line start points and
+        terminal lines if they are not valid anymore. Any full stage
+        (`rmDuplicates()`, `link()`, `snapToGrid()`, `alignToGrid()`)
+        invalidates them.
+        """
+        if self.index is not None:
+            return
+        v, tA, tB = self.__radii()
+        cellSize = max(v, tA, tB, 2 * self.params.minGridStep)
+        self.index = CSpatialIndex(cellSize)
+        self.lineIndex = CSpatialIndex(cellSize)
+        self.terminalIndex = CSpatialIndex(cellSize)
+        self.order = dict()
+        for poi in self.looseGraph:
+            self.__indexPOI(poi)
+        for i, line in enumerate(self.lines):
+            self.lineIndex.insert(i, line[0:2])
+
+    def __indexPOI(self, poi: POI):
+        if poi not in self.order:
+            self.order[poi] = len(self.order)
+        self.index.insert(poi, poi.position)
+        self.__indexTerminalLines(poi)
+
+    def __indexTerminalLines(self, poi: POI):
+        for t, line in (("A", poi.terminalALine), ("B", poi.terminalBLine)):
+            if line is None:
+                self.terminalIndex.remove((poi, t))
+            else:
+                self.terminalIndex.insert((poi, t), line)
+
+    def __unindexPOI(self, poi: POI):
+        self.index.remove(poi)
+        self.terminalIndex.remove((poi, "A"))
+        self.terminalIndex.remove((poi, "B"))
+
+    def __linkTerminalLines(self, poi: POI):
+        """
+        BRIEF
+        -----
+        Find the terminal lines of a single POI from the lines starting
+        close to it, see `link()`.
+        """
+        _, _, tB = self.__radii()
+        poi.terminalALine = None
+        poi.terminalBLine = None
+        for i in sorted(self.lineIndex.query(poi.position, tB)):
+            line = self.lines[i]
+            if(poi.terminalBLine is None):
+                poi.terminalBLine = line[2:4]
+            elif(poi.terminalALine is None):
+                poi.terminalALine = line[2:4]
+        self.__indexTerminalLines(poi)
+
+    def __resolveTerminals(self, poi: POI):
+        """
+        BRIEF
+        -----
+        Resolve `terminalA` and `terminalB` of a single POI against its
+        neighbourhood. Candidates are visited in graph order, which gives
+        the same result as `link()` would.
+        """
+        _, tA, tB = self.__radii()
+        poi.terminalA = None
+        poi.terminalB = None
+        candidates = set()
+        if poi.terminalALine is not None:
+            candidates.update(self.index.query(poi.terminalALine, tA))
+        if poi.terminalBLine is not None:
+            candidates.update(self.index.query(poi.terminalBLine, tB))
+        for other in sorted(candidates, key=self.order.get):
+            if(poi.terminalALine is not None and poi.terminalA is None and (math.dist(other.position, poi.terminalALine) < tA)):
+                poi.terminalA = other
+            elif(poi.terminalBLine is not None and poi.terminalB is None and (math.dist(other.position, poi.terminalBLine) < tB)):
+                poi.terminalB = other
+
+    def __relinkAround(self, positions: list):
+        """
+        BRIEF
+        -----
+        Re-resolve the terminals of all POIs whose terminal lines end close
+        to any of `positions`. The search reaches further than the terminal
+        thresholds, as alignment may have moved POIs since linking.
+        """
+        _, tA, tB = self.__radii()
+        reach = max(tA, tB) + 4 * self.params.minGridStep
+        affected = set()
+        for pos in positions:
+            for poi, _ in self.terminalIndex.query(pos, reach):
+                affected.add(poi)
+        for poi in affected:
+            if poi in self.index:
+                self.__resolveTerminals(poi)
+
+    def __findDuplicate(self, poi: POI):
+        """
+        BRIEF
+        -----
+        Get the POI of the same type within `DuplicateVariance` which comes
+        first in graph order, or `None`.
+        """
+        v, _, _ = self.__radii()
+        dups = [p for p in self.index.query(poi.position, v) if p is not poi and p.type == poi.type]
+        if not dups:
+            return None
+        return min(dups, key=self.order.get)
+
+    def __place(self, poi: POI):
+        """
+        BRIEF
+        -----
+        Snap a single POI to the grid and align it to the POIs in its row
+        and column band, see `snapToGrid()` and `alignToGrid()`. Only the
+        edited POI moves, the rest of the layout stays untouched.
+        """
+        d = self.params.minGridStep
+        margin = (d*2, d*2)
+        x, y = self.__snapPosition(poi.position)
+        band = set(self.index.queryBand(0, x, margin[0])) | set(self.index.queryBand(1, y, margin[1]))
+        for other in sorted(band, key=self.order.get):
+            if other is poi:
+                continue
+            if(other.rotation % 180 == poi.rotation % 180):
+                if(other.rotation % 180 == 0 and abs(other.position[0] - x) < margin[0]):
+                    x = other.position[0]
+                elif(other.rotation % 180 == 90 and abs(other.position[1] - y) < margin[1]):
+                    y = other.position[1]
+            if(other.type == POITypes.Corner or other.type == POITypes.Junction or other.type == POITypes.GND):
+                if abs(other.position[0] - x) < margin[0]:
+                    x = other.position[0]
+                if abs(other.position[1] - y) < margin[1]:
+                    y = other.position[1]
+        poi.position = (x, y)
+        self.index.move(poi, poi.position)
+
+    def __removeDuplicateOf(self, poi: POI):
+        """
+        BRIEF
+        -----
+        Resolve a duplicate conflict of `poi` after an edit. The POI which
+        comes first in graph order survives.
+
+        RETURNS
+        -------
+        `POI`. The surviving POI.
+        """
+        dup = self.__findDuplicate(poi)
+        if dup is None:
+            return poi
+        if self.order[dup] < self.order[poi]:
+            self.removePOI(poi)
+            return dup
+        self.removePOI(dup)
+        return poi
+
+    def addPOI(self, poi: POI) -> POI:
+        """
+        BRIEF
+        -----
+        Insert a single POI into a processed graph. Duplicates, terminals,
+        rotation and grid alignment are only re-evaluated within the
+        neighbourhood of the new POI.
+
+        PARAMETERS
+        ----------
+        `poi`: `png2spice.POI.POI`
+            New POI with its position in image coordinates.
+
+        RETURNS
+        -------
+        `POI`. The inserted POI, or the already present POI of the same type
+        if the new one is a duplicate of it.
+        """
+        self.__buildIndex()
+        dup = self.__findDuplicate(poi)
+        if dup is not None:
+            return dup
+        self.looseGraph.append(poi)
+        self.__indexPOI(poi)
+        self.__linkTerminalLines(poi)
+        self.__resolveTerminals(poi)
+        self.__analyzeRotation(poi)
+        self.__place(poi)
+        self.__relinkAround([poi.position])
+        self.nets = None
+        return poi
+
+    def removePOI(self, poi: POI):
+        """
+        BRIEF
+        -----
+        Remove a single POI from a processed graph and re-resolve the
+        terminals of its neighbours.
+
+        PARAMETERS
+        ----------
+        `poi`: `png2spice.POI.POI`
+            POI to be removed. Has to be part of the graph.
+        """
+        self.__buildIndex()
+        self.looseGraph.remove(poi)
+        self.__unindexPOI(poi)
+        self.__relinkAround([poi.position])
+        self.nets = None
+
+    def retypePOI(self, poi: POI, typ: POITypes) -> POI:
+        """
+        BRIEF
+        -----
+        Change the type of a single POI, e.g. to fix a misclassification.
+
+        PARAMETERS
+        ----------
+        `poi`: `png2spice.POI.POI`
+            POI to be changed. Has to be part of the graph.
+        `typ`: `png2spice.POI.POITypes`
+            New type.
+
+        RETURNS
+        -------
+        `POI`. The surviving POI if the new type makes `poi` a duplicate of
+        a neighbour, else `poi`.
+        """
+        self.__buildIndex()
+        poi.type = typ
+        # The inferred orientation belonged to the old type
+        poi.rotationInferred = False
+        survivor = self.__removeDuplicateOf(poi)
+        if survivor is poi:
+            self.__analyzeRotation(poi)
+            self.__place(poi)
+            self.__relinkAround([poi.position])
+        self.nets = None
+        return survivor
+
+    def movePOI(self, poi: POI, position: tuple) -> POI:
+        """
+        BRIEF
+        -----
+        Move a single POI to a new position and re-evaluate its terminals,
+        rotation and alignment as well as the terminals of its old and new
+        neighbours.
+
+        PARAMETERS
+        ----------
+        `poi`: `png2spice.POI.POI`
+            POI to be moved. Has to be part of the graph.
+        `position`: `tuple`
+            New position in image coordinates.
+
+        RETURNS
+        -------
+        `POI`. The surviving POI if `poi` becomes a duplicate of a
+        neighbour at the new position, else `poi`.
+        """
+        self.__buildIndex()
+        oldPosition = poi.position
+        poi.position = tuple(position)
+        self.index.move(poi, poi.position)
+        survivor = self.__removeDuplicateOf(poi)
+        if survivor is poi:
+            self.__linkTerminalLines(poi)
+            self.__resolveTerminals(poi)
+            self.__analyzeRotation(poi)
+            self.__place(poi)
+        self.__relinkAround([oldPosition, survivor.position])
+        self.nets = None
+        return survivor
+
+
+    def extractNets(self) -> CNets:
+        """
+        BRIEF
+        -----
+        Assign a net ID to every terminal of the linked graph. The result is
+        also stored as `self.nets`.
+
+        RETURNS
+        -------
+        `png2spice.connectivity.CNets`. Net table of the graph.
+
+        NOTES
+        -----
+        Has to be called after `link()`. Any later change of the links
+        invalidates the net table.
+        """
+        with tracing.span("graph.extractNets") as sp:
+            self.nets = CNets(self.looseGraph)
+            sp.count("nets", len(self.nets.table))
+        return self.nets
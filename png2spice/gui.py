@@ -10,17 +10,17 @@ Tkinter SHOULD be a default install with any Python installation.
 import tkinter as tk
 from tkinter import filedialog, ttk
 from PIL import ImageGrab, ImageTk, Image
-import io
-import lines
 import cv2
+import incremental
 import inference
-from os.path import join, exists
+import pipeline
+from os.path import join
 import os
-from graphing import CGraph
-from parsing import CParser
-from ocrtools import get_scaling_from_OCR
 from parameters import P2SParameters
 import numpy as np
+import queue
+import threading
+from concurrent.futures import CancelledError
 
 class ScreenshotApp:
     def __init__(self, root):
@@ -58,35 +58,34 @@ class ScreenshotApp:
         self.root.bind("<Control-v>", self.on_ctrl_v)
 
         ## run-time variables
+        self.worker = None
+        self.cancel_event = threading.Event()
+        self.events = queue.Queue()
+        self.progress_dialog = None
         self.folder_path = os.getcwd()
-        self.input_path = join(self.folder_path, "input.png")
-
-        self.poi_image_path = join(os.getcwd(), "temp", "randomSubFolder")
-        if not os.path.exists(self.poi_image_path):
-            try:
-                os.makedirs(self.poi_image_path)
-            except OSError as e:
-                print(f"Error creating subdirectory {self.poi_image_path}: {e}")
+        self.image = None
+        self.SPICEnet = None
+        self.pipeline = pipeline.CPipeline(cache=pipeline.CStageCache(join(os.getcwd(), ".temp", "checkpoints")))
+        self.session = incremental.CIncrementalSession()
 
 
     def on_ctrl_v(self, event):
         """
         Upon pasting an image from the clipboard into the left panel
-        of the app, the image is saved to a temporary folder and diplayed
-        in scaled fashion inside of the app window.
+        of the app, the image is converted once into a grayscale buffer,
+        which all stages of the analysis consume, and diplayed in scaled
+        fashion inside of the app window. Nothing is written to disk.
         """
         screenshot = ImageGrab.grabclipboard()
-        if screenshot:
+        if isinstance(screenshot, Image.Image):
+            self.image = np.asarray(screenshot.convert("L"))
             max_width, max_height = self.left_frame.winfo_width() - 40, self.left_frame.winfo_height() - 40
-            original_width, original_height = screenshot.size
+            original_height, original_width = self.image.shape
             ratio = min(max_width/original_width, max_height/original_height)
-            new_width, new_height = int(original_width*ratio), int(original_height*ratio)
-            displayScreenshot = screenshot.resize((new_width, new_height))
+            new_width, new_height = max(1, int(original_width*ratio)), max(1, int(original_height*ratio))
+            thumbnail = cv2.resize(self.image, (new_width, new_height), interpolation=cv2.INTER_AREA)
 
-            image_bytes = io.BytesIO()
-            displayScreenshot.save(image_bytes, format='PNG')
-            screenshot.save(self.input_path, format="PNG")
-            image = ImageTk.PhotoImage(data=image_bytes.getvalue())
+            image = ImageTk.PhotoImage(image=Image.fromarray(thumbnail))
             self.image_label.config(image=image)
             self.image_label.image = image
 
@@ -103,19 +102,21 @@ class ScreenshotApp:
         selected_path = filedialog.askdirectory()
         if selected_path:
             self.folder_path = selected_path
-            self.poi_image_path = join(self.folder_path, "POIs", "snapshots")
         print("Selected folder:", self.folder_path)
 
 
     def analyze(self):
         """
-        The `Analyze` button will trigger this callback. At first, the temporary
-        image stored in `on_ctrl_v()` will be consumed. Then, the process will walk 
-        through 6 stages described below in the `dict` `stages`. Each stage updates
-        a progress bar. The stages are described in detail in the paper for this
-        project.
+        The `Analyze` button will trigger this callback. At first, the image
+        buffer filled in `on_ctrl_v()` will be consumed. Then, the process will walk 
+        through 6 stages described below in the `dict` `stages`. The stages run on
+        a worker thread and report their progress through a queue, which is polled
+        by the `tkinter` loop, so the app stays responsive. The stages are described
+        in detail in the paper for this project.
         """
-        if not exists(self.input_path):
+        if self.worker is not None and self.worker.is_alive():
+            return
+        if self.image is None:
             Warning("No image in buffer!")
             return
         
@@ -126,94 +127,149 @@ class ScreenshotApp:
             "Classify POIs": self.stage4,
             "Building graph": self.stage5,
             "Parsing and exporting": self.stage6})
-        
+        if self.session.applies(self.image):
+            # An edited version of the last image: only the changed regions
+            # are analyzed again.
+            stages = dict({
+                "Launching SPICEnet": self.stage3,
+                "Analyzing changed regions": self.stage_update})
+
+        self.cancel_event.clear()
+        self.progress_dialog = ProgressDialog(self.root, self.cancel_event.set)
+        self.worker = threading.Thread(target=self.run_stages, args=(stages,), daemon=True)
+        self.worker.start()
+        self.root.after(50, self.poll_events)
+
+    def run_stages(self, stages: dict):
+        """
+        Worker thread body of `analyze()`. Runs the stages in order and puts
+        `(kind, ...)` events into `self.events`. Never touches `tkinter`.
+        Cancellation is checked between stages and, within `stage4`, between
+        inference batches and OCR snapshots.
+        """
         i = 0
         step = 100 // len(stages.keys())
-        progress_dialog = ProgressDialog(self.root)
+        try:
+            for stage, label in zip(list(stages.values()), list(stages.keys())):
+                if self.cancel_event.is_set():
+                    raise CancelledError()
+                self.events.put(("progress", i, f"{label}... {i}%"))
+                stage()
+                i += step
+            self.events.put(("done",))
+        except CancelledError:
+            self.events.put(("cancelled",))
+        except Exception as e:
+            self.events.put(("error", e))
+
+    def poll_events(self):
+        """
+        Drain the event queue of the worker thread and update the progress
+        dialog. Reschedules itself until the worker reports its end.
+        """
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == "progress":
+                self.progress_dialog.update_progress(event[1], event[2])
+                continue
+            if event[0] == "error":
+                print(f"[ANALYZE ERROR]: {event[1]}")
+            elif event[0] == "cancelled":
+                print("[ANALYZE]: Cancelled")
+            self.progress_dialog.destroy()
+            self.progress_dialog = None
+            return
+        self.root.after(50, self.poll_events)
 
-        for stage, label in zip(list(stages.values()), list(stages.keys())):
-            progress_dialog.update_progress(i, f"{label}... {i}%")
-            stage()
-            i += step
-        
-        progress_dialog.destroy()
+    def resolve(self, target: str):
+        """
+        Resolve a stage of the pipeline DAG for the current image. Stages whose
+        checkpoint exists for this image and these parameters are loaded instead
+        of run, see `png2spice.pipeline.CPipeline`.
+        """
+        res = self.pipeline.run(self.image, self.folder_path, self.base_params,
+                                (target,), self.image_id, cancel=self.cancel_event)
+        self.params = res["params"]
+        return res["outputs"][target]
 
     def stage1(self):
         """
         Data import and normalization stage.
         """
-        print(self.input_path)
-        scalingFactor = get_scaling_from_OCR(self.input_path, threshold=15, letter_to_part_ratio=1/3)
-
-        P2SParameters.setScalingFactor(scalingFactor * -0.5215 + 0.088)
-        
-        img = lines.imageDataFromPath(self.input_path)
-        self.img = lines.normalizeImageData(img)
-        os.remove(self.input_path)
+        self.image_id = pipeline.hashImage(self.image)
+        self.base_params = P2SParameters.freeze()
+        self.img = self.resolve("normalize")
 
 
     def stage2(self):
         """
         Line extraction and POI localization stage. 
         """
-        if not os.path.exists(self.poi_image_path):
-            try:
-                os.makedirs(self.poi_image_path)
-            except OSError as e:
-                print(f"Error creating subdirectory {self.poi_image_path}: {e}")
-        self.HLs = lines.getHoughLines(self.img, spath=self.poi_image_path)
+        self.HLs = self.resolve("lines")
 
 
     def stage3(self):
         """
-        SPICEnet instanciation stage.
+        SPICEnet instanciation stage. The model is only loaded once per app.
         """
-        self.SPICEnet = inference.CSPICEnet(join(os.getcwd(), "SPICEnet"))
+        if self.SPICEnet is None:
+            self.SPICEnet = inference.CSPICEnet(join(os.getcwd(), "SPICEnet"), self.params)
+        self.pipeline.model = self.SPICEnet
 
 
     def stage4(self):
         """
         SPICEnet inference stage.
         """
-        self.preds, self.ocrs = self.SPICEnet.predict(self.folder_path)
+        self.preds, self.ocrs, _ = self.resolve("classify")
     
 
     def stage5(self):
         """
         Graph building stage.
         """
-        self.graph = CGraph(self.HLs, self.preds, self.ocrs)
-        self.graph.rmDuplicates()
-        self.graph.link()
-        self.graph.analyzeRotations()
-        self.graph.snapToGrid()
-        self.graph.alignToGrid()
+        self.graph = self.resolve("graph")
     
 
     def stage6(self):
         """
         Parsing and export stage.
         """
-        parser = CParser(self.graph)
-        output_path = join(self.folder_path, "output.asc")
-        dir = os.listdir(os.getcwd())
-        if(output_path in dir):
-            os.remove(os.path.join(os.getcwd(), output_path))
+        asc, cir = self.resolve("export")
+        pipeline.writeOutputs(self.folder_path, asc, cir)
+        self.session.remember(self.image, self.img, self.params, self.HLs, self.preds, self.ocrs,
+                              self.base_params)
 
-        parser.Graph2Asc(output_path)
+
+    def stage_update(self):
+        """
+        Incremental re-analysis of an edited version of the last image, see
+        `png2spice.incremental.CIncrementalSession.update`.
+        """
+        self.session.model = self.SPICEnet
+        res = self.session.update(self.image, cancel=self.cancel_event)
+        self.params = res["params"]
+        self.HLs, self.preds, self.ocrs, self.graph = res["lines"], res["preds"], res["ocrs"], res["graph"]
+        pipeline.writeOutputs(self.folder_path, res["asc"], res["cir"])
+        print(f"[ANALYZE]: {res['dirtyShare']:.1%} of the image changed, "
+              f"{res['classified']} POIs classified, {res['reused']} taken over")
 
 
 
 class ProgressDialog(tk.Toplevel):
-    def __init__(self, parent):
+    def __init__(self, parent, on_cancel=None):
         """
         Progress bar pop-up for the `analyze()` function. Displays the progress as
-        percent and descriptions of the stages.
+        percent and descriptions of the stages. `on_cancel` is called by the
+        `Cancel` button and when the window is closed.
         """
         super().__init__(parent)
 
         self.title("Progress")
-        self.geometry("300x100")
+        self.geometry("300x130")
 
         self.progress = ttk.Progressbar(self, length=200, mode="determinate")
         self.progress.pack(pady=20)
@@ -221,14 +277,25 @@ class ProgressDialog(tk.Toplevel):
         self.progress_text = tk.Label(self, text="")
         self.progress_text.pack()
 
+        self.on_cancel = on_cancel
+        self.cancel_button = tk.Button(self, text="Cancel", command=self.cancel)
+        self.cancel_button.pack(pady=5)
+        self.protocol("WM_DELETE_WINDOW", self.cancel)
+
         self.grab_set()
 
     def update_progress(self, value, text):
         self.progress["value"] = value
         self.progress_text["text"] = text
-        self.update()
+
+    def cancel(self):
+        self.cancel_button["state"] = "disabled"
+        self.progress_text["text"] = "Cancelling..."
+        if self.on_cancel is not None:
+            self.on_cancel()
 
 
-root = tk.Tk()
-app = ScreenshotApp(root)
-root.mainloop()
+if __name__ == "__main__":
+    root = tk.Tk()
+    app = ScreenshotApp(root)
+    root.mainloop()
@@ -0,0 +1,321 @@
+"""
+This submodule of **png2spice** re-analyzes a slightly edited version of the
+last schematic without processing everything again. A `CIncrementalSession`
+keeps the image, lines, predictions and OCR results of the last run. For a
+new image of the same size, the normalized images are compared tile by tile.
+Lines are only detected again around the changed tiles, and only the
+snapshots whose window overlaps a changed tile are classified and read by
+OCR again. Everything else is taken over from the last run before the graph
+is built.
+
+    session = CIncrementalSession(CSPICEnet("../SPICEnet"))
+    session.run(gray)            # full analysis
+    res = session.update(edited) # only the changed regions
+    print(res["dirtyShare"], res["classified"], res["reused"])
+"""
+
+import math
+from concurrent.futures import CancelledError
+
+import cv2
+import numpy as np
+
+import lines
+import pipeline
+import tracing
+from ocrtools import read_part_OCR
+from POI import isProposalLabel, proposalPosition
+from parameters import CP2SContext, getContext
+from spatial import CSpatialIndex
+
+
+class CIncrementalSession:
+    def __init__(self, model=None, tileSize: int=32, maxDirtyShare: float=0.4, tolerance: int=2) -> None:
+        """
+        BRIEF
+        -----
+        Keep the state of the last analysis for incremental re-analysis.
+
+        PARAMETERS
+        ----------
+        `model`:
+            `png2spice.inference.CSPICEnet`. Loaded model. May be set later.
+        `tileSize`:
+            `int`. Edge length of the diff tiles in pixels of the normalized
+            image.
+        `maxDirtyShare`:
+            `float`. Share of changed tiles above which a full analysis is
+            run instead.
+        `tolerance`:
+            `int`. Distance in pixels within which an end point of the new
+            lines takes over the results of an end point of the last run.
+        """
+        self.model = model
+        self.tileSize = tileSize
+        self.maxDirtyShare = maxDirtyShare
+        self.tolerance = tolerance
+        self.last = None
+
+    def remember(self, gray, img, params: CP2SContext, HLs: np.ndarray, preds: dict, ocrs: dict,
+                 baseParams: CP2SContext=None):
+        """
+        BRIEF
+        -----
+        Store the state of an analysis run elsewhere, e.g. by the pipeline.
+
+        PARAMETERS
+        ----------
+        `gray`:
+            `cv2.typing.MatLike`. Original grayscale image.
+        `img`:
+            `cv2.typing.MatLike`. Normalized image.
+        `params`:
+            `png2spice.parameters.CP2SContext`. Parameters of the run,
+            including the final `scalingFactor`.
+        `HLs`, `preds`, `ocrs`:
+            Lines, predictions and OCR results per end point label.
+        `baseParams`:
+            `png2spice.parameters.CP2SContext`. Parameters a full analysis
+            of another image starts from. Default is `params` with the
+            scaling factor left to be estimated.
+        """
+        if baseParams is None:
+            baseParams = params.replace(scalingFactor=0)
+        self.last = {"shape": tuple(np.shape(gray)[:2]), "img": img, "params": params,
+                     "baseParams": baseParams, "lines": np.asarray(HLs), "preds": dict(preds),
+                     "ocrs": dict(ocrs or {})}
+
+    def applies(self, gray) -> bool:
+        """
+        BRIEF
+        -----
+        Check whether `gray` can be analyzed incrementally, i.e. whether
+        there is a last run of an image of the same size.
+        """
+        return self.last is not None and tuple(np.shape(gray)[:2]) == self.last["shape"]
+
+    def run(self, gray, params: CP2SContext=None, ocr: bool=True, cancel=None) -> dict:
+        """
+        BRIEF
+        -----
+        Analyze `gray` completely and remember the result.
+
+        PARAMETERS
+        ----------
+        `gray`:
+            `cv2.typing.MatLike`. Grayscale image.
+        `params`:
+            `png2spice.parameters.CP2SContext`. A `scalingFactor` of 0 means
+            it is estimated by OCR. Default is a snapshot of the global
+            `P2SParameters`.
+        `ocr`:
+            `bool`. Read part names by OCR.
+        `cancel`:
+            `threading.Event`. Raise `concurrent.futures.CancelledError`
+            once it is set.
+
+        RETURNS
+        -------
+        `dict`. See `update()`.
+        """
+        params = baseParams = getContext(params)
+        if not params.scalingFactor:
+            params = params.replace(scalingFactor=pipeline.estimateScalingFactor(gray))
+        img = lines.normalizeImageData(gray, params)
+        HLs = lines.detectLines(img, True, params)
+        clusters = lines.clusterEndpoints(img, HLs, params)
+        crops = lines.extractLineCrops(img, HLs, params.imageSliceSizeScaled, clusters)
+        preds, ocrs = self.__classify(crops, params, ocr, cancel)
+        preds = lines.expandClusters(preds, clusters)
+        ocrs = lines.expandClusters(ocrs, clusters)
+        self.remember(gray, img, params, HLs, preds, ocrs, baseParams)
+        return self.__finish(HLs, preds, ocrs, params, dirtyShare=1.0, classified=len(crops), reused=0,
+                             incremental=False)
+
+    def update(self, gray, ocr: bool=True, cancel=None) -> dict:
+        """
+        BRIEF
+        -----
+        Analyze an edited version of the last image. Falls back to `run()`
+        if there is no last run of an image of the same size or too much
+        has changed. `run()` then starts from the parameters the last full
+        analysis started from, i.e. it estimates the scaling factor again
+        unless it was given explicitly.
+
+        PARAMETERS
+        ----------
+        `gray`, `ocr`, `cancel`:
+            See `run()`.
+
+        RETURNS
+        -------
+        `dict`. `params`, `lines`, `preds`, `ocrs`, `graph`, `asc`, `cir`,
+        `dirtyShare` (share of changed tiles), `classified` (snapshots
+        classified in this call), `reused` (end points and symbols which
+        took over the results of the last run) and `incremental` (`False`
+        after a full analysis).
+
+        NOTES
+        -----
+        The scaling factor of the last run is kept. Hough lines are found
+        again in the bounding box of the changed tiles and of all old lines
+        touching them; old lines away from the changes are kept as they are.
+        """
+        if not self.applies(gray):
+            params = None if self.last is None else self.last["baseParams"]
+            return self.run(gray, params, ocr, cancel)
+        last = self.last
+        params = last["params"]
+        img = lines.normalizeImageData(gray, params)
+        with tracing.span("incremental.diff") as sp:
+            dirty = self.dirtyTiles(last["img"], img)
+            dirtyShare = float(dirty.mean()) if dirty.size else 0.0
+            sp.set(dirtyShare=dirtyShare)
+        if dirtyShare > self.maxDirtyShare:
+            # Most likely another schematic, possibly at another scale
+            return self.run(gray, last["baseParams"], ocr, cancel)
+        if not dirty.any():
+            self.remember(gray, img, params, last["lines"], last["preds"], last["ocrs"], last["baseParams"])
+            return self.__finish(last["lines"], last["preds"], last["ocrs"], params, dirtyShare, 0,
+                                 len(last["preds"]), True)
+
+        with tracing.span("incremental.lines") as sp:
+            HLs = self.__updateLines(img, last["lines"], dirty, params)
+            sp.count("lines", len(HLs))
+
+        half = params.imageSliceSizeScaled // 2
+        previous = CSpatialIndex(self.tolerance + 1)
+        for i, line in enumerate(last["lines"]):
+            for label, (x, y) in ((f"{i}A", line[0:2]), (f"{i}B", line[2:4])):
+                if label in last["preds"]:
+                    previous.insert(label, (int(x), int(y)))
+
+        preds, ocrs, needed = dict(), dict(), list()
+        for i, line in enumerate(HLs):
+            for label, (x, y) in ((f"{i}A", line[0:2]), (f"{i}B", line[2:4])):
+                x, y = int(x), int(y)
+                match = None
+                if not self.__isDirty(dirty, x - half, y - half, x + half, y + half):
+                    near = previous.query((x, y), self.tolerance + 1)
+                    if near:
+                        match = min(near, key=lambda l: math.dist((x, y), previous.positions[l]))
+                if match is None:
+                    needed.append(label)
+                    continue
+                preds[label] = last["preds"][match]
+                if match in last["ocrs"]:
+                    ocrs[label] = last["ocrs"][match]
+
+        clusters = lines.clusterEndpoints(img, HLs, params)
+        for label, rep in clusters.items():
+            # Symbol proposals without end points are labelled by their position
+            if label != rep or not isProposalLabel(label):
+                continue
+            x, y = proposalPosition(label)
+            if label in last["preds"] and not self.__isDirty(dirty, x - half, y - half, x + half, y + half):
+                preds[label] = last["preds"][label]
+                if label in last["ocrs"]:
+                    ocrs[label] = last["ocrs"][label]
+            else:
+                needed.append(label)
+        reused = len(preds)
+        reps = {clusters[l] for l in needed if l in clusters and clusters[l] not in preds}
+        crops = {l: c for l, c in lines.extractLineCrops(img, HLs, params.imageSliceSizeScaled, clusters).items()
+                 if l in reps}
+        newPreds, newOcrs = self.__classify(crops, params, ocr, cancel)
+        for label in needed:
+            rep = clusters.get(label)
+            if rep in newPreds:
+                preds[label] = newPreds[rep]
+                if newOcrs and rep in newOcrs:
+                    ocrs[label] = newOcrs[rep]
+            elif rep in preds:
+                preds[label] = preds[rep]
+                if rep in ocrs:
+                    ocrs[label] = ocrs[rep]
+
+        if not ocr:
+            ocrs = None
+        self.remember(gray, img, params, HLs, preds, ocrs, last["baseParams"])
+        return self.__finish(HLs, preds, ocrs, params, dirtyShare, len(crops), reused, True)
+
+    def dirtyTiles(self, before, after) -> np.ndarray:
+        """
+        BRIEF
+        -----
+        Compare two normalized images of the same size tile by tile.
+
+        RETURNS
+        -------
+        `np.ndarray`. `bool` array with one entry per tile, `True` where
+        any pixel differs.
+        """
+        h, w = before.shape[:2]
+        t = self.tileSize
+        mask = np.zeros((math.ceil(h / t), math.ceil(w / t)), bool)
+        ys, xs = np.nonzero(cv2.absdiff(before, after))
+        mask[ys // t, xs // t] = True
+        return mask
+
+    def __isDirty(self, dirty: np.ndarray, x0: int, y0: int, x1: int, y1: int) -> bool:
+        t = self.tileSize
+        tx0, ty0 = max(int(min(x0, x1)) // t, 0), max(int(min(y0, y1)) // t, 0)
+        tx1, ty1 = int(max(x0, x1)) // t, int(max(y0, y1)) // t
+        return bool(dirty[ty0:ty1 + 1, tx0:tx1 + 1].any())
+
+    def __updateLines(self, img, previous: np.ndarray, dirty: np.ndarray, params: CP2SContext) -> np.ndarray:
+        """
+        BRIEF
+        -----
+        Keep the old lines away from the changed tiles and detect the lines
+        in the region around them again.
+        """
+        kept, touched = list(), list()
+        for line in previous:
+            (touched if self.__isDirty(dirty, *line) else kept).append(line)
+
+        t = self.tileSize
+        ty, tx = np.nonzero(dirty)
+        x0, y0, x1, y1 = tx.min() * t, ty.min() * t, (tx.max() + 1) * t, (ty.max() + 1) * t
+        for line in touched:
+            x0, x1 = min(x0, line[0], line[2]), max(x1, line[0], line[2])
+            y0, y1 = min(y0, line[1], line[3]), max(y1, line[1], line[3])
+        margin = params.pointDistanceScaled
+        h, w = img.shape[:2]
+        x0, y0 = max(int(x0) - margin, 0), max(int(y0) - margin, 0)
+        x1, y1 = min(int(x1) + margin, w), min(int(y1) + margin, h)
+
+        found = lines.detectLines(img[y0:y1, x0:x1], True, params)
+        merged = list(kept)
+        for line in np.asarray(found).reshape(-1, 4) + (x0, y0, x0, y0):
+            # Lines away from the changes are already kept, possibly clipped
+            # here by the border of the region.
+            if self.__isDirty(dirty, *line) and not lines.hasSimilairLineInList(kept, line, params):
+                merged.append(line)
+        return np.asarray(merged).reshape(-1, 4)
+
+    def __classify(self, crops: dict, params: CP2SContext, ocr: bool, cancel) -> tuple:
+        labels = list(crops.keys())
+        with tracing.span("incremental.classify", crops=len(labels)):
+            raw = self.model.predictArrays([crops[l] for l in labels], params.imgResize, cancel=cancel)
+            preds = self.model.predsToDict(raw, labels)
+        if not ocr:
+            return preds, None
+        ocrs = dict()
+        with tracing.span("incremental.ocr", crops=len(labels)) as sp:
+            for label in labels:
+                if cancel is not None and cancel.is_set():
+                    raise CancelledError()
+                partOcr = read_part_OCR(crops[label])
+                if partOcr != None:
+                    ocrs[label] = partOcr
+            sp.count("names", len(ocrs))
+        return preds, ocrs
+
+    def __finish(self, HLs, preds: dict, ocrs: dict, params: CP2SContext, dirtyShare: float,
+                 classified: int, reused: int, incremental: bool) -> dict:
+        graph = pipeline.stageGraph(HLs, preds, ocrs, params)
+        asc, cir = pipeline.stageExport(graph)
+        return {"params": params, "lines": HLs, "preds": preds, "ocrs": ocrs, "graph": graph,
+                "asc": asc, "cir": cir, "dirtyShare": dirtyShare, "classified": classified,
+                "reused": reused, "incremental": incremental}
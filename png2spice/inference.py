@@ -4,23 +4,39 @@ integrating its results into the entire process. Application access
 to SPICEnet is managed via a virtual representation as its own 
 class. This class is not part of the standalone SPICEnet project/repo
 and only exists within the context of **png2spice**.
+
+Besides the regular per-snapshot inference, SPICEnet can be run densely
+(`CSPICEnet.predictDense`): its convolutional layers run once over large
+tiles of the normalized image and the classifier head is read out at the
+end points of the lines. `CSPICEnet.compareDense` checks the dense results
+against the per-crop ones. `CSPICEnet.predictRotations` classifies every
+snapshot together with its rotations in one batch to find the orientation
+of a part.
 """
 
+import time
+
+from keras import Input, Model
 from keras.applications.vgg16 import preprocess_input
+from keras.layers import InputLayer
 from keras.models import load_model
 from keras.preprocessing.image import ImageDataGenerator
 import numpy as np
-from parameters import P2SParameters
+import cv2
+from parameters import P2SParameters, CP2SContext, getContext
 from os.path import join
 import os
 import re
 from PIL import Image
 import json
+from concurrent.futures import CancelledError
 from ocrtools import read_part_OCR
+from lines import cropImageAtPos
+import tracing
 
 
 class CSPICEnet:
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, params: CP2SContext=None) -> None:
         """
         BRIEF
         -----
@@ -30,18 +46,24 @@ class CSPICEnet:
         ----------
         `path`:
             `str`. Path to the saved SPICEnet model in `.h5` format.
+        `params`:
+            `png2spice.parameters.CP2SContext`. Default parameters for
+            predictions. Default is a snapshot of the global `P2SParameters`.
 
         """
+        self.path = path
         self.model = load_model(join(path, "SPICEnet.h5"))
-        self.imgResize = int(P2SParameters.imageSliceSize * P2SParameters.scalingFactor * 1.37)
+        self.params = getContext(params)
+        self.imgResize = self.params.imgResize
         self.dataGenerator = ImageDataGenerator(
             rescale=1./255
         )
         with open(join(path, "CLASSLIST.json")) as f:
             self.classlist = json.load(f)["class_list"]
+        self.__dense = None
     
 
-    def __predictRaw(self, path: str) -> np.ndarray:
+    def __predictRaw(self, path: str, imgResize: int, cancel=None, batchSize: int=32) -> np.ndarray:
         """
         BRIEF
         -----
@@ -53,23 +75,384 @@ class CSPICEnet:
             `str`. Path to the folder containing the data.
             Since `keras` is used, the folder above the folder(s)
             containing the data is expected.
+        `imgResize`:
+            `int`. Edge length the snapshots are resized to.
+        `cancel`:
+            `threading.Event`. If given, inference runs batch by batch and
+            raises `concurrent.futures.CancelledError` between batches once
+            the event is set.
+        `batchSize`:
+            `int`. Number of snapshots per forward pass.
 
         RETURNS
         -------
         `np.ndarray`. Always of shape `(nPOIs, nClasses)`.
         """
-        pred = self.model.predict(
-            ImageDataGenerator(
-                preprocessing_function=preprocess_input,
-                ).flow_from_directory(
-                    path,
-                    target_size=(self.imgResize, self.imgResize),
-                    shuffle=False)
-        )
-        return pred
+        generator = ImageDataGenerator(
+            preprocessing_function=preprocess_input,
+            ).flow_from_directory(
+                path,
+                target_size=(imgResize, imgResize),
+                batch_size=batchSize,
+                shuffle=False)
+        if cancel is None:
+            return self.model.predict(generator)
+        preds = list()
+        for i in range(len(generator)):
+            if cancel.is_set():
+                raise CancelledError()
+            preds.append(self.model.predict_on_batch(generator[i][0]))
+        if not preds:
+            return np.zeros((0, len(self.classlist)))
+        return np.concatenate(preds)
     
 
-    def predict(self, path: str, ocr: bool=True, show: bool=False):
+    def inputSize(self, imgResize: int) -> tuple:
+        """
+        BRIEF
+        -----
+        Get the edge lengths crops are resized to. Models with a fixed input
+        shape always get that shape, others get `imgResize`.
+        """
+        shape = self.model.input_shape
+        if shape[1] is not None and shape[2] is not None:
+            return (int(shape[1]), int(shape[2]))
+        return (imgResize, imgResize)
+
+    def prepareCrops(self, crops: list, imgResize: int) -> np.ndarray:
+        """
+        BRIEF
+        -----
+        Turn grayscale crops into a network input batch, the same way
+        `flow_from_directory` does for the snapshot files: resize with
+        nearest neighbour, replicate to RGB and apply `preprocess_input`.
+
+        PARAMETERS
+        ----------
+        `crops`:
+            `list`. Grayscale crops as `np.ndarray`.
+        `imgResize`:
+            `int`. Edge length to resize to, see `inputSize()`.
+
+        RETURNS
+        -------
+        `np.ndarray`. Batch of shape `(n, h, w, 3)`.
+        """
+        h, w = self.inputSize(imgResize)
+        batch = np.empty((len(crops), h, w, 3), np.float32)
+        for i, crop in enumerate(crops):
+            resized = cv2.resize(np.asarray(crop), (w, h), interpolation=cv2.INTER_NEAREST)
+            batch[i] = resized[..., None]
+        return preprocess_input(batch)
+
+    def predictArrays(self, crops: list, imgResize: int=None, batchSize: int=32, cancel=None) -> np.ndarray:
+        """
+        BRIEF
+        -----
+        Get the raw output of the SPICEnet inference for crops held in
+        memory, without any snapshot files.
+
+        PARAMETERS
+        ----------
+        `crops`:
+            `list`. Grayscale crops as `np.ndarray`.
+        `imgResize`:
+            `int`. Edge length to resize to. Default is `imgResize` of the
+            context the object was created with.
+        `batchSize`:
+            `int`. Number of crops per forward pass.
+        `cancel`:
+            `threading.Event`. Raise `concurrent.futures.CancelledError`
+            between batches once it is set.
+
+        RETURNS
+        -------
+        `np.ndarray`. Always of shape `(nCrops, nClasses)`.
+        """
+        imgResize = self.imgResize if imgResize is None else imgResize
+        preds = list()
+        with tracing.span("inference.predictArrays", crops=len(crops)) as sp:
+            for start in range(0, len(crops), batchSize):
+                if cancel is not None and cancel.is_set():
+                    raise CancelledError()
+                batch = self.prepareCrops(crops[start:start + batchSize], imgResize)
+                preds.append(np.asarray(self.model.predict_on_batch(batch)))
+            sp.count("batches", len(preds))
+        if not preds:
+            return np.zeros((0, len(self.classlist)))
+        return np.concatenate(preds)
+
+    def predictRotations(self, crops: list, imgResize: int=None, batchSize: int=32, cancel=None) -> tuple:
+        """
+        BRIEF
+        -----
+        Estimate the orientation of the parts in `crops`. Every crop is
+        classified together with its 90, 180 and 270 degree rotations in the
+        same forward pass, and the most confident variant wins.
+
+        PARAMETERS
+        ----------
+        `crops`:
+            `list`. Square grayscale crops as `np.ndarray`.
+        `imgResize`, `cancel`:
+            See `predictArrays()`.
+        `batchSize`:
+            `int`. Number of crops per forward pass; every pass holds
+            `4 * batchSize` variants.
+
+        RETURNS
+        -------
+        `tuple`. `(preds, rotations)`: the raw output of the winning
+        variants of shape `(nCrops, nClasses)` and their LTSPICE rotation in
+        degrees (0, 90, 180 or 270) per crop.
+
+        NOTES
+        -----
+        Assumes SPICEnet learned the parts in the orientation of LTSPICE's
+        `R0`. A crop which has to be turned counter-clockwise by `k * 90`
+        degrees to look like that shows the part turned clockwise by as
+        much, which LTSPICE calls `R{k * 90}`.
+        For symmetric parts such as resistors, a crop and its 180 degree
+        rotation look alike, so the choice between 0 and 180 (or 90 and
+        270) degrees is arbitrary; only the axis is meaningful.
+        """
+        variants = [np.rot90(np.asarray(crop), k) for crop in crops for k in range(4)]
+        with tracing.span("inference.rotations", crops=len(crops)):
+            raw = self.predictArrays(variants, imgResize, 4 * batchSize, cancel)
+        raw = raw.reshape(len(crops), 4, raw.shape[-1])
+        best = np.argmax(raw.max(axis=2), axis=1)
+        return raw[np.arange(len(crops)), best], [int(k) * 90 for k in best]
+
+    def denseModel(self) -> tuple:
+        """
+        BRIEF
+        -----
+        Split SPICEnet into its convolutional backbone, which accepts inputs
+        of any size, and its classifier head, which takes the feature map of
+        a single crop. The split is made before the first layer whose output
+        is no longer a feature map (`Flatten`, global pooling, `Dense`).
+
+        RETURNS
+        -------
+        `tuple`. `(backbone, head, stride, featureShape)`. `stride` is the
+        number of input pixels per feature map cell, `featureShape` the
+        `(height, width, channels)` of the feature map of one crop.
+
+        NOTES
+        -----
+        The dense read-out assumes a VGG-like backbone: convolutions with
+        `same` padding and pooling, so that the feature map of a crop is a
+        window of the feature map of the whole image. Raises a `ValueError`
+        for models which do not have that shape.
+        """
+        if self.__dense is not None:
+            return self.__dense
+        layers = [l for l in self.model.layers if not isinstance(l, InputLayer)]
+        split = next((i for i, l in enumerate(layers) if len(l.output_shape) != 4), None)
+        if not split:
+            raise ValueError("SPICEnet has no convolutional backbone to run densely")
+        featureShape = tuple(layers[split - 1].output_shape[1:])
+        inH, inW = self.inputSize(self.imgResize)
+        if None in featureShape or inW % featureShape[1] or inH % featureShape[0]:
+            raise ValueError(f"SPICEnet feature map {featureShape} does not tile its input {(inH, inW)}")
+
+        x = backboneInput = Input(shape=(None, None, 3))
+        for layer in layers[:split]:
+            x = layer(x)
+        y = headInput = Input(shape=featureShape)
+        for layer in layers[split:]:
+            y = layer(y)
+        self.__dense = (Model(backboneInput, x), Model(headInput, y), inW // featureShape[1], featureShape)
+        return self.__dense
+
+    def predictDense(self, img, points: list, winSize: int, imgResize: int=None, tileSize: int=1024,
+                     batchSize: int=32, cancel=None) -> np.ndarray:
+        """
+        BRIEF
+        -----
+        Get the raw output of SPICEnet for the snapshots around `points`
+        without cropping them: the backbone runs once per image tile and the
+        head is applied to the feature map window of every point.
+
+        PARAMETERS
+        ----------
+        `img`:
+            `cv2.typing.MatLike`. Normalized grayscale image.
+        `points`:
+            `list`. x/y centers of the snapshots, usually line end points.
+        `winSize`:
+            `int`. Edge length of the snapshots in the image, i.e.
+            `imageSliceSizeScaled`.
+        `imgResize`:
+            `int`. Edge length the snapshots would be resized to, see
+            `inputSize()`. Default is `imgResize` of the context the object
+            was created with.
+        `tileSize`:
+            `int`. Edge length of the tiles in network input pixels. Tiles
+            overlap by one snapshot, so they should be a few times larger
+            than the network input. Larger tiles need more memory.
+        `batchSize`:
+            `int`. Number of feature map windows per pass of the head.
+        `cancel`:
+            `threading.Event`. Raise `concurrent.futures.CancelledError`
+            between tiles once it is set.
+
+        RETURNS
+        -------
+        `np.ndarray`. Always of shape `(len(points), nClasses)`.
+
+        NOTES
+        -----
+        The image is resized as a whole, so the windows are aligned to the
+        feature map cells and the network sees the surroundings of a
+        snapshot instead of zero padding. The results are close to, but not
+        the same as, the ones of `predictArrays()`; see `compareDense()`.
+        """
+        if not len(points):
+            return np.zeros((0, len(self.classlist)))
+        imgResize = self.imgResize if imgResize is None else imgResize
+        backbone, head, stride, (fh, fw, channels) = self.denseModel()
+        inH, inW = self.inputSize(imgResize)
+        sy, sx = inH / winSize, inW / winSize
+        # Tile edge and step in feature map cells; every window fits into the
+        # tile its top left cell falls into.
+        tile = max(tileSize // stride, 2 * max(fh, fw))
+        stepY, stepX = tile - fh, tile - fw
+
+        with tracing.span("inference.dense", points=len(points)) as sp:
+            resized = cv2.resize(np.asarray(img), None, fx=sx, fy=sy, interpolation=cv2.INTER_NEAREST)
+            tiles = dict()
+            for i, (x, y) in enumerate(points):
+                cy = max(int(round((y * sy - inH / 2) / stride)), 0)
+                cx = max(int(round((x * sx - inW / 2) / stride)), 0)
+                tiles.setdefault((cy // stepY, cx // stepX), []).append((i, cy, cx))
+
+            windows = np.empty((len(points), fh, fw, channels), np.float32)
+            for (ty, tx), members in tiles.items():
+                if cancel is not None and cancel.is_set():
+                    raise CancelledError()
+                oy, ox = ty * stepY, tx * stepX
+                region = np.full((tile * stride, tile * stride), 255, np.uint8)
+                part = resized[oy * stride:(oy + tile) * stride, ox * stride:(ox + tile) * stride]
+                region[:part.shape[0], :part.shape[1]] = part
+                batch = preprocess_input(np.repeat(region[None, ..., None], 3, axis=3).astype(np.float32))
+                features = np.asarray(backbone.predict_on_batch(batch))[0]
+                for i, cy, cx in members:
+                    windows[i] = features[cy - oy:cy - oy + fh, cx - ox:cx - ox + fw]
+            sp.count("tiles", len(tiles))
+
+            preds = list()
+            for start in range(0, len(points), batchSize):
+                preds.append(np.asarray(head.predict_on_batch(windows[start:start + batchSize])))
+        return np.concatenate(preds)
+
+    def compareDense(self, img, points: list, winSize: int, imgResize: int=None, **kwargs) -> dict:
+        """
+        BRIEF
+        -----
+        Check the dense inference against the per-crop inference for the
+        same points.
+
+        PARAMETERS
+        ----------
+        `img`, `points`, `winSize`, `imgResize`:
+            See `predictDense()`. Points whose snapshot exceeds the image
+            are left out.
+        `**kwargs`:
+            Passed on to `predictDense()`.
+
+        RETURNS
+        -------
+        `dict`. `points` (compared), `agreement` (share of points with the
+        same most likely class), `maxAbsDiff` and `meanAbsDiff` of the class
+        probabilities, and the seconds of both paths, `cropSeconds` and
+        `denseSeconds`.
+        """
+        crops, kept = list(), list()
+        for x, y in points:
+            crop = cropImageAtPos(img, int(x), int(y), winSize)
+            if crop is not None:
+                crops.append(crop)
+                kept.append((int(x), int(y)))
+        t = time.perf_counter()
+        reference = self.predictArrays(crops, imgResize)
+        cropSeconds = time.perf_counter() - t
+        t = time.perf_counter()
+        dense = self.predictDense(img, kept, winSize, imgResize, **kwargs)
+        denseSeconds = time.perf_counter() - t
+        if not kept:
+            return {"points": 0, "agreement": 1.0, "maxAbsDiff": 0.0, "meanAbsDiff": 0.0,
+                    "cropSeconds": cropSeconds, "denseSeconds": denseSeconds}
+        diff = np.abs(reference - dense)
+        return {
+            "points": len(kept),
+            "agreement": float(np.mean(reference.argmax(axis=1) == dense.argmax(axis=1))),
+            "maxAbsDiff": float(diff.max()),
+            "meanAbsDiff": float(diff.mean()),
+            "cropSeconds": cropSeconds,
+            "denseSeconds": denseSeconds,
+        }
+
+    def predictStore(self, store, ocr: bool=True, params: CP2SContext=None, cancel=None,
+                     batchSize: int=32, source: str=None):
+        """
+        BRIEF
+        -----
+        Get the predictions from the inference of SPICEnet for the crops of
+        a crop archive, read without copying from the mapped file.
+
+        PARAMETERS
+        ----------
+        `store`:
+            `png2spice.cropstore.CCropStore`. Open archive.
+        `source`:
+            `str`. Only classify the crops taken from this image. Default
+            is all crops; their labels have to be unique then.
+        `ocr`, `params`, `cancel`, `batchSize`:
+            See `predict()`.
+
+        RETURNS
+        -------
+        Same as `predict()`.
+        """
+        imgResize = self.imgResize if params is None else params.imgResize
+        selected = store.select(source)
+        labels = [store.index[i]["label"] for i in selected]
+        crops = [store.crop(i) for i in selected]
+        with tracing.span("inference.classify") as sp:
+            preds = self.predictArrays(crops, imgResize, batchSize, cancel)
+            sp.count("crops", len(preds))
+        predDict = self.predsToDict(preds, labels)
+        if not ocr:
+            return predDict
+        OCRNameResults = dict()
+        with tracing.span("inference.ocr", crops=len(crops)) as sp:
+            for label, crop in zip(labels, crops):
+                if cancel is not None and cancel.is_set():
+                    raise CancelledError()
+                partOcr = read_part_OCR(crop)
+                if partOcr != None:
+                    OCRNameResults[label] = partOcr
+            sp.count("names", len(OCRNameResults))
+        return predDict, OCRNameResults
+
+    def predsToDict(self, preds: np.ndarray, labels: list) -> dict:
+        """
+        BRIEF
+        -----
+        Convert raw predictions into the dict of dicts returned by
+        `predict()`.
+        """
+        predDict = dict()
+        for pred, label in zip(preds, labels):
+            classDict = dict()
+            for classVal, className in zip(pred, self.classlist):
+                classDict[className] = classVal
+            predDict[label] = classDict
+        return predDict
+
+    def predict(self, path: str, ocr: bool=True, show: bool=False, params: CP2SContext=None, cancel=None,
+                batchSize: int=32):
         """
         BRIEF
         -----
@@ -88,6 +471,17 @@ class CSPICEnet:
             `bool`. Show a plot listing all detected POIs and their
             classifications. The used plotting backend has to be configured 
             outside this function.
+        `params`:
+            `png2spice.parameters.CP2SContext`. Parameters of the run the
+            snapshots belong to. Default is the context the object was
+            created with.
+        `cancel`:
+            `threading.Event`. Stop between inference batches and between
+            OCR snapshots once the event is set by raising
+            `concurrent.futures.CancelledError`. Default is `None`.
+        `batchSize`:
+            `int`. Number of snapshots per forward pass. Smaller batches
+            need less memory. Default is 32.
         
         RETURNS
         -------
@@ -96,31 +490,32 @@ class CSPICEnet:
         probability per class. If `ocr` is set to `True`, a dict (2) of the OCR results
         is returned as well. Both dicts have the same keys.
         """
-        preds = self.__predictRaw(path)
+        imgResize = self.imgResize if params is None else params.imgResize
+        with tracing.span("inference.classify") as sp:
+            preds = self.__predictRaw(path, imgResize, cancel, batchSize)
+            sp.count("crops", len(preds))
         imageDisplayGenerator = self.dataGenerator.flow_from_directory(
             path,
-            target_size=(self.imgResize, self.imgResize),
+            target_size=(imgResize, imgResize),
             shuffle=False,
             batch_size=100)
         fileLabels =  [os.path.basename(s).replace('.png', '') for s in imageDisplayGenerator.filenames]
 
         if ocr:
             OCRNameResults = dict()
-            for file, label in zip(imageDisplayGenerator.filenames, fileLabels):
-                partOcr = read_part_OCR(join(path, file))
-                if partOcr != None:
-                    OCRNameResults[f"{label}"] = partOcr
+            with tracing.span("inference.ocr", crops=len(fileLabels)) as sp:
+                for file, label in zip(imageDisplayGenerator.filenames, fileLabels):
+                    if cancel is not None and cancel.is_set():
+                        raise CancelledError()
+                    partOcr = read_part_OCR(join(path, file))
+                    if partOcr != None:
+                        OCRNameResults[f"{label}"] = partOcr
+                sp.count("names", len(OCRNameResults))
 
-        batch_images = imageDisplayGenerator.next()[0]
-
-        predDict = dict()
-        for pred, label in zip(preds, fileLabels):
-            classDict = dict()
-            for classVal, className in zip(pred, self.classlist):
-                classDict[className] = classVal
-            predDict[label] = classDict
+        predDict = self.predsToDict(preds, fileLabels)
 
         if show:
+            batch_images = imageDisplayGenerator.next()[0]
             rowColSplit = int(np.sqrt(int(imageDisplayGenerator.n)))
             fig, axs = plt.subplots(nrows=rowColSplit, ncols=rowColSplit, figsize=(40, 20))
             ind = 0
@@ -5,7 +5,10 @@ the obtained lines also yield the positions of the components, which are saved
 to a temporary folder for later classification by SPICEnet.
 """
 
-from parameters import P2SParameters
+from parameters import CP2SContext, getContext
+from POI import proposalLabel
+from spatial import CSpatialIndex
+import tracing
 import cv2
 import numpy as np
 import math
@@ -32,7 +35,7 @@ def imageDataFromPath(path: str):
     return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
 
 
-def normalizeImageData(img):
+def normalizeImageData(img, params: CP2SContext=None):
     """
     BRIEF
     -----
@@ -42,6 +45,9 @@ def normalizeImageData(img):
     ----------
     `img`:
         `cv2.typing.MatLike`. Image data matrix to be normalized.
+    `params`:
+        `png2spice.parameters.CP2SContext`. Parameters of this run. Default
+        is a snapshot of the global `P2SParameters`.
 
     RETURNS
     -------
@@ -52,23 +58,25 @@ def normalizeImageData(img):
     Contains **P2S parameters** `imagePadding` and `contrastThreshold`.
     See `png2spice.parameters`. 
     """
-    _, img = cv2.threshold(img, 
-                           P2SParameters.contrastThreshold, 
-                           255, 
-                           cv2.THRESH_BINARY)
-    
-    pad = int(P2SParameters.imagePadding * P2SParameters.scalingFactor)
-    img = cv2.copyMakeBorder(img, 
-                            pad,
-                            pad,
-                            pad,
-                            pad,
-                            cv2.BORDER_CONSTANT,
-                            value=255)
+    params = getContext(params)
+    with tracing.span("lines.normalize"):
+        _, img = cv2.threshold(img, 
+                               params.contrastThreshold, 
+                               255, 
+                               cv2.THRESH_BINARY)
+        
+        pad = params.imagePaddingScaled
+        img = cv2.copyMakeBorder(img, 
+                                pad,
+                                pad,
+                                pad,
+                                pad,
+                                cv2.BORDER_CONSTANT,
+                                value=255)
     return img
 
 
-def getHoughLines(img, rmDuplicates: bool=True, show: bool=False, spath: str=P2SParameters.partSnapshotDir) -> np.ndarray:
+def getHoughLines(img, rmDuplicates: bool=True, show: bool=False, spath: str=None, params: CP2SContext=None) -> np.ndarray:
     """
     BRIEF
     -----
@@ -86,7 +94,10 @@ def getHoughLines(img, rmDuplicates: bool=True, show: bool=False, spath: str=P2S
         backend has to be configured outside this function.
     `spath`:
         `str`. Path to save the screenshots of POIs derived from the Hough
-        lines.
+        lines. Default is `partSnapshotDir` of `params`.
+    `params`:
+        `png2spice.parameters.CP2SContext`. Parameters of this run. Default
+        is a snapshot of the global `P2SParameters`.
 
     RETURNS
     -------
@@ -96,35 +107,26 @@ def getHoughLines(img, rmDuplicates: bool=True, show: bool=False, spath: str=P2S
     NOTES
     -----
     Contains **P2S parameters** `cannyThreshold`, `HLThreshold`,
-    `HLMinLineLength`, `HLmaxLineGap`, `HoughIterations` and `imageSliceSize`.
-    See `png2spice.parameters`. 
+    `HLMinLineLength`, `HLmaxLineGap`, `HoughIterations`, `imageSliceSize`
+    and `EndpointClusterRadius`. See `png2spice.parameters`. Only one
+    snapshot is saved per cluster of end points, see `clusterEndpoints()`.
     """
-    cannyThresh = P2SParameters.cannyThreshold
-    HLThresh = int(P2SParameters.HLThreshold * P2SParameters.scalingFactor)
-    HLMinLineLen = int(P2SParameters.HLMinLineLength * P2SParameters.scalingFactor)
-    HLmaxLineGap = P2SParameters.HLmaxLineGap
-    HLIterations = P2SParameters.HoughIterations
-    imgSliceSize = int(P2SParameters.imageSliceSize * P2SParameters.scalingFactor)
-    HoughThresholdWiggle = P2SParameters.HoughThresholdWiggle
+    params = getContext(params)
+    if spath is None:
+        spath = params.partSnapshotDir
+    imgSliceSize = params.imageSliceSizeScaled
 
-    linesImage = np.zeros((img.shape+(tuple([3]))), np.uint8)
-    edges = cv2.Canny(img, cannyThresh, cannyThresh, None, 5)
-    lines = cv2.HoughLinesP(edges, rho = 1, theta = math.pi/2, threshold = HLThresh, minLineLength = HLMinLineLen , maxLineGap = HLmaxLineGap).squeeze()
-    for i in range(HLIterations-1):
-        lines = np.append(lines,cv2.HoughLinesP(edges, rho = 1, theta = math.pi/2, threshold = HLThresh + ((i+1) * HoughThresholdWiggle), minLineLength = HLMinLineLen , maxLineGap = HLmaxLineGap).squeeze(),axis=0)
-
-    if rmDuplicates:
-        lines = pruneLines(lines)
+    lines = detectLines(img, rmDuplicates, params)
 
     if show:
         linesImage = np.zeros((img.shape + (tuple([3]))), np.uint8)
     
-    for count, line in enumerate(lines):
-        pt1 = (line[0],line[1])
-        pt2 = (line[2],line[3])
-        saveImageFromPos(img.copy(), pt1[0],pt1[1], imgSliceSize, str(count) + 'A', spath)
-        saveImageFromPos(img.copy(), pt2[0],pt2[1], imgSliceSize, str(count) + 'B', spath)
-        if show:
+    saveLineCrops(img, lines, imgSliceSize, spath, clusterEndpoints(img, lines, params))
+
+    if show:
+        for line in lines:
+            pt1 = (line[0],line[1])
+            pt2 = (line[2],line[3])
             cv2.line(linesImage, pt1, pt2, (0,0,255), 4)
             cv2.circle(linesImage, pt1, 2, (255,0,0), 3)
             cv2.circle(linesImage, pt2, 2, (0,255,0), 3)
@@ -145,6 +147,354 @@ def getHoughLines(img, rmDuplicates: bool=True, show: bool=False, spath: str=P2S
 
 
 
+def detectLines(img, rmDuplicates: bool=True, params: CP2SContext=None) -> np.ndarray:
+    """
+    BRIEF
+    -----
+    Detect the Hough-lines of an image data matrix without saving any POI
+    snapshots, see `getHoughLines()`.
+
+    PARAMETERS
+    ----------
+    `img`:
+        `cv2.typing.MatLike`. Image data matrix to be analyzed.
+    `rmDuplicates`:
+        `bool`. Remove lines which are too similar to each other.
+    `params`:
+        `png2spice.parameters.CP2SContext`. Parameters of this run. Default
+        is a snapshot of the global `P2SParameters`.
+
+    RETURNS
+    -------
+    `np.ndarray`. Detected Hough-lines of shape `(n_lines, 4)`.
+    """
+    params = getContext(params)
+    cannyThresh = params.cannyThreshold
+    HLThresh = params.HLThresholdScaled
+    HLMinLineLen = params.HLMinLineLengthScaled
+    HLmaxLineGap = params.HLmaxLineGap
+    HLIterations = params.HoughIterations
+    HoughThresholdWiggle = params.HoughThresholdWiggle
+
+    with tracing.span("lines.canny"):
+        edges = cv2.Canny(img, cannyThresh, cannyThresh, None, 5)
+    with tracing.span("lines.hough", iterations=HLIterations) as sp:
+        lines = houghLines(edges, HLThresh, HLMinLineLen, HLmaxLineGap)
+        for i in range(HLIterations-1):
+            lines = np.append(lines,houghLines(edges, HLThresh + ((i+1) * HoughThresholdWiggle), HLMinLineLen, HLmaxLineGap),axis=0)
+        sp.count("linesFound", len(lines))
+
+    if rmDuplicates:
+        with tracing.span("lines.prune") as sp:
+            lines = pruneLines(lines, params)
+            sp.count("linesPruned", len(lines))
+    return lines
+
+
+def houghLines(edges, threshold: int, minLineLength: int, maxLineGap: int) -> np.ndarray:
+    """
+    BRIEF
+    -----
+    Run one horizontal/vertical probabilistic Hough transform.
+
+    RETURNS
+    -------
+    `np.ndarray`. Lines of shape `(n_lines, 4)`, also if none or only one
+    line was found.
+    """
+    lines = cv2.HoughLinesP(edges, rho = 1, theta = math.pi/2, threshold = threshold, minLineLength = minLineLength, maxLineGap = maxLineGap)
+    if lines is None:
+        return np.zeros((0, 4), np.int32)
+    return lines.reshape(-1, 4)
+
+
+def cropImageAtPos(img, x: int, y: int, winSize: int):
+    """
+    BRIEF
+    -----
+    Get the square box around a specified point on an image as a view
+    into the image data, without copying.
+
+    PARAMETERS
+    ----------
+    `img`:
+        `cv2.typing.MatLike`. Image data matrix.
+    `x`:
+        `int`. Center point x-coordinate of box.
+    `y`:
+        `int`. Center point y-coordinate of box.
+    `winSize`:
+        `int`. Size of square box in pixels.
+
+    RETURNS
+    -------
+    `cv2.typing.MatLike`. The box, or `None` if it exceeds the image.
+    """
+    yMax, xMax = img.shape
+    if(x+int(winSize/2) > xMax or y+int(winSize/2) > yMax or x-int(winSize/2) < 0 or y-int(winSize/2) < 0):
+        return None
+    return img[y-int(winSize/2):y+int(winSize/2), x-int(winSize/2):x+int(winSize/2)]
+
+
+POI_PROPOSAL_MODES = ("endpoints", "both")
+
+
+class CEndpointClusters(dict):
+    def __init__(self) -> None:
+        """
+        BRIEF
+        -----
+        Result of `clusterEndpoints()`: label of every end point (`{i}A`/`{i}B`)
+        to the label of the snapshot representing it. `centers` holds the
+        crop center `(x, y)` of every representative in the order they were
+        found; a representative is either an end point itself or a symbol
+        proposal (see `png2spice.POI.proposalLabel` and
+        `proposeComponents()`). Symbol proposals without any end point map
+        to themselves, so that they become POIs of their own.
+        """
+        super().__init__()
+        self.centers = dict()
+
+
+def proposeComponents(img, params: CP2SContext=None) -> np.ndarray:
+    """
+    BRIEF
+    -----
+    Locate the symbol blobs of a schematic directly: long horizontal and
+    vertical wires are removed by morphological opening, the remaining
+    strokes of a symbol are closed into one blob and the blobs are found as
+    connected components.
+
+    PARAMETERS
+    ----------
+    `img`:
+        `cv2.typing.MatLike`. Normalized image data matrix.
+    `params`:
+        `png2spice.parameters.CP2SContext`. Parameters of this run. Default
+        is a snapshot of the global `P2SParameters`.
+
+    RETURNS
+    -------
+    `np.ndarray`. Proposals of shape `(n_proposals, 4)`: center x/y, width
+    and height of the bounding box of every blob.
+
+    NOTES
+    -----
+    Contains **P2S parameters** `SymbolWireLength`, `SymbolMergeDistance`,
+    `SymbolMinSize` and `imageSliceSize`. See `png2spice.parameters`. Strokes
+    at least `SymbolWireLength` long count as wires, so it has to be longer
+    than the straight edges of any symbol. Blobs larger than a snapshot are
+    dropped; part names next to a symbol may show up as blobs of their own,
+    which SPICEnet then rejects.
+    """
+    params = getContext(params)
+    wireLength = max(params.SymbolWireLengthScaled, 3)
+    merge = max(params.SymbolMergeDistanceScaled, 1)
+    minSize = params.SymbolMinSizeScaled
+    maxSize = params.imageSliceSizeScaled
+    with tracing.span("lines.components") as sp:
+        _, ink = cv2.threshold(img, 127, 255, cv2.THRESH_BINARY_INV)
+        horizontal = cv2.morphologyEx(ink, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (wireLength, 1)))
+        vertical = cv2.morphologyEx(ink, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (1, wireLength)))
+        wires = cv2.dilate(cv2.bitwise_or(horizontal, vertical), np.ones((3, 3), np.uint8))
+        symbols = cv2.bitwise_and(ink, cv2.bitwise_not(wires))
+        symbols = cv2.morphologyEx(symbols, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (merge, merge)))
+        n, _, stats, _ = cv2.connectedComponentsWithStats(symbols, connectivity=8)
+        proposals = list()
+        for x, y, w, h, _ in stats[1:n]:
+            if minSize <= max(w, h) <= maxSize:
+                proposals.append((x + w // 2, y + h // 2, w, h))
+        sp.count("blobs", n - 1)
+        sp.count("proposals", len(proposals))
+    return np.asarray(proposals, np.int32).reshape(-1, 4)
+
+
+def clusterEndpoints(img, lines: np.ndarray, params: CP2SContext=None) -> CEndpointClusters:
+    """
+    BRIEF
+    -----
+    Decide which snapshots are cropped, classified and read by OCR, and
+    which end points share them. End points sharing a position, e.g. at a
+    corner or where wires meet at a terminal, are grouped so that every
+    group is handled only once. With `POIProposals` `"both"`, every symbol
+    found by `proposeComponents()` gets a snapshot centered on it as well,
+    which the end points at the symbol share.
+
+    PARAMETERS
+    ----------
+    `img`:
+        `cv2.typing.MatLike`. Normalized image data matrix.
+    `lines`:
+        `np.ndarray`. Lines of shape `(n_lines, 4)`.
+    `params`:
+        `png2spice.parameters.CP2SContext`. Parameters of this run. Default
+        is a snapshot of the global `P2SParameters`.
+
+    RETURNS
+    -------
+    `CEndpointClusters`. Label of every end point (`{i}A`/`{i}B`) to the
+    label of its representative. End point representatives and symbol
+    proposals without end points map to themselves. End points and symbols
+    too close to the border are left out, as they have no snapshot.
+
+    NOTES
+    -----
+    Contains **P2S parameters** `POIProposals`, `EndpointClusterRadius`,
+    `pointDistance` and `imageSliceSize`, plus those of
+    `proposeComponents()` unless `POIProposals` is `"endpoints"`. See
+    `png2spice.parameters`. The modes are:
+
+    - `"endpoints"`: only end points are grouped.
+    - `"both"`: end points within `pointDistance` of a symbol blob share
+      the snapshot of the blob, the remaining end points (wire corners,
+      junctions, ground) are grouped as with `"endpoints"`. Blobs without
+      any end point, e.g. symbols whose leads Hough missed, still get their
+      snapshot.
+
+    The end points are visited in label order; each one joins the closest
+    representative within the radius or becomes a representative itself,
+    so the clusters do not chain along a wire. A radius of 0 disables the
+    grouping of end points.
+    """
+    params = getContext(params)
+    mode = params.POIProposals
+    if mode not in POI_PROPOSAL_MODES:
+        raise ValueError(f"Invalid POI proposal mode '{mode}', expected one of {', '.join(POI_PROPOSAL_MODES)}")
+    radius = params.EndpointClusterRadiusScaled
+    winSize = params.imageSliceSizeScaled
+    margin = params.pointDistanceScaled
+    clusters = CEndpointClusters()
+
+    blobs = CSpatialIndex(max(winSize, 1))
+    boxes = dict()
+    if mode != "endpoints":
+        for cx, cy, w, h in proposeComponents(img, params):
+            if cropImageAtPos(img, int(cx), int(cy), winSize) is None:
+                continue
+            label = proposalLabel(cx, cy)
+            boxes[label] = (int(cx), int(cy), int(w) // 2 + margin, int(h) // 2 + margin)
+            blobs.insert(label, (int(cx), int(cy)))
+
+    index = CSpatialIndex(radius)
+    with tracing.span("lines.cluster") as sp:
+        for count, line in enumerate(lines):
+            for label, (x, y) in ((f"{count}A", line[0:2]), (f"{count}B", line[2:4])):
+                pos = (int(x), int(y))
+                near = [b for b in blobs.query(pos, winSize)
+                        if abs(pos[0] - boxes[b][0]) <= boxes[b][2] and abs(pos[1] - boxes[b][1]) <= boxes[b][3]]
+                if near:
+                    rep = min(near, key=lambda b: math.dist(pos, boxes[b][:2]))
+                    clusters[label] = rep
+                    clusters.centers.setdefault(rep, boxes[rep][:2])
+                    continue
+                if cropImageAtPos(img, pos[0], pos[1], winSize) is None:
+                    continue
+                near = index.query(pos, radius) if radius > 0 else []
+                if near:
+                    clusters[label] = min(near, key=lambda r: math.dist(pos, index.positions[r]))
+                else:
+                    clusters[label] = label
+                    clusters.centers[label] = pos
+                    index.insert(label, pos)
+        sp.count("endpoints", len(clusters))
+        for label, box in boxes.items():
+            if label not in clusters.centers:
+                clusters[label] = label
+                clusters.centers[label] = box[:2]
+        sp.count("clusters", len(clusters.centers))
+        sp.count("symbols", len(boxes))
+    return clusters
+
+
+def cropCenters(lines: np.ndarray, clusters: CEndpointClusters=None):
+    """
+    BRIEF
+    -----
+    Iterate over the snapshots to take: both end points of every line, or
+    only the representatives of `clusters` (see `clusterEndpoints()`).
+
+    RETURNS
+    -------
+    Generator of `tuple`. `(label, x, y)` of every snapshot center.
+    """
+    if clusters is not None:
+        for label, (x, y) in clusters.centers.items():
+            yield label, int(x), int(y)
+        return
+    for count, line in enumerate(lines):
+        yield f"{count}A", int(line[0]), int(line[1])
+        yield f"{count}B", int(line[2]), int(line[3])
+
+
+def expandClusters(results: dict, clusters: dict) -> dict:
+    """
+    BRIEF
+    -----
+    Hand the results of the cluster representatives (predictions or OCR
+    readings) to every end point of their cluster, see `clusterEndpoints()`.
+
+    RETURNS
+    -------
+    `dict`. Label of every end point (and symbol proposal of its own)
+    whose representative has a result to that result. `None` if `results`
+    is `None`.
+    """
+    if results is None:
+        return None
+    return {label: results[rep] for label, rep in clusters.items() if rep in results}
+
+
+def extractLineCrops(img, lines: np.ndarray, winSize: int, clusters: CEndpointClusters=None) -> dict:
+    """
+    BRIEF
+    -----
+    Get the POI snapshots around both end points of every line in memory,
+    named like the files of `saveLineCrops()`.
+
+    RETURNS
+    -------
+    `dict`. Label (`{i}A`/`{i}B`) to crop. End points too close to the
+    border are left out, as in `saveLineCrops()`. With `clusters` (see
+    `clusterEndpoints()`), only the representatives are cropped.
+    """
+    crops = dict()
+    with tracing.span("lines.crops") as sp:
+        for label, x, y in cropCenters(lines, clusters):
+            crop = cropImageAtPos(img, x, y, winSize)
+            if crop is not None:
+                crops[label] = crop
+        sp.count("crops", len(crops))
+    return crops
+
+
+def saveLineCrops(img, lines: np.ndarray, winSize: int, spath: str, clusters: CEndpointClusters=None):
+    """
+    BRIEF
+    -----
+    Save the POI snapshots around both end points of every line. The
+    snapshots are named `{i}A` and `{i}B` after the line index `i`.
+
+    PARAMETERS
+    ----------
+    `img`:
+        `cv2.typing.MatLike`. Normalized image data matrix.
+    `lines`:
+        `np.ndarray`. Lines of shape `(n_lines, 4)`.
+    `winSize`:
+        `int`. Size of the square snapshots in pixels.
+    `spath`:
+        `str`. Path to save location.
+    `clusters`:
+        `CEndpointClusters`. End point clusters, see `clusterEndpoints()`.
+        If given, only the snapshots of the representatives are saved; the
+        results for them are handed to the other end points by
+        `expandClusters()`.
+    """
+    with tracing.span("lines.saveCrops", lines=len(lines)):
+        for label, x, y in cropCenters(lines, clusters):
+            saveImageFromPos(img, x, y, winSize, label, spath)
+
+
 def saveImageFromPos(img, x: int, y: int, winSize: int, name: str, spath: str):
     """
     BRIEF
@@ -166,23 +516,20 @@ def saveImageFromPos(img, x: int, y: int, winSize: int, name: str, spath: str):
     `spath`:
         `str`. Path to save location.
     """
-    
-    cv2.imwrite("fnawdawame.png", img)
     if not os.path.exists(spath):
         try:
             os.makedirs(spath)
         except OSError as e:
             print(f"Error creating subdirectory {spath}: {e}")
 
-    yMax, xMax = img.shape
-    if(x+int(winSize/2) > xMax or y+int(winSize/2) > yMax or x-int(winSize/2) < 0 or y-int(winSize/2) < 0):
+    img = cropImageAtPos(img, x, y, winSize)
+    if img is None:
         return
-    img = img[y-int(winSize/2):y+int(winSize/2), x-int(winSize/2):x+int(winSize/2)]
     fname = join(spath, str(name) + ".png")
     cv2.imwrite(fname, img)
 
 
-def hasSimilairLineInList(lineList: list, line: np.ndarray):
+def hasSimilairLineInList(lineList: list, line: np.ndarray, params: CP2SContext=None):
     """
     BRIEF
     -----
@@ -196,6 +543,9 @@ def hasSimilairLineInList(lineList: list, line: np.ndarray):
     `line`:
         `np.ndarray`. Line as represented in start- and end-point coordinates.
         `(x1, y1, x2, y2)`.
+    `params`:
+        `png2spice.parameters.CP2SContext`. Parameters of this run. Default
+        is a snapshot of the global `P2SParameters`.
 
     RETURNS
     -------
@@ -206,7 +556,7 @@ def hasSimilairLineInList(lineList: list, line: np.ndarray):
     Contains **P2S parameters** `pointDistance`.
     See `png2spice.parameters`. 
     """
-    dist = int(P2SParameters.pointDistance * P2SParameters.scalingFactor)
+    dist = getContext(params).pointDistanceScaled
     for l in lineList:
         pt1 = (l[0],l[1])
         pt2 = (l[2],l[3])
@@ -217,7 +567,7 @@ def hasSimilairLineInList(lineList: list, line: np.ndarray):
     return False
 
 
-def pruneLines(lines: np.ndarray) -> np.ndarray:
+def pruneLines(lines: np.ndarray, params: CP2SContext=None) -> np.ndarray:
     """
     BRIEF
     -----
@@ -227,15 +577,21 @@ def pruneLines(lines: np.ndarray) -> np.ndarray:
     ----------
     `lines`:
         `np.ndarray`. List of lines containing duplicates.
+    `params`:
+        `png2spice.parameters.CP2SContext`. Parameters of this run. Default
+        is a snapshot of the global `P2SParameters`.
     
     RETURNS
     -------
     `np.ndarray`. Modified input array without duplicates.
     """
+    params = getContext(params)
+    if len(lines) < 2:
+        return np.asarray(lines)
     prunedLinesList = []
     prunedLinesList.append(lines[1].tolist())
     for line in lines:
-        if(not hasSimilairLineInList(prunedLinesList,line)):
+        if(not hasSimilairLineInList(prunedLinesList,line,params)):
             prunedLinesList.append(line.tolist())
     return np.asarray(prunedLinesList)
 
@@ -0,0 +1,313 @@
+"""
+This submodule of **png2spice** accounts for the memory used by the analysis
+stages and keeps a run within a memory budget.
+
+Two kinds of memory are measured per stage: allocations made by Python
+(via `tracemalloc`, only if it is running, see `png2spice.tracing`) and the
+resident set size (RSS) of the process, which also covers the native buffers
+of `cv2`, `numpy` and `tensorflow`. With a budget (`CMemoryBudget`), the
+pipeline estimates the memory of the image stages and of the inference
+batches beforehand, downscales the image or shrinks the batches to fit, and
+raises `MemoryBudgetExceeded` if even the smallest configuration does not.
+"""
+
+import math
+import os
+import re
+import threading
+import tracemalloc
+from typing import Optional
+
+from parameters import CP2SContext
+
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+class MemoryBudgetExceeded(MemoryError):
+    def __init__(self, stage: str, required: int, available: int) -> None:
+        """
+        BRIEF
+        -----
+        Raised when a stage cannot be run within the memory budget.
+
+        PARAMETERS
+        ----------
+        `stage`:
+            `str`. Stage that would exceed the budget.
+        `required`:
+            `int`. Estimated or measured bytes the stage needs.
+        `available`:
+            `int`. Bytes left in the budget.
+        """
+        super().__init__(f"Stage '{stage}' needs about {formatSize(required)}, "
+                         f"but only {formatSize(max(available, 0))} of the memory budget are left")
+        self.stage = stage
+        self.required = required
+        self.available = available
+
+
+def parseSize(text: str) -> int:
+    """
+    BRIEF
+    -----
+    Parse a size like `512M`, `2G` or `1.5GiB` into bytes.
+    """
+    m = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)(i?B)?\s*", str(text), re.IGNORECASE)
+    if m is None:
+        raise ValueError(f"Invalid size '{text}'")
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2).upper()])
+
+
+def formatSize(n: int) -> str:
+    for unit in ("T", "G", "M", "K"):
+        if abs(n) >= SIZE_UNITS[unit]:
+            return f"{n / SIZE_UNITS[unit]:.1f} {unit}iB"
+    return f"{n} B"
+
+
+def rss() -> Optional[int]:
+    """
+    BRIEF
+    -----
+    Get the resident set size of this process in bytes.
+
+    RETURNS
+    -------
+    `int`, or `None` if it cannot be determined on this platform.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+
+class CRSSSampler:
+    def __init__(self, interval: float=0.01) -> None:
+        """
+        BRIEF
+        -----
+        Sample the RSS on a background thread to catch short peaks of native
+        buffers, which a single reading before and after a stage misses. Use
+        it as a context manager.
+
+        PARAMETERS
+        ----------
+        `interval`:
+            `float`. Seconds between two samples.
+        """
+        self.interval = interval
+        self.peak = None
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __sample(self):
+        value = rss()
+        if value is not None and (self.peak is None or value > self.peak):
+            self.peak = value
+
+    def __loop(self):
+        while not self.__stop.wait(self.interval):
+            self.__sample()
+
+    def __enter__(self):
+        self.__sample()
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__loop, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.__stop.set()
+        self.__thread.join()
+        self.__sample()
+        return False
+
+
+class CStageMemory:
+    def __init__(self, sample: bool=False) -> None:
+        """
+        BRIEF
+        -----
+        Measure the memory of one stage. Use it as a context manager, the
+        results are available afterwards via `asDict()`.
+
+        PARAMETERS
+        ----------
+        `sample`:
+            `bool`. Sample the RSS during the stage to get its peak, see
+            `CRSSSampler`. Otherwise only the RSS before and after is read.
+        """
+        self.sample = sample
+        self.rssBefore = None
+        self.rssAfter = None
+        self.rssPeak = None
+        self.pythonPeak = None
+        self.__sampler = None
+        self.__pythonBase = 0
+
+    def __enter__(self):
+        if tracemalloc.is_tracing():
+            self.__pythonBase = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.rssBefore = rss()
+        if self.sample:
+            self.__sampler = CRSSSampler().__enter__()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if self.__sampler is not None:
+            self.__sampler.__exit__(excType, exc, tb)
+            self.rssPeak = self.__sampler.peak
+        self.rssAfter = rss()
+        if self.rssPeak is None and self.rssAfter is not None:
+            self.rssPeak = max(self.rssBefore or 0, self.rssAfter)
+        if tracemalloc.is_tracing():
+            self.pythonPeak = tracemalloc.get_traced_memory()[1] - self.__pythonBase
+        return False
+
+    def asDict(self) -> dict:
+        """
+        RETURNS
+        -------
+        `dict`. `rss` (bytes the RSS grew by), `rssPeak` (highest RSS above
+        the RSS at the start) and `python` (peak of Python allocations
+        above the start, `None` without `tracemalloc`).
+        """
+        known = self.rssBefore is not None and self.rssAfter is not None
+        return {
+            "rss": self.rssAfter - self.rssBefore if known else None,
+            "rssPeak": self.rssPeak - self.rssBefore if known else None,
+            "python": self.pythonPeak,
+        }
+
+
+class CMemoryBudget:
+    def __init__(self, limit: int, minScale: float=0.25, activationFactor: float=8.0) -> None:
+        """
+        BRIEF
+        -----
+        Memory budget of a single run. The budget covers the memory the run
+        adds on top of the RSS at `start()`, so an already loaded SPICEnet
+        does not count against it.
+
+        PARAMETERS
+        ----------
+        `limit`:
+            `int`. Budget in bytes, see `parseSize()`.
+        `minScale`:
+            `float`. Smallest factor the image may be downscaled by before
+            `MemoryBudgetExceeded` is raised. Below about 0.25 the symbols
+            get too small for SPICEnet.
+        `activationFactor`:
+            `float`. Memory of the network activations per crop, as a
+            multiple of the size of the input crop.
+        """
+        self.limit = int(limit)
+        self.minScale = minScale
+        self.activationFactor = activationFactor
+        self.base = None
+
+    def start(self):
+        """
+        BRIEF
+        -----
+        Take the current RSS as the zero point of the budget.
+        """
+        self.base = rss()
+
+    def used(self) -> int:
+        current = rss()
+        if current is None or self.base is None:
+            return 0
+        return max(current - self.base, 0)
+
+    def available(self) -> int:
+        return self.limit - self.used()
+
+    def check(self, stage: str):
+        """
+        BRIEF
+        -----
+        Raise `MemoryBudgetExceeded` if the budget is already used up before
+        `stage` starts.
+        """
+        available = self.available()
+        if available <= 0:
+            raise MemoryBudgetExceeded(stage, self.used(), available)
+
+    @staticmethod
+    def estimateImage(shape: tuple, params: CP2SContext, scale: float=1.0) -> int:
+        """
+        BRIEF
+        -----
+        Estimate the peak bytes of the image stages (decoding, resizing,
+        thresholding, padding and edge detection) for an image of `shape`.
+
+        PARAMETERS
+        ----------
+        `shape`:
+            `tuple`. `(height, width)` of the original image.
+        `params`:
+            `png2spice.parameters.CP2SContext`. Parameters with the final
+            `scalingFactor` at scale 1.
+        `scale`:
+            `float`. Factor the image is downscaled by after decoding.
+        """
+        h, w = shape[:2]
+        pad = int(params.imagePadding * params.scalingFactor * scale)
+        sh, sw = int(h * scale), int(w * scale)
+        padded = (sh + 2 * pad) * (sw + 2 * pad)
+        # Grayscale decode, resized copy, thresholded copy, padded image and edges
+        return h * w + sh * sw * 2 + padded * 2
+
+    def imageScale(self, shape: tuple, params: CP2SContext) -> float:
+        """
+        BRIEF
+        -----
+        Get the largest factor (at most 1) the image has to be downscaled by
+        for the image stages to fit into the budget.
+
+        RETURNS
+        -------
+        `float`. Factor in `[minScale, 1]`.
+        """
+        available = self.available()
+        if self.estimateImage(shape, params) <= available:
+            return 1.0
+        lo, hi = self.minScale, 1.0
+        if self.estimateImage(shape, params, lo) > available:
+            raise MemoryBudgetExceeded("normalize", self.estimateImage(shape, params, lo), available)
+        for _ in range(20):
+            mid = (lo + hi) / 2
+            if self.estimateImage(shape, params, mid) <= available:
+                lo = mid
+            else:
+                hi = mid
+        return math.floor(lo * 1000) / 1000
+
+    def inferenceBatch(self, inputSize: tuple, requested: int=32) -> int:
+        """
+        BRIEF
+        -----
+        Get the largest SPICEnet batch size up to `requested` which fits into
+        the budget.
+
+        PARAMETERS
+        ----------
+        `inputSize`:
+            `tuple`. `(height, width)` of the network input, see
+            `png2spice.inference.CSPICEnet.inputSize`.
+        `requested`:
+            `int`. Batch size used without a budget.
+        """
+        perCrop = int(inputSize[0] * inputSize[1] * 3 * 4 * (1 + self.activationFactor))
+        available = self.available()
+        if perCrop > available:
+            raise MemoryBudgetExceeded("classify", perCrop, available)
+        return max(1, min(requested, available // perCrop))
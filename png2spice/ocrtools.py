@@ -13,8 +13,32 @@ import numpy as np
 from scipy.stats import gaussian_kde
 from IPython.display import display
 import re
+import tracing
 
-def localize_part_OCR(img_path: str, threshold: int=5, get_box_heights=False, show=False) -> list:
+def as_PIL_image(img):
+    """
+    BRIEF
+    -----
+    Get a `PIL.Image` from a path, a `numpy` array or a `PIL.Image`.
+
+    PARAMS
+    ------
+    `img`: `Union[str, np.ndarray, PIL.Image.Image]`
+        Image or path to image.
+
+    RETURNS
+    -------
+    `PIL.Image.Image`:
+        The image. Arrays are wrapped without re-encoding.
+    """
+    if isinstance(img, str):
+        return Image.open(img)
+    if isinstance(img, np.ndarray):
+        return Image.fromarray(img)
+    return img
+
+
+def localize_part_OCR(img_path, threshold: int=5, get_box_heights=False, show=False) -> list:
     """
     BRIEF
     -----
@@ -24,8 +48,8 @@ def localize_part_OCR(img_path: str, threshold: int=5, get_box_heights=False, sh
 
     PARAMS
     ------
-    `img_path`: str
-        Path to image.
+    `img_path`: `Union[str, np.ndarray, PIL.Image.Image]`
+        Path to image or image data, see `as_PIL_image()`.
     `threshold`: int
         Defines which values `threshold` lower than the peak are classified as valid.
     `get_box_heights`: bool
@@ -42,7 +66,9 @@ def localize_part_OCR(img_path: str, threshold: int=5, get_box_heights=False, sh
         box heights which are within the given threshold if `get_box_heights`
         is set to `True`.
     """
-    image = Image.open(img_path)
+    image = as_PIL_image(img_path)
+    if show:
+        image = image.copy()
     width, height = image.size
     boxes = []
     box_heights = []
@@ -87,7 +113,7 @@ def localize_part_OCR(img_path: str, threshold: int=5, get_box_heights=False, sh
     return valid_boxes
     
 
-def read_part_OCR(img_path: str):
+def read_part_OCR(img_path):
     """
     BRIEF
     -----
@@ -95,8 +121,8 @@ def read_part_OCR(img_path: str):
 
     PARAMS
     ------
-    `img_path`: `str`
-        Path to image.
+    `img_path`: `Union[str, np.ndarray, PIL.Image.Image]`
+        Path to image or image data, see `as_PIL_image()`.
 
     RETURNS
     -------
@@ -107,14 +133,14 @@ def read_part_OCR(img_path: str):
     -----
     The searched letters depend on the regex listed below.
     """
-    result = pytesseract.image_to_string(Image.open(img_path))
+    result = pytesseract.image_to_string(as_PIL_image(img_path))
     resultPostRegex = re.search(r"[RCDL](\d+)", result, re.IGNORECASE)
     if(resultPostRegex != None):
         resultPostRegex = resultPostRegex.group().capitalize()
     return resultPostRegex
 
 
-def get_scaling_from_OCR(img_path: str, threshold: int=5, letter_to_part_ratio: float=1/3) -> float:
+def get_scaling_from_OCR(img_path, threshold: int=5, letter_to_part_ratio: float=1/3) -> float:
     """
     BRIEF
     -----
@@ -128,8 +154,8 @@ def get_scaling_from_OCR(img_path: str, threshold: int=5, letter_to_part_ratio:
 
     PARAMS
     ------
-    `img_path`: str
-        Path to image.
+    `img_path`: `Union[str, np.ndarray, PIL.Image.Image]`
+        Path to image or image data, see `as_PIL_image()`.
     `threshold`: int
         Defines which values `threshold` lower than the peak are taken into the 
         mean-operation.
@@ -141,9 +167,11 @@ def get_scaling_from_OCR(img_path: str, threshold: int=5, letter_to_part_ratio:
     `float`:
         Ratio of component size to image size.
     """
-    image = Image.open(img_path)
-    width, _ = image.size
-    _, selected_values = localize_part_OCR(img_path, threshold, get_box_heights=True, show=False)
-    print(selected_values)
-    result_mean = np.mean(selected_values)
+    with tracing.span("ocr.scaling") as sp:
+        image = as_PIL_image(img_path)
+        width, _ = image.size
+        _, selected_values = localize_part_OCR(image, threshold, get_box_heights=True, show=False)
+        result_mean = np.mean(selected_values)
+        sp.count("boxes", len(selected_values))
+        sp.set(boxHeights=[float(v) for v in selected_values])
     return (1/letter_to_part_ratio) * result_mean / width
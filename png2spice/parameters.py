@@ -2,6 +2,11 @@
 This submodule of **png2spice** contains widely used parameters and
 fine-tuning. The issue of fine-tuning is described in the paper for
 **png2spice**.
+
+`P2SParameters` is the global, mutable set of defaults. A single run should
+not read it directly but work on an immutable `CP2SContext` obtained from
+`P2SParameters.freeze()`, so that several images can be processed
+concurrently with different scaling factors.
 """
 
 from os.path import join
@@ -13,6 +18,11 @@ class CP2SParameters:
         self.cannyThreshold             = 200   # Preprocessing for Hough lines
         self.pointDistance              = 850   # Distance for combining lines
         self.imageSliceSize             = 2960  # The size of the subimages of POI analysis
+        self.EndpointClusterRadius      = 850   # Distance for sharing one POI snapshot between line end points
+        self.POIProposals               = "endpoints" # POI snapshots at "endpoints" only or at symbol blobs as well ("both")
+        self.SymbolWireLength           = 1600  # Minimum stroke length removed as wire before finding symbol blobs
+        self.SymbolMergeDistance        = 200   # Gap closed between the strokes of one symbol blob
+        self.SymbolMinSize              = 300   # Minimum bounding box edge of a symbol blob
         self.HLThreshold                = 75    # Hough Lines Transform threshold
         self.HLMinLineLength            = 940   # Hough Lines Transform minLineLength
         self.HLmaxLineGap               = 2     # Hough Lines Transform maxLineGap
@@ -28,4 +38,121 @@ class CP2SParameters:
     def setScalingFactor(self, scalingFactor) -> float:
         self.scalingFactor = scalingFactor
 
-P2SParameters = CP2SParameters()
\ No newline at end of file
+    def freeze(self, **overrides) -> "CP2SContext":
+        """
+        BRIEF
+        -----
+        Take an immutable snapshot of the current parameters for a single run.
+
+        PARAMETERS
+        ----------
+        `overrides`:
+            Parameters to be replaced in the snapshot, e.g. `scalingFactor`.
+            The global parameters are not modified.
+
+        RETURNS
+        -------
+        `CP2SContext`. Immutable parameter context.
+        """
+        return CP2SContext(vars(self), **overrides)
+
+
+class CP2SContext:
+    def __init__(self, values: dict, **overrides) -> None:
+        """
+        BRIEF
+        -----
+        Immutable per-run parameter context. Holds the same attributes as
+        `CP2SParameters` plus the values derived from `scalingFactor`, which
+        are computed once here instead of at every use.
+
+        PARAMETERS
+        ----------
+        `values`:
+            `dict`. Parameter names and values, usually `vars()` of a
+            `CP2SParameters` object.
+        `overrides`:
+            Parameters to be replaced. Unknown names raise a `TypeError`.
+
+        NOTES
+        -----
+        Derived values carry the suffix `Scaled` (or are named `imgResize`)
+        and are always `int`.
+        """
+        unknown = set(overrides) - set(values)
+        if unknown:
+            raise TypeError(f"Unknown P2S parameters: {', '.join(sorted(unknown))}")
+        values = dict(values)
+        values.update(overrides)
+        object.__setattr__(self, "_values", values)
+        for k, v in values.items():
+            object.__setattr__(self, k, v)
+
+        sf = values["scalingFactor"]
+        derived = {
+            "imagePaddingScaled":               int(values["imagePadding"] * sf),
+            "HLThresholdScaled":                int(values["HLThreshold"] * sf),
+            "HLMinLineLengthScaled":            int(values["HLMinLineLength"] * sf),
+            "imageSliceSizeScaled":             int(values["imageSliceSize"] * sf),
+            "pointDistanceScaled":              int(values["pointDistance"] * sf),
+            "EndpointClusterRadiusScaled":      int(values["EndpointClusterRadius"] * sf),
+            "SymbolWireLengthScaled":           int(values["SymbolWireLength"] * sf),
+            "SymbolMergeDistanceScaled":        int(values["SymbolMergeDistance"] * sf),
+            "SymbolMinSizeScaled":              int(values["SymbolMinSize"] * sf),
+            "DuplicateVarianceScaled":          int(values["DuplicateVariance"] * sf),
+            "ComponentTerminalAVarianceScaled": int(values["ComponentTerminalAVariance"] * sf),
+            "ComponentTerminalBVarianceScaled": int(values["ComponentTerminalBVariance"] * sf),
+            "imgResize":                        int(values["imageSliceSize"] * sf * 1.37),
+        }
+        for k, v in derived.items():
+            object.__setattr__(self, k, v)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"CP2SContext is immutable, use replace(): cannot set '{name}'")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"CP2SContext is immutable: cannot delete '{name}'")
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, CP2SContext) and self._values == other._values
+
+    def __hash__(self) -> int:
+        return hash(tuple(sorted(self._values.items())))
+
+    def __repr__(self) -> str:
+        return "CP2SContext(" + ", ".join(f"{k}={v!r}" for k, v in self._values.items()) + ")"
+
+    def __reduce__(self):
+        return (CP2SContext, (self._values,))
+
+    def replace(self, **overrides) -> "CP2SContext":
+        """
+        BRIEF
+        -----
+        Get a copy of this context with some parameters replaced.
+        """
+        return CP2SContext(self._values, **overrides)
+
+    def asDict(self) -> dict:
+        """
+        BRIEF
+        -----
+        Get the base (non-derived) parameters as a new `dict`.
+        """
+        return dict(self._values)
+
+
+def getContext(params: CP2SContext=None) -> CP2SContext:
+    """
+    BRIEF
+    -----
+    Resolve an optional parameter context. Functions accepting a `params`
+    argument call this, so that omitting it falls back to a snapshot of the
+    global `P2SParameters` at call time.
+    """
+    if params is None:
+        return P2SParameters.freeze()
+    return params
+
+
+P2SParameters = CP2SParameters()
@@ -1,6 +1,8 @@
 """
 This submodule of **png2spice** parses the virtual graph into LTSPICE
-syntax and exports it as `.asc` file for LTSPICE to open. Sadly, the 
+syntax and exports it as `.asc` file for LTSPICE to open. Additionally,
+a plain SPICE netlist (`.cir`) can be exported from the nets of the graph,
+which can be simulated without a round-trip through LTSPICE. Sadly, the 
 relationships of the LTSPICE part coordinatees and their terminals is
 undocumented, which means that it had to be investigated manually. The
 results are described and used below:
@@ -41,10 +43,82 @@ DIODE HOR RIGHT Y + 16
 
 from POI import POI, POITypes
 from graphing import CGraph
-from typing import List, Union
+from connectivity import CNets, GROUND_NET
+from parameters import CP2SContext, getContext
+from typing import IO, List, Optional, Tuple, Union
+import shutil
+import subprocess
+import tracing
+
+# Beginnings of the lines by which ngspice reports errors, e.g.
+# "Error on line 3 :", "Error: unknown model" or "ERROR: fatal error in ngspice".
+NGSPICE_ERROR_PREFIXES = ("error", "fatal")
+
+TERMINAL_OFFSETS = {
+    # (type, rotation, terminal): (x offset, y offset)
+    (POITypes.Resistor,  0,  "A"): (16, 16),
+    (POITypes.Resistor,  0,  "B"): (16, 96),
+    (POITypes.Resistor,  90, "A"): (-96, 16),
+    (POITypes.Resistor,  90, "B"): (-16, 16),
+    (POITypes.Capacitor, 0,  "A"): (16, 0),
+    (POITypes.Capacitor, 0,  "B"): (16, 64),
+    (POITypes.Capacitor, 90, "A"): (-64, 16),
+    (POITypes.Capacitor, 90, "B"): (0, 16),
+    (POITypes.Inductor,  0,  "A"): (16, 16),
+    (POITypes.Inductor,  0,  "B"): (16, 96),
+    (POITypes.Inductor,  90, "A"): (-96, 16),
+    (POITypes.Inductor,  90, "B"): (-16, 16),
+    (POITypes.Diode,     0,  "A"): (16, 0),
+    (POITypes.Diode,     0,  "B"): (16, 64),
+    (POITypes.Diode,     90, "A"): (-64, 16),
+    (POITypes.Diode,     90, "B"): (0, 16),
+    # R180 and R270 turn R0 by another 90 and 180 degrees clockwise. As
+    # above, A is the upper or left terminal.
+    (POITypes.Resistor,  180, "A"): (-16, -96),
+    (POITypes.Resistor,  180, "B"): (-16, -16),
+    (POITypes.Resistor,  270, "A"): (16, -16),
+    (POITypes.Resistor,  270, "B"): (96, -16),
+    (POITypes.Capacitor, 180, "A"): (-16, -64),
+    (POITypes.Capacitor, 180, "B"): (-16, 0),
+    (POITypes.Capacitor, 270, "A"): (0, -16),
+    (POITypes.Capacitor, 270, "B"): (64, -16),
+    (POITypes.Inductor,  180, "A"): (-16, -96),
+    (POITypes.Inductor,  180, "B"): (-16, -16),
+    (POITypes.Inductor,  270, "A"): (16, -16),
+    (POITypes.Inductor,  270, "B"): (96, -16),
+    (POITypes.Diode,     180, "A"): (-16, -64),
+    (POITypes.Diode,     180, "B"): (-16, 0),
+    (POITypes.Diode,     270, "A"): (0, -16),
+    (POITypes.Diode,     270, "B"): (64, -16),
+}
+# Rotations at which terminal A of a diode, the upper or left one, is its
+# cathode: the anode of LTSPICE's diode symbol is on top at R0.
+CATHODE_FIRST_ROTATIONS = (90, 180)
+# Wiring POIs and GND attach at the same point for every rotation and terminal.
+for _rot in (0, 90, 180, 270):
+    for _terminal in ("A", "B"):
+        for _type in (POITypes.Corner, POITypes.Junction, POITypes.Cross):
+            TERMINAL_OFFSETS[(_type, _rot, _terminal)] = (16, 16)
+        TERMINAL_OFFSETS[(POITypes.GND, _rot, _terminal)] = (16, 0)
+
+
+SPICE_PREFIXES = {
+    POITypes.Resistor: "R",
+    POITypes.Capacitor: "C",
+    POITypes.Inductor: "L",
+    POITypes.Diode: "D",
+}
+
+SPICE_DEFAULT_VALUES = {
+    POITypes.Resistor: "1k",
+    POITypes.Capacitor: "1u",
+    POITypes.Inductor: "1m",
+    POITypes.Diode: "D",
+}
+
 
 class CParser():
-    def __init__(self, graph: Union[CGraph, List[POI]]) -> None:
+    def __init__(self, graph: Union[CGraph, List[POI]], params: CP2SContext=None) -> None:
         """
         BRIEF
         -----
@@ -55,11 +129,20 @@ class CParser():
         ----------
         `graph`: `Union[CGraph, List[POI]]`
             Graph or list of POIs (loose graph).
+        `params`: `png2spice.parameters.CP2SContext`
+            Parameters of this run. Default is the context of `graph` if it
+            is a `CGraph`, else a snapshot of the global `P2SParameters`.
         """
+        self.nets = None
+        self.wireCount = 0
+        self.placeholderCount = 0
         if isinstance(graph, CGraph):
             self.graphContents = graph.looseGraph
+            self.nets = graph.nets
+            self.params = graph.params if params is None else params
         else:
             self.graphContents = graph
+            self.params = getContext(params)
         self.header = "SHEET 1 1000 1000"
         self.part_aliases = dict({
             f"{POITypes.Resistor}": "res",
@@ -101,116 +184,122 @@ class CParser():
         else:
             return ""
 
-    def __GeneratePartOffset(self, POIType: POITypes, x: int, y: int, rot: int, terminal: str) -> str: # maybe make this a num
+    def __TerminalPosition(self, poi: POI, terminal: str) -> tuple:
         """
         BRIEF
         -----
-        Obtain the fitting part offset per part type as needed by LTSPICE.
+        Obtain the LTSPICE coordinates of a part's terminal from
+        `TERMINAL_OFFSETS`.
 
         PARAMETERS
         ----------
-        `POIType`: `png2spice.POI.POITypes`
-            Desired POI type.
-        `x`: `int`
-            x-coordinate of part.
-        `y`: `int`
-            y-coordinate of part.
-        `rot`: `int`
-            rotation of part.
+        `poi`: `png2spice.POI.POI`
+            POI owning the terminal.
         `terminal`: `str`
             Primary terminal (A) or secondary terminal (B).
 
         RETURNS
         -------
-        `str`:
-            POI as line in text format corresponding to LTSPICE
-            syntax.
+        `tuple`:
+            x/y coordinates of the terminal. `(0, 0)` if the combination of
+            type and rotation is unknown.
         """
-        if(POIType == POITypes.Resistor):
-            if(rot == 0):
-                if(terminal == "A"):
-                    return f"{x + 16} {y + 16}"
-                elif(terminal == "B"):
-                    return f"{x + 16} {y + 96}"
-            elif(rot == 90):
-                if(terminal == "A"):
-                    return f"{x - 96} {y + 16}"
-                elif(terminal == "B"):
-                    return f"{x - 16} {y + 16}"
-        elif(POIType == POITypes.Capacitor):
-            if(rot == 0):
-                if(terminal == "A"):
-                    return f"{x + 16} {y}"
-                elif(terminal == "B"):
-                    return f"{x + 16} {y + 64}"
-            elif(rot == 90):
-                if(terminal == "A"):
-                    return f"{x - 64} {y + 16}"
-                elif(terminal == "B"):
-                    return f"{x } {y + 16}"
-        elif(POIType == POITypes.Inductor):
-            if(rot == 0):
-                if(terminal == "A"):
-                    return f"{x + 16} {y + 16}"
-                elif(terminal == "B"):
-                    return f"{x + 16} {y + 96}"
-            elif(rot == 90):
-                if(terminal == "A"):
-                    return f"{x - 96} {y + 16}"
-                elif(terminal == "B"):
-                    return f"{x - 16} {y + 16}"
-        elif(POIType == POITypes.Diode):
-            if(rot == 0):
-                if(terminal == "A"):
-                    return f"{x + 16} {y + 0}"
-                elif(terminal == "B"):
-                    return f"{x + 16} {y +64}"
-            elif(rot == 90):
-                if(terminal == "A"):
-                    return f"{x - 64} {y + 16}"
-                elif(terminal == "B"):
-                    return f"{x} {y + 16}"
-        elif(POIType == POITypes.Corner or POIType == POITypes.Junction or POIType == POITypes.Cross):
-            return f"{x+16} {y+16}"
-        elif(POIType == POITypes.GND):
-            return f"{x + 16} {y}"
-        return "0 0"
-
-    def __GenerateWire(self, startPOI: POI, terminal: str) -> str:
+        offset = TERMINAL_OFFSETS.get((poi.type, poi.rotation, terminal))
+        if offset is None:
+            return (0, 0)
+        return (poi.position[0] + offset[0], poi.position[1] + offset[1])
+
+    def __GenerateWires(self, poi: POI, seen: set):
         """
         BRIEF
         -----
-        Create LTSPICE syntax for wires.
+        Create LTSPICE syntax for the wires of a POI. Wires already emitted
+        from the other side and wires of zero length are skipped.
 
         PARAMETERS
         ----------
-        `startPOI`: `png2spice.POI.POI`
-            First POI in graph.
-        `terminal`: `str`
-            Primary terminal (A) or secondary terminal (B).
-            
+        `poi`: `png2spice.POI.POI`
+            POI whose terminals are wired.
+        `seen`: `set`
+            Wires emitted so far, updated in place.
+
         RETURNS
         -------
-        `str`:
-            Wire as line in text format corresponding to LTSPICE
-            syntax.
+        `Iterator[str]`:
+            Wires as lines in text format corresponding to LTSPICE syntax.
         """
-        startX = startPOI.position[0]
-        startY = startPOI.position[1]
-        rot = startPOI.rotation
-        if(terminal == "A" and startPOI.terminalA is not None):
-            return f"WIRE {self.__GeneratePartOffset(startPOI.type, startX, startY, startPOI.rotation, 'A')} {self.__GeneratePartOffset(startPOI.terminalA.type, startPOI.terminalA.position[0], startPOI.terminalA.position[1], startPOI.terminalA.rotation , 'A')}"
-        elif(terminal == "B" and startPOI.terminalB is not None):
-            return f"WIRE {self.__GeneratePartOffset(startPOI.type, startX, startY, startPOI.rotation, 'B')} {self.__GeneratePartOffset(startPOI.terminalB.type, startPOI.terminalB.position[0], startPOI.terminalB.position[1], startPOI.terminalB.rotation, 'B')}"
-        else:
-            return ""
-        
+        for terminal, other in (("A", poi.terminalA), ("B", poi.terminalB)):
+            if other is None:
+                continue
+            start = self.__TerminalPosition(poi, terminal)
+            end = self.__TerminalPosition(other, terminal)
+            if start == end:
+                continue
+            key = (start, end) if start <= end else (end, start)
+            if key in seen:
+                continue
+            seen.add(key)
+            yield f"WIRE {start[0]} {start[1]} {end[0]} {end[1]}"
+
+    def IterAsc(self, graph: List[POI]=None):
+        """
+        BRIEF
+        -----
+        Iterate through all registered POIs in the graph and yield them as
+        lines in LTSPICE syntax, without line breaks.
+
+        PARAMETERS
+        ----------
+        `graph`: `list[png2spice.POI.POI]`
+            Graph to be converted. If `graph` is omitted, the graph passed
+            at the creation of the `CParser` is used. Default is `None`.
+
+        RETURNS
+        -------
+        `Iterator[str]`:
+            Header, symbols, flags and unique wires.
+        """
+        if graph:
+            if isinstance(graph, CGraph):
+                self.graphContents = graph.looseGraph
+            else:
+                self.graphContents = graph
+        yield self.header
+        seen = set()
+        for poi in self.graphContents:
+            line = self.__Poi2Str(poi)
+            if line:
+                yield line
+            yield from self.__GenerateWires(poi, seen)
+        self.wireCount = len(seen)
+
+    def WriteAsc(self, stream: IO[str], graph: List[POI]=None):
+        """
+        BRIEF
+        -----
+        Stream the LTSPICE syntax of the graph line by line into any
+        writable text file-like object.
+
+        PARAMETERS
+        ----------
+        `stream`: `IO[str]`
+            Destination, e.g. an open file or `io.StringIO`.
+        `graph`: `list[png2spice.POI.POI]`
+            See `IterAsc()`.
+        """
+        with tracing.span("parsing.asc") as sp:
+            for line in self.IterAsc(graph):
+                stream.write(line + "\n")
+            sp.count("pois", len(self.graphContents))
+            sp.count("wires", self.wireCount)
+
     def Graph2Asc(self, save_path: str="./output.asc", graph: List[POI]=None):
         """
         BRIEF
         -----
         Iterate through all registered POIs in the graph and convert them
-        into LTSPICE syntax.
+        into LTSPICE syntax. The file is assembled in memory and written in
+        one go.
 
         PARAMETERS
         ----------
@@ -222,14 +311,229 @@ class CParser():
             omitted, the graph passed at the creation of the `CParser` is
             used. Default is `None`.
         """
+        with tracing.span("parsing.asc") as sp:
+            text = "\n".join(self.IterAsc(graph)) + "\n"
+            with open(save_path, 'w') as f:
+                f.write(text)
+            sp.count("pois", len(self.graphContents))
+            sp.count("wires", self.wireCount)
+
+    def __NetName(self, netId: int) -> str:
+        """
+        BRIEF
+        -----
+        Convert a net ID into a SPICE node name. Ground is always `0`.
+        """
+        if netId == GROUND_NET:
+            return "0"
+        return f"N{netId:03d}"
+
+    def __Designators(self, parts: List[POI]) -> dict:
+        """
+        BRIEF
+        -----
+        Assign a unique SPICE designator to every part. OCR names from
+        `POI.name` are kept if they carry the right prefix and are not
+        taken yet, all other parts are numbered after the highest OCR
+        number of their prefix.
+
+        RETURNS
+        -------
+        `dict`:
+            POI to designator.
+        """
+        designators = dict()
+        taken = set()
+        for poi in parts:
+            prefix = SPICE_PREFIXES[poi.type]
+            name = str(poi.name).upper() if poi.name else ""
+            if name.startswith(prefix) and name[len(prefix):].isdigit() and name not in taken:
+                designators[poi] = name
+                taken.add(name)
+        counters = dict()
+        for poi in parts:
+            if poi in designators:
+                continue
+            prefix = SPICE_PREFIXES[poi.type]
+            n = counters.get(prefix, 0) + 1
+            while f"{prefix}{n}" in taken:
+                n += 1
+            counters[prefix] = n
+            designators[poi] = f"{prefix}{n}"
+            taken.add(designators[poi])
+        return designators
+
+    def IterCir(self, graph: List[POI]=None, analysis: str=".op"):
+        """
+        BRIEF
+        -----
+        Iterate through all parts in the graph and yield a SPICE netlist
+        line by line, without line breaks.
+
+        PARAMETERS
+        ----------
+        `graph`: `list[png2spice.POI.POI]`
+            Graph to be converted. If `graph` is omitted, the graph passed
+            at the creation of the `CParser` is used. Default is `None`.
+        `analysis`: `str`
+            Analysis card written before `.end`. Pass an empty string to
+            omit it. Default is `.op`.
+
+        RETURNS
+        -------
+        `Iterator[str]`:
+            Title, one line per part, models, analysis and `.end`.
+
+        NOTES
+        -----
+        Node names are derived from the net table of
+        `png2spice.connectivity.CNets`, which is built here if the graph
+        does not carry one yet. Part values are taken from `POI.text`. OCR
+        only reads the part names, so `POI.text` is only set for graphs from
+        `png2spice.synthetic` or by hand; all other parts get the
+        placeholder of `SPICE_DEFAULT_VALUES`, flagged by a comment line
+        right above them and counted in `placeholderCount`. Diodes list their
+        anode first, which is terminal B at the `CATHODE_FIRST_ROTATIONS`,
+        matching the symbol drawn by `IterAsc()`.
+        """
         if graph:
             if isinstance(graph, CGraph):
                 self.graphContents = graph.looseGraph
+                self.nets = graph.nets
             else:
                 self.graphContents = graph
+                self.nets = None
+        if self.nets is None or self.nets.pois != list(self.graphContents):
+            self.nets = CNets(self.graphContents)
+        parts = [p for p in self.nets.components() if p.type in SPICE_PREFIXES]
+        designators = self.__Designators(parts)
+
+        yield "* png2spice netlist"
+        hasDiode = False
+        self.placeholderCount = 0
+        for poi in parts:
+            value = poi.text
+            if not value:
+                value = SPICE_DEFAULT_VALUES[poi.type]
+                self.placeholderCount += 1
+                yield f"* {designators[poi]}: value not read from the schematic, placeholder {value}"
+            hasDiode = hasDiode or poi.type == POITypes.Diode
+            nodeA = self.__NetName(self.nets.netOf(poi, "A"))
+            nodeB = self.__NetName(self.nets.netOf(poi, "B"))
+            if poi.type == POITypes.Diode and poi.rotation in CATHODE_FIRST_ROTATIONS:
+                nodeA, nodeB = nodeB, nodeA
+            yield f"{designators[poi]} {nodeA} {nodeB} {value}"
+        if hasDiode:
+            yield f".model {SPICE_DEFAULT_VALUES[POITypes.Diode]} D"
+        if analysis:
+            yield analysis
+        yield ".end"
+
+    def WriteCir(self, stream: IO[str], graph: List[POI]=None, analysis: str=".op"):
+        """
+        BRIEF
+        -----
+        Stream the SPICE netlist of the graph line by line into any writable
+        text file-like object. See `IterCir()`.
+        """
+        with tracing.span("parsing.cir") as sp:
+            for line in self.IterCir(graph, analysis):
+                stream.write(line + "\n")
+            sp.count("parts", len(self.nets.components()))
+            sp.count("nets", len(self.nets.table))
+            sp.count("placeholders", self.placeholderCount)
+
+    def Graph2Cir(self, save_path: str="./output.cir", graph: List[POI]=None, analysis: str=".op"):
+        """
+        BRIEF
+        -----
+        Convert the graph into a SPICE netlist and save it as `.cir` file.
+        The file is streamed to disk line by line.
+
+        PARAMETERS
+        ----------
+        `save_path`: `str`
+            Destination of the `.cir` file to be saved.
+            Default is `./output.cir`
+        `graph`: `list[png2spice.POI.POI]`
+            See `IterCir()`.
+        `analysis`: `str`
+            See `IterCir()`.
+        """
         with open(save_path, 'w') as f:
-            f.write(self.header + "\n")
-            for poi in self.graphContents:
-                    f.write(self.__Poi2Str(poi) + "\n")
-                    f.write(self.__GenerateWire(poi, "A") + "\n")
-                    f.write(self.__GenerateWire(poi, "B") + "\n")
\ No newline at end of file
+            self.WriteCir(f, graph, analysis)
+
+
+def parseAsc(text: str) -> dict:
+    """
+    BRIEF
+    -----
+    Read the parts, flags and wires of LTSPICE `.asc` content into a
+    canonical, order-independent form.
+
+    PARAMETERS
+    ----------
+    `text`: `str`
+        Content of an `.asc` file.
+
+    RETURNS
+    -------
+    `dict`:
+        `symbols`: sorted list of `(alias, x, y, rotation)`,
+        `flags`: sorted list of `(label, x, y)`,
+        `wires`: sorted list of `(x1, y1, x2, y2)` with the smaller end
+        point first. Other lines are ignored.
+    """
+    symbols, flags, wires = list(), list(), list()
+    for line in text.splitlines():
+        tok = line.split()
+        if not tok:
+            continue
+        try:
+            if tok[0] == "SYMBOL" and len(tok) >= 5:
+                symbols.append((tok[1], int(float(tok[2])), int(float(tok[3])), tok[4]))
+            elif tok[0] == "FLAG" and len(tok) >= 4:
+                flags.append((tok[3], int(float(tok[1])), int(float(tok[2]))))
+            elif tok[0] == "WIRE" and len(tok) >= 5:
+                a = (int(float(tok[1])), int(float(tok[2])))
+                b = (int(float(tok[3])), int(float(tok[4])))
+                wires.append(a + b if a <= b else b + a)
+        except ValueError:
+            continue
+    return {"symbols": sorted(symbols), "flags": sorted(flags), "wires": sorted(wires)}
+
+
+def validateCir(path: str, simulator: str="ngspice", timeout: float=60) -> Optional[Tuple[bool, str]]:
+    """
+    BRIEF
+    -----
+    Let a local open-source SPICE simulator parse and run a netlist in
+    batch mode.
+
+    PARAMETERS
+    ----------
+    `path`: `str`
+        Path to the `.cir` file.
+    `simulator`: `str`
+        Executable to use. It has to support `-b` for batch mode like
+        `ngspice` does. Default is `ngspice`.
+    `timeout`: `float`
+        Seconds until the simulator is killed.
+
+    RETURNS
+    -------
+    `tuple`:
+        `(ok, output)`, where `ok` is `False` if the simulator exited with
+        an error code or printed a line starting with one of
+        `NGSPICE_ERROR_PREFIXES`. `None` if the simulator is not installed.
+    """
+    exe = shutil.which(simulator)
+    if exe is None:
+        return None
+    try:
+        res = subprocess.run([exe, "-b", path], capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired as e:
+        return False, f"{simulator} timed out after {timeout}s: {e}"
+    output = res.stdout + res.stderr
+    errors = [l for l in output.splitlines() if l.strip().lower().startswith(NGSPICE_ERROR_PREFIXES)]
+    return res.returncode == 0 and not errors, output
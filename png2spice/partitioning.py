@@ -0,0 +1,256 @@
+"""
+This submodule of **png2spice** splits the graph stage of a schematic into
+regions which cannot influence each other, such as independent
+sub-circuits, ground islands or separate sheets on one page. Two line end
+points belong to the same region if they are closer than the largest
+distance any graph step looks at (duplicate removal and terminal linking),
+and both end points of a line always do. Every region is built, cleaned,
+linked and aligned on its own, in parallel worker processes, and the
+regions are merged into one graph afterwards. All regions work in the
+coordinates of the whole image, so no positions have to be translated.
+
+    graph = partitionedGraph(HLs, preds, ocrs, params, workers=8)
+    asc, cir = pipeline.stageExport(graph)
+
+The quadratic graph steps thus scale with the size of the largest region
+instead of the whole page.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import tracing
+from connectivity import CUnionFind
+from graphing import CGraph
+from POI import isProposalLabel, proposalPosition
+from parameters import CP2SContext, getContext
+from spatial import CSpatialIndex
+
+_pool = None
+_poolWorkers = 0
+
+
+def partitionLines(lines: np.ndarray, params: CP2SContext=None) -> list:
+    """
+    BRIEF
+    -----
+    Split the lines into regions whose end points are farther apart than
+    any graph step reaches.
+
+    PARAMETERS
+    ----------
+    `lines`:
+        `np.ndarray`. Lines of shape `(n_lines, 4)`.
+    `params`:
+        `png2spice.parameters.CP2SContext`. Parameters of this run. Default
+        is a snapshot of the global `P2SParameters`.
+
+    RETURNS
+    -------
+    `list`. One `np.ndarray` of line indices per region, each in ascending
+    order, largest region first.
+
+    NOTES
+    -----
+    Contains **P2S parameters** `DuplicateVariance`,
+    `ComponentTerminalAVariance` and `ComponentTerminalBVariance`. See
+    `png2spice.parameters`.
+    """
+    params = getContext(params)
+    radius = max(params.DuplicateVarianceScaled, params.ComponentTerminalAVarianceScaled,
+                 params.ComponentTerminalBVarianceScaled, 1)
+    lines = np.asarray(lines).reshape(-1, 4)
+    regions = CUnionFind()
+    index = CSpatialIndex(radius)
+    for i, line in enumerate(lines):
+        regions.add(i)
+        for end, pos in (("A", line[0:2]), ("B", line[2:4])):
+            for other in index.query(pos, radius):
+                regions.union(i, other[0])
+            index.insert((i, end), (int(pos[0]), int(pos[1])))
+    groups = dict()
+    for i in range(len(lines)):
+        groups.setdefault(regions.find(i), list()).append(i)
+    return sorted((np.asarray(g) for g in groups.values()), key=len, reverse=True)
+
+
+def assignProposals(lines: np.ndarray, regions: list, labels: list, params: CP2SContext=None) -> list:
+    """
+    BRIEF
+    -----
+    Add the symbol proposals without a line end point (see
+    `png2spice.lines.clusterEndpoints`) to the regions of `partitionLines()`.
+    A proposal joins all regions with an end point in reach, which are
+    merged; proposals out of reach of any end point form a region without
+    lines.
+
+    RETURNS
+    -------
+    `list`. `(lineIndices, proposalLabels)` per region, largest first.
+    """
+    params = getContext(params)
+    radius = max(params.DuplicateVarianceScaled, params.ComponentTerminalAVarianceScaled,
+                 params.ComponentTerminalBVarianceScaled, 1)
+    lines = np.asarray(lines).reshape(-1, 4)
+    index = CSpatialIndex(radius)
+    for k, region in enumerate(regions):
+        for i in region:
+            index.insert((k, i, "A"), (int(lines[i][0]), int(lines[i][1])))
+            index.insert((k, i, "B"), (int(lines[i][2]), int(lines[i][3])))
+    merged = CUnionFind()
+    for k in range(len(regions)):
+        merged.add(("region", k))
+    for label in labels:
+        merged.add(label)
+        for k, _, _ in index.query(proposalPosition(label), radius):
+            merged.union(label, ("region", k))
+    groups = dict()
+    for k, region in enumerate(regions):
+        groups.setdefault(merged.find(("region", k)), (list(), list()))[0].extend(region)
+    for label in labels:
+        groups.setdefault(merged.find(label), (list(), list()))[1].append(label)
+    return sorted(((np.asarray(sorted(r), int), p) for r, p in groups.values()),
+                  key=lambda g: len(g[0]) + len(g[1]), reverse=True)
+
+
+def _regionInputs(lines: np.ndarray, region: np.ndarray, proposals: list, preds: dict, ocrs: dict,
+                  rotations: dict) -> tuple:
+    """
+    BRIEF
+    -----
+    Get the lines of a region and its predictions, OCR results and
+    rotations under the labels of the region's own line numbering. Symbol
+    proposals keep their labels.
+    """
+    def sub(results):
+        if results is None:
+            return None
+        local = {f"{j}{end}": results[f"{i}{end}"]
+                 for j, i in enumerate(region) for end in ("A", "B") if f"{i}{end}" in results}
+        local.update((label, results[label]) for label in proposals if label in results)
+        return local
+    return lines[region], sub(preds), sub(ocrs), sub(rotations)
+
+
+def _processRegions(tasks: list, params: CP2SContext) -> list:
+    """
+    BRIEF
+    -----
+    Run the graph steps up to the grid alignment on several regions. Runs
+    in a worker process.
+
+    PARAMETERS
+    ----------
+    `tasks`:
+        `list`. `(region, lines, preds, ocrs, rotations)` per region, see
+        `_regionInputs()`.
+
+    RETURNS
+    -------
+    `list`. `(region, looseGraph)` per region. The POIs are labelled with
+    their global labels again.
+    """
+    results = list()
+    for region, HLs, preds, ocrs, rotations in tasks:
+        graph = CGraph(HLs, preds, ocrs, params, rotations)
+        graph.rmDuplicates()
+        graph.link()
+        graph.analyzeRotations()
+        graph.snapToGrid()
+        graph.alignToGrid()
+        for poi in graph.looseGraph:
+            if not isProposalLabel(poi.value):
+                poi.value = f"{region[int(poi.value[:-1])]}{poi.value[-1]}"
+        results.append((region, graph.looseGraph))
+    return results
+
+
+def _shards(tasks: list, n: int) -> list:
+    """
+    BRIEF
+    -----
+    Spread the regions over `n` shards of about the same work, the largest
+    regions first. The graph steps grow quadratically with the lines of a
+    region.
+    """
+    shards = [list() for _ in range(n)]
+    loads = [0] * n
+    for task in sorted(tasks, key=lambda t: len(t[0]), reverse=True):
+        k = loads.index(min(loads))
+        shards[k].append(task)
+        loads[k] += max(len(task[0]), 1) ** 2
+    return [s for s in shards if s]
+
+
+def getPool(workers: int) -> ProcessPoolExecutor:
+    """
+    BRIEF
+    -----
+    Get the process pool of the region workers, created on first use and
+    kept for later images. Workers are spawned, so that they do not inherit
+    the threads of `tensorflow` or `cv2`.
+    """
+    global _pool, _poolWorkers
+    if _pool is None or _poolWorkers != workers:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        _poolWorkers = workers
+    return _pool
+
+
+def partitionedGraph(lines: np.ndarray, preds: dict, ocrs: dict, params: CP2SContext=None,
+                     rotations: dict=None, workers: int=None) -> CGraph:
+    """
+    BRIEF
+    -----
+    Graph building stage on independent regions, with the same result as
+    `png2spice.pipeline.stageGraph` apart from the grid alignment, which
+    does not align POIs of different regions to each other.
+
+    PARAMETERS
+    ----------
+    `lines`, `preds`, `ocrs`, `params`, `rotations`:
+        See `png2spice.graphing.CGraph`.
+    `workers`:
+        `int`. Worker processes. Default is the number of CPUs. With a
+        single worker or region, everything runs in this process.
+
+    RETURNS
+    -------
+    `png2spice.graphing.CGraph`. The merged graph with its nets extracted,
+    holding the POIs in the order of their labels.
+    """
+    params = getContext(params)
+    workers = workers or os.cpu_count() or 1
+    lines = np.asarray(lines).reshape(-1, 4)
+    with tracing.span("graph.partition", lines=len(lines)) as sp:
+        proposals = [label for label in preds if isProposalLabel(label)]
+        regions = assignProposals(lines, partitionLines(lines, params), proposals, params)
+        sp.count("regions", len(regions))
+        sp.count("largestRegion", len(regions[0][0]) if regions else 0)
+        tasks = [(region,) + _regionInputs(lines, region, labels, preds, ocrs, rotations)
+                 for region, labels in regions]
+
+    with tracing.span("graph.regions", regions=len(tasks)):
+        if workers <= 1 or len(tasks) <= 1:
+            results = _processRegions(tasks, params)
+        else:
+            pool = getPool(workers)
+            futures = [pool.submit(_processRegions, shard, params) for shard in _shards(tasks, workers)]
+            results = [r for future in futures for r in future.result()]
+
+    with tracing.span("graph.merge") as sp:
+        graph = CGraph(lines, dict(), None, params)
+        pois = [poi for _, looseGraph in results for poi in looseGraph]
+        # Same order as in a single CGraph: end points by line, then proposals
+        pois.sort(key=lambda poi: (1, 0, poi.value) if isProposalLabel(poi.value)
+                  else (0, int(poi.value[:-1]), poi.value[-1]))
+        graph.looseGraph = pois
+        graph.index = None
+        sp.count("pois", len(pois))
+    graph.extractNets()
+    return graph
@@ -0,0 +1,1019 @@
+"""
+This submodule of **png2spice** runs the analysis stages without the GUI.
+The stages are the same as the ones of `png2spice.gui.ScreenshotApp.analyze`:
+scaling estimation, normalization, line extraction, classification (SPICEnet
+and OCR), graph building and export. They form a small DAG (`CPipeline`).
+Every stage declares the **P2S parameters** it depends on, and its output is
+checkpointed under a key derived from the input image hash, those parameters,
+the stage and code version, the model version and the keys of the stages it
+depends on. Re-running an image with a tweaked downstream parameter thus
+skips all upstream stages.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+from collections import OrderedDict
+from concurrent.futures import CancelledError
+from os.path import join, exists
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import cropstore
+import lines
+import memory
+import partitioning
+import tracing
+from graphing import CGraph
+from POI import ORIENTED_TYPES, POLARIZED_TYPES, isValidPOI, pred2Type
+from parsing import CParser
+from ocrtools import get_scaling_from_OCR, read_part_OCR
+from parameters import CP2SContext, getContext
+
+PIPELINE_VERSION = "1"
+
+# Limits of an on-disk checkpoint cache, see `CStageCache`
+DEFAULT_CACHE_BYTES = 2 * 1024**3
+DEFAULT_CACHE_AGE = 30 * 24 * 3600
+PRUNE_INTERVAL = 32
+# Stage outputs held in memory; a conversion produces one per stage
+DEFAULT_MEMORY_ENTRIES = 64
+
+STAGE_ORDER = ("scaling", "normalize", "lines", "classify", "rotate", "graph", "export")
+
+ROTATION_MODES = ("off", "polarized", "all")
+
+STAGE_PARAMETERS = {
+    "scaling":   ("scalingFactor",),
+    "normalize": ("contrastThreshold", "imagePadding"),
+    "lines":     ("cannyThreshold", "pointDistance", "imageSliceSize", "HLThreshold",
+                  "HLMinLineLength", "HLmaxLineGap", "HoughIterations", "HoughThresholdWiggle",
+                  "EndpointClusterRadius", "POIProposals", "SymbolWireLength", "SymbolMergeDistance",
+                  "SymbolMinSize"),
+    "classify":  (),
+    "rotate":    (),
+    "graph":     ("DuplicateVariance", "ComponentTerminalAVariance",
+                  "ComponentTerminalBVariance", "minGridStep"),
+    "export":    (),
+}
+
+
+def hashFile(path: str) -> str:
+    """
+    BRIEF
+    -----
+    Get the SHA-1 hex digest of a file's content.
+    """
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hashImage(image) -> str:
+    """
+    BRIEF
+    -----
+    Get the SHA-1 hex digest of an image, i.e. of the file's content for a
+    path and of shape and pixels for image data. Used as image ID.
+    """
+    if isinstance(image, str):
+        return hashFile(image)
+    data = np.ascontiguousarray(image)
+    h = hashlib.sha1(f"{data.dtype}{data.shape}".encode())
+    h.update(memoryview(data).cast("B"))
+    return h.hexdigest()
+
+
+class CStageCache:
+    def __init__(self, path: str=None, maxBytes: int=DEFAULT_CACHE_BYTES, maxAge: float=DEFAULT_CACHE_AGE,
+                 maxEntries: int=DEFAULT_MEMORY_ENTRIES) -> None:
+        """
+        BRIEF
+        -----
+        Cache for stage outputs. The most recently used entries are kept in
+        memory and, if `path` is given, all of them are pickled to disk so
+        that other processes and later runs can reuse them.
+
+        PARAMETERS
+        ----------
+        `path`:
+            `str`. Cache directory. Default is `None` (memory only).
+        `maxBytes`:
+            `int`. Size of the cache directory above which the least
+            recently used checkpoints are deleted. `None` means no limit.
+            Default is `DEFAULT_CACHE_BYTES`.
+        `maxAge`:
+            `float`. Seconds since the last use after which a checkpoint is
+            deleted. `None` means no limit. Default is `DEFAULT_CACHE_AGE`.
+        `maxEntries`:
+            `int`. Number of entries kept in memory; the least recently used
+            ones are dropped beyond it, and read from disk again if `path`
+            is given. `None` means no limit. Default is
+            `DEFAULT_MEMORY_ENTRIES`.
+
+        NOTES
+        -----
+        The directory is pruned on creation and every `PRUNE_INTERVAL`
+        writes, so it may exceed `maxBytes` by the checkpoints written in
+        between. Entries deleted on disk are dropped from memory as well.
+        """
+        self.path = path
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.maxEntries = maxEntries
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        if path is not None:
+            if not exists(path):
+                os.makedirs(path, exist_ok=True)
+            self.prune()
+
+    def __file(self, key: str) -> str:
+        return join(self.path, key[:2], key + ".pkl")
+
+    def get(self, key: str, default=None):
+        if key in self.memory:
+            self.hits += 1
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.path is not None and exists(self.__file(key)):
+            try:
+                with open(self.__file(key), "rb") as f:
+                    value = pickle.load(f)
+                # The modification time tracks the last use for pruning
+                os.utime(self.__file(key))
+            except FileNotFoundError:
+                # Pruned by another process in the meantime
+                self.misses += 1
+                return default
+            self.__remember(key, value)
+            self.hits += 1
+            return value
+        self.misses += 1
+        return default
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.memory or (self.path is not None and exists(self.__file(key)))
+
+    def __remember(self, key: str, value) -> None:
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if self.maxEntries is not None:
+            while len(self.memory) > self.maxEntries:
+                self.memory.popitem(last=False)
+
+    def put(self, key: str, value) -> None:
+        self.__remember(key, value)
+        if self.path is not None:
+            fname = self.__file(key)
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            tmp = fname + f".{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, fname)
+            self.writes += 1
+            if self.writes % PRUNE_INTERVAL == 0:
+                self.prune()
+
+    def prune(self) -> int:
+        """
+        BRIEF
+        -----
+        Delete the checkpoints on disk which are older than `maxAge` and,
+        least recently used first, as many more as needed to get below
+        `maxBytes`.
+
+        RETURNS
+        -------
+        `int`. Number of deleted checkpoints.
+        """
+        if self.path is None or (self.maxBytes is None and self.maxAge is None):
+            return 0
+        entries = list()
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if not name.endswith(".pkl"):
+                    continue
+                try:
+                    st = os.stat(join(root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, join(root, name)))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        deleted = 0
+        for mtime, size, fname in entries:
+            expired = self.maxAge is not None and now - mtime > self.maxAge
+            if not expired and (self.maxBytes is None or total <= self.maxBytes):
+                break
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+            self.memory.pop(os.path.basename(fname)[:-len(".pkl")], None)
+            total -= size
+            deleted += 1
+        return deleted
+
+
+def estimateScalingFactor(imagePath) -> float:
+    """
+    BRIEF
+    -----
+    Estimate the scaling factor of a schematic from the size of its letters,
+    see `png2spice.ocrtools.get_scaling_from_OCR`. `imagePath` may also be
+    image data, see `png2spice.ocrtools.as_PIL_image`.
+
+    RETURNS
+    -------
+    `float`. Value for the `scalingFactor` parameter.
+    """
+    scalingFactor = get_scaling_from_OCR(imagePath, threshold=15, letter_to_part_ratio=1/3)
+    return scalingFactor * -0.5215 + 0.088
+
+
+def imageShape(imagePath) -> tuple:
+    """
+    BRIEF
+    -----
+    Get `(height, width)` of an image file from its header, without
+    decoding it. `imagePath` may also be image data.
+    """
+    if not isinstance(imagePath, str):
+        return tuple(imagePath.shape[:2])
+    with Image.open(imagePath) as img:
+        width, height = img.size
+    return height, width
+
+
+def snapshotDirs(workDir: str) -> tuple:
+    """
+    BRIEF
+    -----
+    Get the folder handed to SPICEnet and the folder the POI snapshots are
+    written to for a working directory.
+
+    RETURNS
+    -------
+    `tuple`. `(poiDir, snapshotDir)`.
+    """
+    poiDir = join(workDir, "POIs")
+    return poiDir, join(poiDir, "snapshots")
+
+
+def stageNormalize(imagePath, params: CP2SContext, scale: float=1.0):
+    """
+    BRIEF
+    -----
+    Data import and normalization stage. `imagePath` is a path or grayscale
+    image data, which is used as is. With a `scale` below 1, the image is
+    downscaled right after decoding; `params` then has to carry the scaling
+    factor of the downscaled image.
+    """
+    if isinstance(imagePath, str):
+        img = lines.imageDataFromPath(imagePath)
+    else:
+        img = imagePath
+    if scale != 1.0:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return lines.normalizeImageData(img, params)
+
+
+def stageLines(img, workDir: str, params: CP2SContext):
+    """
+    BRIEF
+    -----
+    Line extraction and POI localization stage. Snapshots of a previous run
+    in the same working directory are removed first.
+    """
+    _, snapshotDir = snapshotDirs(workDir)
+    if exists(snapshotDir):
+        shutil.rmtree(snapshotDir)
+    os.makedirs(snapshotDir)
+    return lines.getHoughLines(img, spath=snapshotDir, params=params)
+
+
+def stageClassify(model, workDir: str, params: CP2SContext, ocr: bool=True, cancel=None,
+                  batchSize: int=None):
+    """
+    BRIEF
+    -----
+    SPICEnet inference and OCR stage. If `cancel` (a `threading.Event`) is
+    given, the stage stops between batches once it is set, see
+    `png2spice.inference.CSPICEnet.predict`. `batchSize` overrides the
+    inference batch size of the model. The results only cover the saved
+    snapshots; with end point clusters they have to be expanded by
+    `png2spice.lines.expandClusters()`.
+
+    RETURNS
+    -------
+    `tuple`. `(preds, ocrs)`, `ocrs` is `None` if `ocr` is `False`.
+    """
+    poiDir, _ = snapshotDirs(workDir)
+    kwargs = dict() if batchSize is None else {"batchSize": batchSize}
+    if ocr:
+        return model.predict(poiDir, params=params, cancel=cancel, **kwargs)
+    return model.predict(poiDir, ocr=False, params=params, cancel=cancel, **kwargs), None
+
+
+def stageClassifyStore(model, store: cropstore.CCropStore, params: CP2SContext, ocr: bool=True,
+                       cancel=None, batchSize: int=None):
+    """
+    BRIEF
+    -----
+    SPICEnet inference and OCR stage reading the crops from a crop archive
+    instead of snapshot files, see `png2spice.cropstore`.
+
+    RETURNS
+    -------
+    `tuple`. `(preds, ocrs)`, as `stageClassify()`.
+    """
+    kwargs = dict() if batchSize is None else {"batchSize": batchSize}
+    if ocr:
+        return model.predictStore(store, params=params, cancel=cancel, **kwargs)
+    return model.predictStore(store, ocr=False, params=params, cancel=cancel, **kwargs), None
+
+
+def stageClassifyDense(model, img, HLs, clusters: lines.CEndpointClusters, params: CP2SContext, ocr: bool=True,
+                       cancel=None, batchSize: int=None):
+    """
+    BRIEF
+    -----
+    SPICEnet inference and OCR stage without snapshot files. SPICEnet runs
+    densely over the normalized image and is read out at the end points
+    representing the `clusters`, see
+    `png2spice.inference.CSPICEnet.predictDense`. OCR reads crops held in
+    memory.
+
+    RETURNS
+    -------
+    `tuple`. `(preds, ocrs)` for the representatives, as `stageClassify()`.
+    """
+    labels, points = list(), list()
+    for label, x, y in lines.cropCenters(HLs, clusters):
+        labels.append(label)
+        points.append((x, y))
+    kwargs = dict() if batchSize is None else {"batchSize": batchSize}
+    with tracing.span("inference.classify", crops=len(points)):
+        preds = model.predsToDict(model.predictDense(img, points, params.imageSliceSizeScaled,
+                                                     params.imgResize, cancel=cancel, **kwargs), labels)
+    if not ocr:
+        return preds, None
+    ocrs = dict()
+    crops = lines.extractLineCrops(img, HLs, params.imageSliceSizeScaled, clusters)
+    with tracing.span("inference.ocr", crops=len(crops)) as sp:
+        for label, crop in crops.items():
+            if cancel is not None and cancel.is_set():
+                raise CancelledError()
+            partOcr = read_part_OCR(crop)
+            if partOcr is not None:
+                ocrs[label] = partOcr
+        sp.count("names", len(ocrs))
+    return preds, ocrs
+
+
+def stageRotate(model, img, HLs, preds: dict, params: CP2SContext, mode: str="all", cancel=None,
+                batchSize: int=None, clusters: lines.CEndpointClusters=None) -> dict:
+    """
+    BRIEF
+    -----
+    Orientation stage. The snapshots of all valid parts with an orientation
+    go through SPICEnet once more, each together with its rotations, see
+    `png2spice.inference.CSPICEnet.predictRotations`.
+
+    PARAMETERS
+    ----------
+    `preds`:
+        `dict`. Predictions per end point label, as returned by the
+        classification stage.
+    `mode`:
+        `str`. One of `ROTATION_MODES`: `"off"`, `"polarized"` (only parts
+        whose terminals are not interchangeable, i.e. diodes) or `"all"`.
+    `clusters`:
+        `png2spice.lines.CEndpointClusters`. End point clusters the
+        classification stage used. Default is to cluster the end points
+        again.
+
+    RETURNS
+    -------
+    `dict`. LTSPICE rotation in degrees per end point label, see
+    `png2spice.graphing.CGraph`.
+
+    NOTES
+    -----
+    A symmetric part looks the same turned by 180 degrees, so SPICEnet can
+    only tell whether it lies horizontally or vertically. In `"all"` mode,
+    the rotations of parts which are not in `POLARIZED_TYPES` are reduced
+    to 0 or 90 degrees.
+    """
+    if mode not in ROTATION_MODES:
+        raise ValueError(f"Invalid rotation mode '{mode}', expected one of {', '.join(ROTATION_MODES)}")
+    if mode == "off":
+        return dict()
+    types = POLARIZED_TYPES if mode == "polarized" else ORIENTED_TYPES
+    winSize = params.imageSliceSizeScaled
+    if clusters is None:
+        clusters = lines.clusterEndpoints(img, HLs, params)
+    reps = dict()
+    for label, pred in preds.items():
+        classifications = list(pred.values())
+        rep = clusters.get(label)
+        if rep is not None and rep not in reps and isValidPOI(classifications) \
+                and pred2Type(classifications) in types:
+            reps[rep] = pred2Type(classifications)
+    if not reps:
+        return dict()
+    crops = [lines.cropImageAtPos(img, *clusters.centers[rep], winSize) for rep in reps]
+    kwargs = dict() if batchSize is None else {"batchSize": batchSize}
+    _, degrees = model.predictRotations(crops, params.imgResize, cancel=cancel, **kwargs)
+    rotations = dict()
+    for (rep, typ), deg in zip(reps.items(), degrees):
+        rotations[rep] = deg if typ in POLARIZED_TYPES else deg % 180
+    return lines.expandClusters(rotations, clusters)
+
+
+def stageGraph(HLs, preds: dict, ocrs: dict, params: CP2SContext, rotations: dict=None,
+               partition: bool=False, workers: int=None) -> CGraph:
+    """
+    BRIEF
+    -----
+    Graph building stage. `rotations` are the results of `stageRotate()`.
+    With `partition`, independent regions of the schematic are processed
+    by `workers` processes, see `png2spice.partitioning`.
+    """
+    if partition:
+        return partitioning.partitionedGraph(HLs, preds, ocrs, params, rotations, workers)
+    graph = CGraph(HLs, preds, ocrs, params, rotations)
+    graph.rmDuplicates()
+    graph.link()
+    graph.analyzeRotations()
+    graph.snapToGrid()
+    graph.alignToGrid()
+    graph.extractNets()
+    return graph
+
+
+def stageExport(graph: CGraph, outDir: str=None) -> tuple:
+    """
+    BRIEF
+    -----
+    Parsing and export stage.
+
+    PARAMETERS
+    ----------
+    `graph`:
+        `png2spice.graphing.CGraph`. Processed graph.
+    `outDir`:
+        `str`. If given, `output.asc` and `output.cir` are written there.
+
+    RETURNS
+    -------
+    `tuple`. Content of the `.asc` and of the `.cir` file.
+    """
+    parser = CParser(graph)
+    with tracing.span("parsing.asc") as sp:
+        asc = "\n".join(parser.IterAsc()) + "\n"
+        sp.count("pois", len(parser.graphContents))
+        sp.count("wires", parser.wireCount)
+    with tracing.span("parsing.cir") as sp:
+        cir = "\n".join(parser.IterCir()) + "\n"
+        sp.count("parts", len(parser.nets.components()))
+        sp.count("nets", len(parser.nets.table))
+    if outDir is not None:
+        writeOutputs(outDir, asc, cir)
+    return asc, cir
+
+
+def writeOutputs(outDir: str, asc: str, cir: str):
+    """
+    BRIEF
+    -----
+    Write `output.asc` and `output.cir` into `outDir`.
+    """
+    os.makedirs(outDir, exist_ok=True)
+    with open(join(outDir, "output.asc"), "w") as f:
+        f.write(asc)
+    with open(join(outDir, "output.cir"), "w") as f:
+        f.write(cir)
+
+
+_modelVersions = dict()
+
+
+def modelVersion(model) -> str:
+    """
+    BRIEF
+    -----
+    Get a version string of a SPICEnet model from the content of its
+    `SPICEnet.h5` and `CLASSLIST.json`. The hash is computed once per file
+    state and memoized.
+
+    PARAMETERS
+    ----------
+    `model`:
+        Object with a `path` attribute, usually
+        `png2spice.inference.CSPICEnet`, or `None`.
+
+    RETURNS
+    -------
+    `str`. Hex digest, `"none"` if there is no model and `"unknown"` if its
+    files cannot be read.
+    """
+    if model is None:
+        return "none"
+    path = getattr(model, "path", None)
+    if path is None:
+        return "unknown"
+    files = [join(path, "SPICEnet.h5"), join(path, "CLASSLIST.json")]
+    try:
+        state = tuple((f, os.path.getmtime(f), os.path.getsize(f)) for f in files)
+    except OSError:
+        return "unknown"
+    if state not in _modelVersions:
+        _modelVersions[state] = hashlib.sha1("".join(hashFile(f) for f in files).encode()).hexdigest()
+    return _modelVersions[state]
+
+
+class CStage:
+    def __init__(self, name: str, func, deps: tuple=(), parameters: tuple=(),
+                 options: tuple=(), usesModel: bool=False, version: str="1") -> None:
+        """
+        BRIEF
+        -----
+        A node of the pipeline DAG.
+
+        PARAMETERS
+        ----------
+        `name`:
+            `str`. Unique stage name.
+        `func`:
+            Callable `func(run, *depOutputs)`, where `run` is the `CRun` of
+            the current image and `depOutputs` are the outputs of `deps` in
+            order.
+        `deps`:
+            `tuple`. Names of the stages this stage consumes.
+        `parameters`:
+            `tuple`. **P2S parameters** the stage itself depends on.
+        `options`:
+            `tuple`. Run options (see `CPipeline.run`) the stage depends on.
+        `usesModel`:
+            `bool`. The output depends on the SPICEnet model version.
+        `version`:
+            `str`. Bump whenever the stage's code changes its output.
+        """
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.parameters = tuple(parameters)
+        self.options = tuple(options)
+        self.usesModel = usesModel
+        self.version = version
+
+
+class CRun:
+    def __init__(self, imagePath: str, workDir: str, model, params: CP2SContext,
+                 options: dict, cancel=None, budget: memory.CMemoryBudget=None) -> None:
+        """
+        BRIEF
+        -----
+        State of a single pipeline run, handed to every stage function.
+        `params` carries the estimated scaling factor once the `scaling`
+        stage is resolved, and the scaling factor of the downscaled image
+        if the image is downscaled (option `imageScale`). `keys` holds the
+        checkpoint key of every stage.
+        """
+        self.imagePath = imagePath
+        self.workDir = workDir
+        self.model = model
+        self.params = params
+        self.options = options
+        self.cancel = cancel
+        self.budget = budget
+        self.keys = dict()
+
+
+def _scaling(run: CRun) -> float:
+    if run.params.scalingFactor:
+        return run.params.scalingFactor
+    return estimateScalingFactor(run.imagePath)
+
+
+def _normalize(run: CRun, scaling: float):
+    return stageNormalize(run.imagePath, run.params, run.options["imageScale"])
+
+
+def _lines(run: CRun, img):
+    if run.options["cropStore"]:
+        # The crops are archived by the classification stage
+        return lines.detectLines(img, True, run.params)
+    HLs = stageLines(img, run.workDir, run.params)
+    _markSnapshots(run)
+    return HLs
+
+
+def _markSnapshots(run: CRun):
+    _, snapshotDir = snapshotDirs(run.workDir)
+    with open(join(snapshotDir, ".lines"), "w") as f:
+        f.write(run.keys["lines"])
+
+
+def _classify(run: CRun, img, HLs):
+    clusters = lines.clusterEndpoints(img, HLs, run.params)
+    batchSize = None
+    if run.budget is not None and hasattr(run.model, "inputSize"):
+        batchSize = run.budget.inferenceBatch(run.model.inputSize(run.params.imgResize))
+    if run.options["dense"]:
+        preds, ocrs = stageClassifyDense(run.model, img, HLs, clusters, run.params, run.options["ocr"],
+                                         run.cancel, batchSize)
+        return lines.expandClusters(preds, clusters), lines.expandClusters(ocrs, clusters), clusters
+
+    if run.options["cropStore"]:
+        poiDir, _ = snapshotDirs(run.workDir)
+        os.makedirs(poiDir, exist_ok=True)
+        winSize = run.params.imageSliceSizeScaled
+        source = run.imagePath if isinstance(run.imagePath, str) else None
+        with cropstore.CCropStore(cropstore.storePath(poiDir), 2 * (winSize // 2), "w") as store:
+            store.addLines(img, HLs, winSize, source, run.params.scalingFactor, clusters)
+            preds, ocrs = stageClassifyStore(run.model, store, run.params, run.options["ocr"],
+                                             run.cancel, batchSize)
+        return lines.expandClusters(preds, clusters), lines.expandClusters(ocrs, clusters), clusters
+
+    _, snapshotDir = snapshotDirs(run.workDir)
+    marker = join(snapshotDir, ".lines")
+    current = None
+    if exists(marker):
+        with open(marker) as f:
+            current = f.read()
+    if current != run.keys["lines"]:
+        # The lines come from a checkpoint, their snapshots have to be
+        # recreated in this working directory.
+        if exists(snapshotDir):
+            shutil.rmtree(snapshotDir)
+        os.makedirs(snapshotDir)
+        lines.saveLineCrops(img, HLs, run.params.imageSliceSizeScaled, snapshotDir, clusters)
+        _markSnapshots(run)
+    preds, ocrs = stageClassify(run.model, run.workDir, run.params, run.options["ocr"], run.cancel, batchSize)
+    return lines.expandClusters(preds, clusters), lines.expandClusters(ocrs, clusters), clusters
+
+
+def _rotate(run: CRun, img, HLs, classified):
+    batchSize = None
+    if run.options["rotations"] != "off" and run.budget is not None and hasattr(run.model, "inputSize"):
+        # Every snapshot is classified in four rotations at once
+        batchSize = max(1, run.budget.inferenceBatch(run.model.inputSize(run.params.imgResize)) // 4)
+    preds, _, clusters = classified
+    return stageRotate(run.model, img, HLs, preds, run.params, run.options["rotations"], run.cancel,
+                       batchSize, clusters)
+
+
+def _graph(run: CRun, HLs, classified, rotations):
+    return stageGraph(HLs, classified[0], classified[1], run.params, rotations, run.options["partition"],
+                      run.options["graphWorkers"])
+
+
+def _export(run: CRun, graph):
+    return stageExport(graph)
+
+
+def defaultStages() -> list:
+    """
+    BRIEF
+    -----
+    Get the stages of the regular analysis in topological order. The
+    `version` of a stage has to be bumped with every change of its code
+    that changes its output, or stale checkpoints are reused.
+    """
+    return [
+        CStage("scaling",   _scaling,   (),                      STAGE_PARAMETERS["scaling"]),
+        CStage("normalize", _normalize, ("scaling",),            STAGE_PARAMETERS["normalize"],
+               options=("imageScale",)),
+        CStage("lines",     _lines,     ("normalize",),          STAGE_PARAMETERS["lines"]),
+        # 2: symbol proposals without end points are classified as well
+        # 3: (preds, ocrs, clusters), the clusters are reused by "rotate"
+        CStage("classify",  _classify,  ("normalize", "lines"),  STAGE_PARAMETERS["classify"],
+               options=("ocr", "dense", "cropStore"), usesModel=True, version="3"),
+        # 2: symmetric parts are only turned by 0 or 90 degrees
+        CStage("rotate",    _rotate,    ("normalize", "lines", "classify"), STAGE_PARAMETERS["rotate"],
+               options=("rotations",), usesModel=True, version="2"),
+        CStage("graph",     _graph,     ("lines", "classify", "rotate"), STAGE_PARAMETERS["graph"],
+               options=("partition",)),
+        # 2: placeholder part values are flagged in the .cir
+        # 3: diodes turned by 90 or 180 degrees list their anode first in the .cir
+        CStage("export",    _export,    ("graph",),              STAGE_PARAMETERS["export"], version="3"),
+    ]
+
+
+# graphWorkers does not change any output and is thus not part of a checkpoint key
+DEFAULT_OPTIONS = {"ocr": True, "imageScale": 1.0, "dense": False, "cropStore": False, "rotations": "off",
+                   "partition": False, "graphWorkers": None}
+
+
+class CPipeline:
+    def __init__(self, stages: list=None, cache: CStageCache=None, model=None) -> None:
+        """
+        BRIEF
+        -----
+        DAG of analysis stages with checkpointing.
+
+        PARAMETERS
+        ----------
+        `stages`:
+            `list`. `CStage` objects. Default is `defaultStages()`.
+        `cache`:
+            `CStageCache`. Checkpoint store. Pass one with a path to keep
+            checkpoints across processes and sessions. Default is a
+            memory-only cache.
+        `model`:
+            `png2spice.inference.CSPICEnet`. Loaded model for stages with
+            `usesModel`. It may be set later, it is only needed on a
+            checkpoint miss of such a stage.
+        """
+        self.stages = {s.name: s for s in (defaultStages() if stages is None else stages)}
+        self.cache = CStageCache() if cache is None else cache
+        self.model = model
+
+    def __required(self, targets: tuple) -> list:
+        """
+        BRIEF
+        -----
+        Get the names of `targets` and all their dependencies in topological
+        order.
+        """
+        order, visiting = list(), set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f"Cycle in pipeline at stage '{name}'")
+            if name not in self.stages:
+                raise KeyError(f"Unknown pipeline stage '{name}'")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            visiting.discard(name)
+            order.append(name)
+
+        for t in targets:
+            visit(t)
+        return order
+
+    def keys(self, imageId: str, params: CP2SContext, targets: tuple=("export",),
+             options: dict=None) -> dict:
+        """
+        BRIEF
+        -----
+        Get the checkpoint keys of `targets` and their dependencies without
+        running anything.
+
+        RETURNS
+        -------
+        `dict`. Stage name to hex digest.
+        """
+        options = dict(DEFAULT_OPTIONS, **(options or {}))
+        version = modelVersion(self.model) if any(self.stages[n].usesModel for n in self.__required(targets)) else None
+        keys = dict()
+        for name in self.__required(targets):
+            stage = self.stages[name]
+            payload = [
+                PIPELINE_VERSION, stage.name, stage.version,
+                imageId if not stage.deps else None,
+                [(p, getattr(params, p)) for p in stage.parameters],
+                [(o, options.get(o)) for o in stage.options],
+                version if stage.usesModel else None,
+                [keys[d] for d in stage.deps],
+            ]
+            keys[name] = hashlib.sha1(json.dumps(payload, default=str).encode()).hexdigest()
+        return keys
+
+    def run(self, imagePath: str, workDir: str, params: CP2SContext=None,
+            targets: tuple=("export",), imageId: str=None, options: dict=None,
+            cancel=None, budget: memory.CMemoryBudget=None) -> dict:
+        """
+        BRIEF
+        -----
+        Resolve `targets` for a single image. Stages whose checkpoint exists
+        are loaded instead of run; stages not needed for a checkpointed
+        target are not touched at all.
+
+        PARAMETERS
+        ----------
+        `imagePath`:
+            `Union[str, np.ndarray]`. Path to the schematic image or the
+            image itself as grayscale `uint8` array, e.g. straight from
+            the clipboard. Arrays are never written to disk.
+        `workDir`:
+            `str`. Folder for the POI snapshots of this run.
+        `params`:
+            `png2spice.parameters.CP2SContext`. Parameters of the run. A
+            `scalingFactor` of 0 means it is estimated by OCR. Default is a
+            snapshot of the global `P2SParameters`.
+        `targets`:
+            `tuple`. Stage names to resolve. Default is `("export",)`.
+        `imageId`:
+            `str`. Identifier of the image. Default is `hashImage()`.
+        `options`:
+            `dict`. Run options, see `DEFAULT_OPTIONS`.
+        `cancel`:
+            `threading.Event`. Raise `concurrent.futures.CancelledError`
+            before the next stage once it is set.
+        `budget`:
+            `png2spice.memory.CMemoryBudget`. Memory budget of the run. The
+            image is downscaled (option `imageScale`) and the inference
+            batches are shrunk as far as needed to stay within it, and
+            `png2spice.memory.MemoryBudgetExceeded` is raised if that is not
+            enough. Default is `None` (no limit).
+
+        RETURNS
+        -------
+        `dict`. `outputs` (stage name to output), `keys`, `timings` (seconds
+        per executed or loaded stage), `cached` (names of stages loaded
+        from checkpoints), `memory` (see
+        `png2spice.memory.CStageMemory.asDict`, per executed stage) and
+        `params` (effective parameters).
+
+        NOTES
+        -----
+        On a downscaled image, all positions (and thus the `.asc` output)
+        are in the coordinates of the downscaled image.
+        """
+        params = getContext(params)
+        options = dict(DEFAULT_OPTIONS, **(options or {}))
+        imageId = hashImage(imagePath) if imageId is None else imageId
+        run = CRun(imagePath, workDir, self.model, params, options, cancel, budget)
+        run.keys = self.keys(imageId, params, targets, options)
+        outputs, timings, cached, memoryStats = dict(), dict(), list(), dict()
+        if budget is not None:
+            budget.start()
+
+        def resolve(name):
+            if name in outputs:
+                return outputs[name]
+            key = run.keys[name]
+            t = time.perf_counter()
+            with tracing.span("checkpoint." + name) as sp:
+                value = self.cache.get(key, _MISSING)
+                sp.count("hits", value is not _MISSING)
+            if value is not _MISSING:
+                cached.append(name)
+            else:
+                depOutputs = [resolve(d) for d in self.stages[name].deps]
+                if cancel is not None and cancel.is_set():
+                    raise CancelledError()
+                if budget is not None:
+                    budget.check(name)
+                t = time.perf_counter()
+                with tracing.span("stage." + name), memory.CStageMemory(budget is not None) as mem:
+                    value = self.stages[name].func(run, *depOutputs)
+                memoryStats[name] = mem.asDict()
+                self.cache.put(key, value)
+            timings[name] = time.perf_counter() - t
+            outputs[name] = value
+            if name == "scaling":
+                run.params = run.params.replace(scalingFactor=value)
+            return value
+
+        if "scaling" in run.keys:
+            resolve("scaling")
+        scale = options["imageScale"]
+        if budget is not None and "normalize" in run.keys:
+            scale = min(scale, budget.imageScale(imageShape(imagePath), run.params))
+        if scale != options["imageScale"]:
+            options["imageScale"] = scale
+            run.keys = self.keys(imageId, params, targets, options)
+        if scale != 1.0:
+            run.params = run.params.replace(scalingFactor=run.params.scalingFactor * scale)
+        for t in targets:
+            resolve(t)
+        return {"outputs": outputs, "keys": run.keys, "timings": timings,
+                "cached": cached, "memory": memoryStats, "params": run.params}
+
+
+_MISSING = object()
+
+
+def stageKey(stage: str, imageId: str, params: CP2SContext, options: dict=None) -> str:
+    """
+    BRIEF
+    -----
+    Get the checkpoint key of a stage of the default pipeline, see
+    `CPipeline.keys`. The model version is not part of this key.
+    """
+    return CPipeline().keys(imageId, params, (stage,), options)[stage]
+
+
+def runCached(imagePath: str, workDir: str, model, params: CP2SContext=None,
+              cache: CStageCache=None, imageId: str=None, ocr: bool=True) -> dict:
+    """
+    BRIEF
+    -----
+    Resolve all stages up to the graph for a single image using the
+    checkpoints in `cache`.
+
+    PARAMETERS
+    ----------
+    `imagePath`:
+        `Union[str, np.ndarray]`. Path to the schematic image or grayscale
+        image data, see `CPipeline.run`.
+    `workDir`:
+        `str`. Folder for the POI snapshots of this run.
+    `model`:
+        `png2spice.inference.CSPICEnet`. Loaded model. Only used on a
+        checkpoint miss of the classification stage.
+    `params`:
+        `png2spice.parameters.CP2SContext`. Parameters of the run.
+    `cache`:
+        `CStageCache`. Default is `None` (a throw-away cache).
+    `imageId`:
+        `str`. Identifier of the image. Default is the hash of the file.
+    `ocr`:
+        `bool`. Perform OCR in the classification stage.
+
+    RETURNS
+    -------
+    `dict`. Outputs per stage name.
+    """
+    res = CPipeline(cache=cache, model=model).run(imagePath, workDir, params, ("graph",),
+                                                  imageId, {"ocr": ocr})
+    return res["outputs"]
+
+
+def runImage(imagePath: str, workDir: str, model, params: CP2SContext=None,
+             outDir: str=None, ocr: bool=True, cache: CStageCache=None,
+             budget: memory.CMemoryBudget=None, dense: bool=False, cropStore: bool=False,
+             rotations: str="off", graphWorkers: int=0) -> dict:
+    """
+    BRIEF
+    -----
+    Run all stages for a single image and time them.
+
+    PARAMETERS
+    ----------
+    `imagePath`:
+        `Union[str, np.ndarray]`. Path to the schematic image or grayscale
+        image data, see `CPipeline.run`.
+    `workDir`:
+        `str`. Folder for the POI snapshots of this run.
+    `model`:
+        `png2spice.inference.CSPICEnet`. Loaded model.
+    `params`:
+        `png2spice.parameters.CP2SContext`. Parameters of the run. If it is
+        omitted or its `scalingFactor` is 0, the scaling factor is estimated
+        by OCR.
+    `outDir`:
+        `str`. Destination of `output.asc` and `output.cir`. Default is
+        `None` (nothing is written).
+    `ocr`:
+        `bool`. Perform OCR in the classification stage.
+    `cache`:
+        `CStageCache`. Checkpoints to reuse. Default is `None` (all stages
+        run from scratch).
+    `budget`:
+        `png2spice.memory.CMemoryBudget`. See `CPipeline.run`.
+    `dense`:
+        `bool`. Run SPICEnet densely over the image instead of per
+        snapshot, see `stageClassifyDense()`.
+    `cropStore`:
+        `bool`. Keep the POI snapshots in one crop archive
+        (`POIs/crops.p2s`) instead of `.png` files, see
+        `png2spice.cropstore`.
+    `rotations`:
+        `str`. Infer the orientation of the parts with SPICEnet, see
+        `stageRotate()`. Default is `"off"` (derived from the terminals).
+    `graphWorkers`:
+        `int`. Build the graph on independent regions in this many worker
+        processes, see `png2spice.partitioning`. Default is 0 (one flat
+        graph).
+
+    RETURNS
+    -------
+    `dict`. `params`, `lines`, `preds`, `ocrs`, `graph`, `asc`, `cir`,
+    `timings` (seconds per stage), `memory` (per stage) and `cached`
+    (stages loaded from checkpoints).
+    """
+    # Every stage read below is a target, a checkpoint of a later stage
+    # would otherwise skip it
+    res = CPipeline(cache=cache, model=model).run(imagePath, workDir, params,
+                                                  ("lines", "classify", "graph", "export"),
+                                                  options={"ocr": ocr, "dense": dense, "cropStore": cropStore,
+                                                           "rotations": rotations, "partition": graphWorkers > 0,
+                                                           "graphWorkers": graphWorkers},
+                                                  budget=budget)
+    out = res["outputs"]
+    asc, cir = out["export"]
+    if outDir is not None:
+        writeOutputs(outDir, asc, cir)
+    preds, ocrs, _ = out["classify"]
+    return {"params": res["params"], "lines": out["lines"], "preds": preds, "ocrs": ocrs,
+            "graph": out["graph"], "asc": asc, "cir": cir,
+            "timings": res["timings"], "memory": res["memory"], "cached": res["cached"]}
@@ -0,0 +1,334 @@
+"""
+This submodule of **png2spice** offers conversions through a local HTTP
+endpoint. The CPU-bound stages (scaling, normalization, lines, crops and
+OCR) of every request run in a process pool. The crops of concurrent
+requests are then coalesced into shared SPICEnet batches by a single
+inference thread (`CMicroBatcher`), which waits at most a configurable
+time for further requests before running a batch.
+
+Usage:
+    python service.py --model ../SPICEnet --port 8350
+    curl --data-binary @schematic.png http://127.0.0.1:8350/convert > output.asc
+
+`POST /convert` takes the raw image bytes as body and returns the `.asc`
+content. `?format=cir` returns the SPICE netlist instead, `?ocr=0` skips
+OCR of part names. `GET /health` returns batching statistics as JSON. A
+request whose predictions do not arrive within `--timeout` seconds fails
+with 503.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import cv2
+import numpy as np
+
+import lines
+import pipeline
+from ocrtools import read_part_OCR
+from parameters import P2SParameters
+
+# Seconds a request waits for its SPICEnet predictions before it fails with 503
+DEFAULT_INFERENCE_TIMEOUT = 60.0
+
+
+def prepareRequest(imageBytes: bytes, ocr: bool=True) -> dict:
+    """
+    BRIEF
+    -----
+    Run the CPU stages for one request: decode, estimate the scaling,
+    normalize, detect lines, crop the POIs and read them by OCR. Runs in a
+    worker process.
+
+    PARAMETERS
+    ----------
+    `imageBytes`:
+        `bytes`. Encoded image, any format `cv2.imdecode` understands.
+    `ocr`:
+        `bool`. Read part names from the crops.
+
+    RETURNS
+    -------
+    `dict`. `params`, `lines`, `labels`, `clusters`, `crops` (in label
+    order) and `ocrs`. Only the representatives of the end point clusters
+    are cropped and read, see `png2spice.lines.clusterEndpoints()`.
+    """
+    gray = cv2.imdecode(np.frombuffer(imageBytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError("Request body is not a decodable image")
+    params = P2SParameters.freeze()
+    if not params.scalingFactor:
+        params = params.replace(scalingFactor=pipeline.estimateScalingFactor(gray))
+    img = lines.normalizeImageData(gray, params)
+    HLs = lines.detectLines(img, True, params)
+    clusters = lines.clusterEndpoints(img, HLs, params)
+    crops = lines.extractLineCrops(img, HLs, params.imageSliceSizeScaled, clusters)
+    labels = list(crops.keys())
+    ocrs = dict()
+    if ocr:
+        for label in labels:
+            partOcr = read_part_OCR(crops[label])
+            if partOcr != None:
+                ocrs[label] = partOcr
+    return {"params": params, "lines": HLs, "labels": labels, "clusters": clusters,
+            "crops": [np.ascontiguousarray(crops[l]) for l in labels], "ocrs": ocrs}
+
+
+class CMicroBatcher:
+    def __init__(self, model, maxBatch: int=64, maxWait: float=0.02) -> None:
+        """
+        BRIEF
+        -----
+        Collect crops of concurrent requests into shared SPICEnet batches.
+        All inference runs on one thread owned by this object.
+
+        PARAMETERS
+        ----------
+        `model`:
+            `png2spice.inference.CSPICEnet`. Loaded model.
+        `maxBatch`:
+            `int`. Number of crops after which a batch runs without waiting
+            any longer. Larger requests are split into batches of this size.
+        `maxWait`:
+            `float`. Seconds to wait for further requests after the first one
+            of a batch arrived.
+        """
+        self.model = model
+        self.maxBatch = maxBatch
+        self.maxWait = maxWait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.stats = {"batches": 0, "requests": 0, "crops": 0, "busySeconds": 0.0}
+        self.thread = threading.Thread(target=self.__loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, crops: list, imgResize: int) -> Future:
+        """
+        BRIEF
+        -----
+        Queue the crops of one request.
+
+        RETURNS
+        -------
+        `concurrent.futures.Future`. Resolves to the raw predictions of
+        shape `(len(crops), nClasses)`.
+        """
+        future = Future()
+        if not crops:
+            future.set_result(np.zeros((0, len(self.model.classlist))))
+            return future
+        self.queue.put((crops, imgResize, future))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def __loop(self):
+        running = True
+        while running:
+            first = self.queue.get()
+            if first is None:
+                break
+            pending = [first]
+            count = len(first[0])
+            deadline = time.monotonic() + self.maxWait
+            while count < self.maxBatch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                pending.append(item)
+                count += len(item[0])
+            self.__run(pending)
+
+    def __run(self, pending: list):
+        """
+        BRIEF
+        -----
+        Run the pending requests, grouped by network input size, and hand
+        every request its slice of the predictions.
+        """
+        groups = dict()
+        for item in pending:
+            try:
+                groups.setdefault(self.model.inputSize(item[1]), []).append(item)
+            except Exception as e:
+                self.__fail([item], e)
+        for items in groups.values():
+            # Any error has to reach the waiting requests; it must not end
+            # the batcher thread
+            try:
+                self.__runGroup(items)
+            except Exception as e:
+                self.__fail(items, e)
+
+    def __runGroup(self, items: list):
+        allCrops = [c for crops, _, _ in items for c in crops]
+        t = time.perf_counter()
+        preds = self.model.predictArrays(allCrops, items[0][1], self.maxBatch)
+        with self.lock:
+            self.stats["batches"] += -(-len(allCrops) // self.maxBatch)
+            self.stats["requests"] += len(items)
+            self.stats["crops"] += len(allCrops)
+            self.stats["busySeconds"] += time.perf_counter() - t
+        start = 0
+        for crops, _, future in items:
+            future.set_result(preds[start:start + len(crops)])
+            start += len(crops)
+
+    @staticmethod
+    def __fail(items: list, error: Exception):
+        for _, _, future in items:
+            if not future.done():
+                future.set_exception(error)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+        stats["meanBatchSize"] = stats["crops"] / stats["batches"] if stats["batches"] else 0.0
+        stats["queued"] = self.queue.qsize()
+        return stats
+
+
+class CConversionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple, model, workers: int=os.cpu_count(),
+                 maxBatch: int=64, maxWait: float=0.02, inferenceTimeout: float=DEFAULT_INFERENCE_TIMEOUT) -> None:
+        """
+        BRIEF
+        -----
+        HTTP server converting schematic images to `.asc`/`.cir`.
+
+        PARAMETERS
+        ----------
+        `address`:
+            `tuple`. `(host, port)` to bind to.
+        `model`:
+            `png2spice.inference.CSPICEnet`. Loaded model.
+        `workers`:
+            `int`. Size of the process pool for the CPU stages.
+        `maxBatch`, `maxWait`:
+            See `CMicroBatcher`.
+        `inferenceTimeout`:
+            `float`. Seconds a request waits for its predictions before it
+            fails with 503.
+        """
+        super().__init__(address, _Handler)
+        self.model = model
+        self.inferenceTimeout = inferenceTimeout
+        # Spawned workers do not inherit the initialized tensorflow runtime
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.batcher = CMicroBatcher(model, maxBatch, maxWait)
+
+    def convert(self, imageBytes: bytes, ocr: bool=True) -> tuple:
+        """
+        BRIEF
+        -----
+        Convert one image. Called concurrently from the request threads.
+
+        RETURNS
+        -------
+        `tuple`. Content of the `.asc` and of the `.cir` file.
+
+        NOTES
+        -----
+        Raises `concurrent.futures.TimeoutError` if the predictions take
+        longer than `inferenceTimeout`.
+        """
+        prep = self.pool.submit(prepareRequest, imageBytes, ocr).result()
+        future = self.batcher.submit(prep["crops"], prep["params"].imgResize)
+        preds = future.result(timeout=self.inferenceTimeout)
+        predDict = lines.expandClusters(self.model.predsToDict(preds, prep["labels"]), prep["clusters"])
+        ocrs = lines.expandClusters(prep["ocrs"], prep["clusters"])
+        graph = pipeline.stageGraph(prep["lines"], predDict, ocrs, prep["params"])
+        return pipeline.stageExport(graph)
+
+    def server_close(self):
+        super().server_close()
+        self.batcher.close()
+        self.pool.shutdown()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def __reply(self, code: int, body: str, contentType: str="text/plain; charset=utf-8"):
+        data = body.encode()
+        self.send_response(code)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            self.__reply(404, "Not found\n")
+            return
+        self.__reply(200, json.dumps(self.server.batcher.snapshot()), "application/json")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/convert":
+            self.__reply(404, "Not found\n")
+            return
+        query = parse_qs(url.query)
+        ocr = query.get("ocr", ["1"])[0] not in ("0", "false", "no")
+        fmt = query.get("format", ["asc"])[0]
+        if fmt not in ("asc", "cir"):
+            self.__reply(400, "format has to be asc or cir\n")
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            asc, cir = self.server.convert(body, ocr)
+        except ValueError as e:
+            self.__reply(400, f"{e}\n")
+            return
+        except FutureTimeoutError:
+            self.__reply(503, "SPICEnet did not answer in time\n")
+            return
+        except Exception as e:
+            self.__reply(500, f"{type(e).__name__}: {e}\n")
+            return
+        self.__reply(200, asc if fmt == "asc" else cir)
+
+
+def main(argv: list=None):
+    ap = argparse.ArgumentParser(description="Serve png2spice conversions over local HTTP.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8350)
+    ap.add_argument("--model", default="SPICEnet", help="Folder containing SPICEnet.h5 and CLASSLIST.json.")
+    ap.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes for the CPU stages.")
+    ap.add_argument("--max-batch", type=int, default=64, help="Crops per shared SPICEnet batch.")
+    ap.add_argument("--max-wait-ms", type=float, default=20, help="Time to wait for further requests per batch.")
+    ap.add_argument("--timeout", type=float, default=DEFAULT_INFERENCE_TIMEOUT,
+                    help="Seconds a request waits for SPICEnet before it fails with 503.")
+    args = ap.parse_args(argv)
+
+    from inference import CSPICEnet
+    server = CConversionServer((args.host, args.port), CSPICEnet(args.model),
+                               args.workers, args.max_batch, args.max_wait_ms / 1000, args.timeout)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
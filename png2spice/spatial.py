@@ -0,0 +1,136 @@
+"""
+This submodule of **png2spice** provides a uniform-grid spatial index for
+points in image coordinates. It is used wherever the graph needs the
+neighbourhood of a position without scanning all POIs or lines.
+"""
+
+import math
+from typing import Hashable, List, Tuple
+
+
+class CSpatialIndex:
+    def __init__(self, cellSize: float) -> None:
+        """
+        BRIEF
+        -----
+        Create an empty spatial index. Items are hashed into square cells
+        and additionally into row and column bands of the same size, which
+        allows both radius queries and axis-band queries.
+
+        PARAMETERS
+        ----------
+        `cellSize`:
+            `float`. Edge length of a cell in pixels. Queries are cheapest if
+            the radius is in the order of the cell size.
+        """
+        self.cellSize = max(float(cellSize), 1.0)
+        self.cells = dict()
+        self.cols = dict()
+        self.rows = dict()
+        self.positions = dict()
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __contains__(self, item: Hashable) -> bool:
+        return item in self.positions
+
+    def __cell(self, pos: Tuple[float, float]) -> Tuple[int, int]:
+        return (int(pos[0] // self.cellSize), int(pos[1] // self.cellSize))
+
+    def insert(self, item: Hashable, pos) -> None:
+        """
+        BRIEF
+        -----
+        Add `item` at position `pos`. An item that is already present is
+        moved instead.
+        """
+        if item in self.positions:
+            self.remove(item)
+        pos = (float(pos[0]), float(pos[1]))
+        cx, cy = self.__cell(pos)
+        self.positions[item] = pos
+        self.cells.setdefault((cx, cy), set()).add(item)
+        self.cols.setdefault(cx, set()).add(item)
+        self.rows.setdefault(cy, set()).add(item)
+
+    def remove(self, item: Hashable) -> None:
+        """
+        BRIEF
+        -----
+        Remove `item` from the index. Unknown items are ignored.
+        """
+        pos = self.positions.pop(item, None)
+        if pos is None:
+            return
+        cx, cy = self.__cell(pos)
+        for bucket, key in ((self.cells, (cx, cy)), (self.cols, cx), (self.rows, cy)):
+            bucket[key].discard(item)
+            if not bucket[key]:
+                del bucket[key]
+
+    def move(self, item: Hashable, pos) -> None:
+        """
+        BRIEF
+        -----
+        Update the position of `item`.
+        """
+        self.insert(item, pos)
+
+    def query(self, pos, radius: float) -> List[Hashable]:
+        """
+        BRIEF
+        -----
+        Get all items strictly closer than `radius` to `pos`.
+
+        PARAMETERS
+        ----------
+        `pos`:
+            Center of the query as x/y coordinates.
+        `radius`:
+            `float`. Euclidean search radius in pixels.
+
+        RETURNS
+        -------
+        `list`. Items within the radius in no particular order.
+        """
+        x, y = float(pos[0]), float(pos[1])
+        reach = int(math.ceil(radius / self.cellSize))
+        cx, cy = self.__cell((x, y))
+        found = list()
+        for i in range(cx - reach, cx + reach + 1):
+            for j in range(cy - reach, cy + reach + 1):
+                for item in self.cells.get((i, j), ()):
+                    if math.dist((x, y), self.positions[item]) < radius:
+                        found.append(item)
+        return found
+
+    def queryBand(self, axis: int, value: float, margin: float) -> List[Hashable]:
+        """
+        BRIEF
+        -----
+        Get all items whose coordinate on `axis` is strictly closer than
+        `margin` to `value`, regardless of the other coordinate.
+
+        PARAMETERS
+        ----------
+        `axis`:
+            `int`. 0 for x (column band), 1 for y (row band).
+        `value`:
+            `float`. Coordinate on `axis`.
+        `margin`:
+            `float`. Half width of the band in pixels.
+
+        RETURNS
+        -------
+        `list`. Items within the band in no particular order.
+        """
+        bands = self.cols if axis == 0 else self.rows
+        reach = int(math.ceil(margin / self.cellSize))
+        c = int(float(value) // self.cellSize)
+        found = list()
+        for i in range(c - reach, c + reach + 1):
+            for item in bands.get(i, ()):
+                if abs(self.positions[item][axis] - float(value)) < margin:
+                    found.append(item)
+        return found
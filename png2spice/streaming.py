@@ -0,0 +1,316 @@
+"""
+This submodule of **png2spice** converts a stream of images with the stages
+running concurrently. Instead of finishing one image before starting the
+next, images flow through bounded queues between four stages, each served by
+its own threads:
+
+- `prepare`: decoding, scaling estimation, normalization, lines and crops
+  (CPU-bound, `cv2` releases the GIL)
+- `classify`: SPICEnet inference (`tensorflow`-bound, one thread)
+- `ocr`: reading part names (bound by the tesseract subprocesses)
+- `export`: graph building, `.asc`/`.cir` export
+
+While image k is classified, the lines of image k+1 and the OCR of image k-1
+run, so the sustained throughput approaches that of the slowest stage. The
+bounded queues keep the number of images in flight, and thus the memory,
+limited. `CStreamingPipeline.stats()` reports the queue depth and the
+occupancy of every stage, which shows where the bottleneck is.
+
+    stream = CStreamingPipeline(CSPICEnet("../SPICEnet"))
+    for job in stream.process(images, outDirs):
+        print(job["image"], job["error"])
+    print(stream.stats())
+"""
+
+import queue
+import threading
+import time
+import traceback
+
+import lines
+import pipeline
+from ocrtools import read_part_OCR
+from parameters import CP2SContext, getContext
+
+STREAM_STAGES = ("prepare", "classify", "ocr", "export")
+
+_DONE = object()
+
+
+class CMeteredQueue(queue.Queue):
+    def __init__(self, maxsize: int=0) -> None:
+        """
+        BRIEF
+        -----
+        `queue.Queue` which records its depth over time.
+        """
+        super().__init__(maxsize)
+        self.meterLock = threading.Lock()
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.area = 0.0
+        self.maxDepth = 0
+
+    def __account(self, delta: int):
+        with self.meterLock:
+            now = time.perf_counter()
+            depth = self.qsize()
+            self.area += (depth - delta) * (now - self.last)
+            self.last = now
+            self.maxDepth = max(self.maxDepth, depth)
+
+    def put(self, item, block: bool=True, timeout: float=None):
+        super().put(item, block, timeout)
+        self.__account(1)
+
+    def get(self, block: bool=True, timeout: float=None):
+        item = super().get(block, timeout)
+        self.__account(-1)
+        return item
+
+    def stats(self) -> dict:
+        """
+        RETURNS
+        -------
+        `dict`. Current `depth`, `maxDepth`, time-averaged `meanDepth` and
+        `capacity` (0 is unbounded).
+        """
+        with self.meterLock:
+            now = time.perf_counter()
+            depth = self.qsize()
+            area = self.area + depth * (now - self.last)
+            elapsed = now - self.start
+            return {"depth": depth, "maxDepth": self.maxDepth,
+                    "meanDepth": area / elapsed if elapsed else 0.0, "capacity": self.maxsize}
+
+
+class CStreamStage:
+    def __init__(self, name: str, func, workers: int, inQueue: CMeteredQueue, outQueue: CMeteredQueue) -> None:
+        """
+        BRIEF
+        -----
+        One stage of a `CStreamingPipeline`: `workers` threads take jobs
+        from `inQueue`, apply `func` and pass them on to `outQueue`. Jobs
+        that failed in an earlier stage are passed on untouched.
+
+        PARAMETERS
+        ----------
+        `name`:
+            `str`. Name of the stage.
+        `func`:
+            Function modifying a job `dict` in place.
+        `workers`:
+            `int`. Number of threads.
+        `inQueue`, `outQueue`:
+            `CMeteredQueue`. Queues before and after the stage.
+        """
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.inQueue = inQueue
+        self.outQueue = outQueue
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busySeconds = 0.0
+        self.running = 0
+        self.threads = list()
+
+    def start(self, downstreamWorkers: int):
+        """
+        BRIEF
+        -----
+        Start the worker threads. The last thread to stop hands one stop
+        marker to each of the `downstreamWorkers`.
+        """
+        self.running = self.workers
+        for _ in range(self.workers):
+            t = threading.Thread(target=self.__loop, args=(downstreamWorkers,), daemon=True,
+                                 name=f"png2spice-{self.name}")
+            t.start()
+            self.threads.append(t)
+
+    def __loop(self, downstreamWorkers: int):
+        while True:
+            job = self.inQueue.get()
+            if job is _DONE:
+                break
+            if job["error"] is None:
+                t = time.perf_counter()
+                try:
+                    self.func(job)
+                except Exception as e:
+                    job["error"] = f"{type(e).__name__}: {e}"
+                    job["traceback"] = traceback.format_exc()
+                seconds = time.perf_counter() - t
+                job["timings"][self.name] = seconds
+                with self.lock:
+                    self.items += 1
+                    self.busySeconds += seconds
+            self.outQueue.put(job)
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last:
+            for _ in range(downstreamWorkers):
+                self.outQueue.put(_DONE)
+
+
+class CStreamingPipeline:
+    def __init__(self, model, params: CP2SContext=None, ocr: bool=True, queueSize: int=2,
+                 prepareWorkers: int=2, ocrWorkers: int=2, exportWorkers: int=1) -> None:
+        """
+        BRIEF
+        -----
+        Convert images with all stages running concurrently.
+
+        PARAMETERS
+        ----------
+        `model`:
+            `png2spice.inference.CSPICEnet`. Loaded model. Only used by the
+            single `classify` thread.
+        `params`:
+            `png2spice.parameters.CP2SContext`. Parameters of all images. A
+            `scalingFactor` of 0 means it is estimated per image. Default is
+            a snapshot of the global `P2SParameters`.
+        `ocr`:
+            `bool`. Read part names by OCR.
+        `queueSize`:
+            `int`. Capacity of every queue between two stages. Together
+            with the workers, it bounds the number of images in flight.
+        `prepareWorkers`, `ocrWorkers`, `exportWorkers`:
+            `int`. Threads of the respective stages.
+        """
+        self.model = model
+        self.params = getContext(params)
+        self.ocr = ocr
+        self.queueSize = queueSize
+        self.workers = {"prepare": prepareWorkers, "classify": 1, "ocr": ocrWorkers, "export": exportWorkers}
+        self.stages = list()
+        self.queues = list()
+        self.wallSeconds = 0.0
+        self.images = 0
+
+    def _prepare(self, job: dict):
+        params = job["params"]
+        gray = lines.imageDataFromPath(job["image"]) if isinstance(job["image"], str) else job["image"]
+        if gray is None:
+            raise ValueError(f"Cannot read image {job['image']}")
+        if not params.scalingFactor:
+            params = params.replace(scalingFactor=pipeline.estimateScalingFactor(gray))
+        img = lines.normalizeImageData(gray, params)
+        HLs = lines.detectLines(img, True, params)
+        clusters = lines.clusterEndpoints(img, HLs, params)
+        job["params"] = params
+        job["lines"] = HLs
+        job["clusters"] = clusters
+        job["crops"] = lines.extractLineCrops(img, HLs, params.imageSliceSizeScaled, clusters)
+
+    def _classify(self, job: dict):
+        labels = list(job["crops"].keys())
+        preds = self.model.predictArrays([job["crops"][l] for l in labels], job["params"].imgResize)
+        job["preds"] = self.model.predsToDict(preds, labels)
+
+    def _ocr(self, job: dict):
+        if not self.ocr:
+            job["ocrs"] = None
+            return
+        ocrs = dict()
+        for label, crop in job["crops"].items():
+            partOcr = read_part_OCR(crop)
+            if partOcr != None:
+                ocrs[label] = partOcr
+        job["ocrs"] = ocrs
+
+    def _export(self, job: dict):
+        job["crops"] = None
+        preds = lines.expandClusters(job["preds"], job["clusters"])
+        ocrs = lines.expandClusters(job["ocrs"], job["clusters"])
+        job["graph"] = pipeline.stageGraph(job["lines"], preds, ocrs, job["params"])
+        job["asc"], job["cir"] = pipeline.stageExport(job["graph"], job["outDir"])
+
+    def process(self, images: list, outDirs: list=None):
+        """
+        BRIEF
+        -----
+        Convert `images`, yielding every job as soon as it left the last
+        stage (not necessarily in input order).
+
+        PARAMETERS
+        ----------
+        `images`:
+            `list`. Paths to images or grayscale image data.
+        `outDirs`:
+            `list`. Destination of `output.asc` and `output.cir` per image.
+            Default is `None` (nothing is written).
+
+        RETURNS
+        -------
+        Generator of `dict`. `image`, `outDir`, `error` (`None` or the
+        message), `timings` (seconds per stage), `params`, `lines`,
+        `preds`, `ocrs`, `graph`, `asc` and `cir`.
+        """
+        images = list(images)
+        outDirs = [None] * len(images) if outDirs is None else list(outDirs)
+        self.wallSeconds = 0.0
+        self.images = 0
+        funcs = {"prepare": self._prepare, "classify": self._classify, "ocr": self._ocr, "export": self._export}
+        self.queues = [CMeteredQueue(self.queueSize) for _ in STREAM_STAGES] + [CMeteredQueue()]
+        self.stages = [CStreamStage(name, funcs[name], self.workers[name], self.queues[i], self.queues[i + 1])
+                       for i, name in enumerate(STREAM_STAGES)]
+        for i, stage in enumerate(self.stages):
+            downstream = self.stages[i + 1].workers if i + 1 < len(self.stages) else 1
+            stage.start(downstream)
+
+        def feed():
+            for image, outDir in zip(images, outDirs):
+                self.queues[0].put({"image": image, "outDir": outDir, "params": self.params,
+                                    "error": None, "timings": dict()})
+            for _ in range(self.stages[0].workers):
+                self.queues[0].put(_DONE)
+
+        t = time.perf_counter()
+        feeder = threading.Thread(target=feed, daemon=True, name="png2spice-feed")
+        feeder.start()
+        try:
+            while True:
+                job = self.queues[-1].get()
+                if job is _DONE:
+                    break
+                self.images += 1
+                yield job
+        finally:
+            self.wallSeconds += time.perf_counter() - t
+        feeder.join()
+
+    def stats(self) -> dict:
+        """
+        BRIEF
+        -----
+        Get the metrics of the last `process()` call.
+
+        RETURNS
+        -------
+        `dict`. `images`, `wallSeconds`, `throughput` (images per second),
+        `bottleneck` (the stage with the highest occupancy) and `stages`:
+        stage name to `workers`, `items`, `busySeconds`, `occupancy` (busy
+        share of the wall time of all its workers) and `queue` (the input
+        queue of the stage, see `CMeteredQueue.stats`).
+        """
+        stages = dict()
+        for stage in self.stages:
+            with stage.lock:
+                busy, items = stage.busySeconds, stage.items
+            stages[stage.name] = {
+                "workers": stage.workers,
+                "items": items,
+                "busySeconds": busy,
+                "occupancy": busy / (stage.workers * self.wallSeconds) if self.wallSeconds else 0.0,
+                "queue": stage.inQueue.stats(),
+            }
+        return {
+            "images": self.images,
+            "wallSeconds": self.wallSeconds,
+            "throughput": self.images / self.wallSeconds if self.wallSeconds else 0.0,
+            "bottleneck": max(stages, key=lambda n: stages[n]["occupancy"]) if stages else None,
+            "stages": stages,
+        }
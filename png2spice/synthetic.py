@@ -0,0 +1,384 @@
+"""
+This submodule of **png2spice** renders synthetic schematics of arbitrary
+size together with their ground truth, to stress-test the pipeline far
+beyond the images in `testSchematicsPNG`.
+
+The layout is a ladder: every row is a horizontal chain of parts between a
+left and a right rail, the rails are vertical wires joining the rows, some
+rail segments on the right carry a vertical part, and GND symbols hang below
+the bottom row. Parts are labelled (`R1`, `C4`, ...) with a value below them.
+The ground truth is the list of POIs with their links in the form produced
+by `png2spice.graphing.CGraph`, so it can be exported with
+`png2spice.parsing.CParser` and compared with `png2spice.tuning.scoreAsc`.
+
+Usage:
+    python synthetic.py -n 10 100 1000 10000 -o synth --pitch 144
+    python benchmark.py --images synth --no-ocr --scaling <scaling> ...
+
+The suggested scaling factor for every size is written to the `.json` file
+of the schematic.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+from os.path import join
+
+import cv2
+import numpy as np
+
+from POI import POI, POITypes
+from parameters import P2SParameters
+from parsing import CParser
+
+PARTS = (POITypes.Resistor, POITypes.Capacitor, POITypes.Inductor, POITypes.Diode)
+PREFIXES = {POITypes.Resistor: "R", POITypes.Capacitor: "C", POITypes.Inductor: "L", POITypes.Diode: "D"}
+VALUES = {
+    POITypes.Resistor: ("100", "1k", "4.7k", "10k", "47k"),
+    POITypes.Capacitor: ("10p", "100n", "1u", "10u"),
+    POITypes.Inductor: ("1u", "10u", "1m"),
+    POITypes.Diode: ("D",),
+}
+DEFAULT_MIX = {POITypes.Resistor: 4, POITypes.Capacitor: 3, POITypes.Inductor: 2, POITypes.Diode: 1}
+
+
+class CSyntheticSchematic:
+    def __init__(self, n: int, grounds: int=1, mix: dict=None, pitch: int=144,
+                 verticalShare: float=0.1, lineWidth: int=3, seed: int=0) -> None:
+        """
+        BRIEF
+        -----
+        Lay out a synthetic schematic. Rendering is done in `render()`.
+
+        PARAMETERS
+        ----------
+        `n`:
+            `int`. Number of parts (resistors, capacitors, inductors and
+            diodes).
+        `grounds`:
+            `int`. Number of GND symbols, at least 1.
+        `mix`:
+            `dict`. Relative frequency per part type. Default is
+            `DEFAULT_MIX`.
+        `pitch`:
+            `int`. Distance between neighbouring parts in pixels. A part
+            symbol is half as long, labels scale with it.
+        `verticalShare`:
+            `float`. Share of parts placed vertically on the right rail.
+        `lineWidth`:
+            `int`. Stroke width in pixels.
+        `seed`:
+            `int`. Seed for types, values and placement.
+
+        NOTES
+        -----
+        Positions of the ground truth are pixel coordinates of the rendered
+        image. The pipeline works on the padded image, so `asc()` takes the
+        padding as offset.
+        """
+        self.n = n
+        self.pitch = pitch
+        self.lineWidth = lineWidth
+        self.partLength = pitch // 2
+        self.rng = random.Random(seed)
+        mix = mix or DEFAULT_MIX
+        self.types = self.rng.choices(list(mix.keys()), weights=list(mix.values()), k=n)
+
+        cols = max(1, math.ceil(math.sqrt(n)))
+        rows = max(1, math.ceil(n / cols))
+        nVertical = min(rows - 1, int(round(n * verticalShare)))
+        rows = max(1, math.ceil((n - nVertical) / cols))
+        nVertical = min(nVertical, rows - 1, n)
+        self.rows = rows
+        self.cols = cols
+
+        self.pois = list()
+        self.wires = list()
+        self.junctions = list()
+        self.counters = dict()
+        self.partCount = 0
+        self.__layout(n - nVertical, nVertical, max(1, grounds))
+
+    def __part(self, position: tuple, vertical: bool) -> POI:
+        typ = self.types[self.partCount]
+        self.partCount += 1
+        prefix = PREFIXES[typ]
+        self.counters[prefix] = self.counters.get(prefix, 0) + 1
+        poi = POI(f"S{len(self.pois)}", position, typ, f"{prefix}{self.counters[prefix]}")
+        poi.text = self.rng.choice(VALUES[typ])
+        poi.rotation = 0 if vertical else 90
+        self.pois.append(poi)
+        return poi
+
+    def __node(self, position: tuple, typ: POITypes) -> POI:
+        poi = POI(f"S{len(self.pois)}", position, typ, None)
+        self.pois.append(poi)
+        if typ == POITypes.Junction:
+            self.junctions.append(position)
+        return poi
+
+    def __wire(self, a: POI, b: POI):
+        """
+        BRIEF
+        -----
+        Draw a straight wire between two POIs, ending at the symbol
+        outlines. Links `b` to `a` as in `CGraph.link()`: terminal A of the
+        right/lower POI points left/up, terminal B of the left/upper POI
+        points right/down.
+        """
+        (ax, ay), (bx, by) = a.position, b.position
+        horizontal = ay == by
+        ra = self.partLength // 2 if a.type in PARTS else 0
+        rb = self.partLength // 2 if b.type in PARTS else 0
+        if b.type == POITypes.GND:
+            rb = 0
+        if horizontal:
+            self.wires.append(((ax + ra, ay), (bx - rb, by)))
+        else:
+            self.wires.append(((ax, ay + ra), (bx, by - rb)))
+        if b.terminalA is None:
+            b.terminalA = a
+        if a.terminalB is None:
+            a.terminalB = b
+
+    def __layout(self, nHorizontal: int, nVertical: int, grounds: int):
+        p = self.pitch
+        margin = p
+        rowPitch = p
+        perRow = [self.cols] * self.rows
+        perRow[-1] = nHorizontal - self.cols * (self.rows - 1)
+        extraGrounds = grounds - 1
+        slots = max(perRow[:-1] + [perRow[-1] + extraGrounds])
+        xRight = margin + (slots + 1) * p
+
+        left, right = list(), list()
+        for r in range(self.rows):
+            y = margin + r * rowPitch
+            last = r == self.rows - 1
+            # The bottom left node also connects to GND
+            leftType = POITypes.Corner if r == 0 else POITypes.Junction
+            rightType = POITypes.Corner if r in (0, self.rows - 1) else POITypes.Junction
+            l = self.__node((margin, y), leftType)
+            if left:
+                self.__wire(left[-1], l)
+            left.append(l)
+
+            chain = [l]
+            groundAt = set()
+            if last and extraGrounds:
+                step = (perRow[r] + extraGrounds) / (extraGrounds + 1)
+                groundAt = {int((k + 1) * step) for k in range(extraGrounds)}
+            x = margin
+            for s in range(perRow[r] + (extraGrounds if last else 0)):
+                x += p
+                if s in groundAt:
+                    j = self.__node((x, y), POITypes.Junction)
+                    self.__wire(chain[-1], j)
+                    chain.append(j)
+                    g = self.__node((x, y + p // 2), POITypes.GND)
+                    self.__wire(j, g)
+                else:
+                    part = self.__part((x, y), False)
+                    self.__wire(chain[-1], part)
+                    chain.append(part)
+            rt = self.__node((xRight, y), rightType)
+            self.__wire(chain[-1], rt)
+            right.append(rt)
+
+        # Vertical parts sit on the right rail between two rows
+        verticalAt = set(self.rng.sample(range(self.rows - 1), nVertical)) if nVertical else set()
+        for r in range(self.rows - 1):
+            upper, lower = right[r], right[r + 1]
+            if r in verticalAt:
+                part = self.__part((xRight, (upper.position[1] + lower.position[1]) // 2), True)
+                self.__wire(upper, part)
+                self.__wire(part, lower)
+            else:
+                self.__wire(upper, lower)
+
+        gnd = self.__node((margin, left[-1].position[1] + p // 2), POITypes.GND)
+        self.__wire(left[-1], gnd)
+        self.width = xRight + margin
+        self.height = left[-1].position[1] + p // 2 + margin
+
+    @property
+    def scalingFactor(self) -> float:
+        """
+        BRIEF
+        -----
+        Scaling factor for which the POI snapshots (`imageSliceSize`)
+        cover about one pitch, i.e. a symbol and the adjacent wire ends.
+        """
+        return self.pitch / P2SParameters.imageSliceSize
+
+    def render(self) -> np.ndarray:
+        """
+        BRIEF
+        -----
+        Draw the schematic.
+
+        RETURNS
+        -------
+        `np.ndarray`. Grayscale image, black on white.
+        """
+        img = np.full((self.height, self.width), 255, np.uint8)
+        t = self.lineWidth
+        for a, b in self.wires:
+            cv2.line(img, a, b, 0, t)
+        for j in self.junctions:
+            cv2.circle(img, j, t * 2, 0, -1)
+        for poi in self.pois:
+            if poi.type in PARTS:
+                self.__drawPart(img, poi)
+            elif poi.type == POITypes.GND:
+                self.__drawGround(img, poi.position)
+        return img
+
+    def __drawPart(self, img: np.ndarray, poi: POI):
+        t = self.lineWidth
+        h = self.partLength // 2
+        w = max(3, self.partLength // 6)
+        cx, cy = poi.position
+        vertical = poi.rotation == 0
+
+        def pt(u, v):
+            # u along the wire, v across it
+            return (int(cx - v), int(cy + u)) if vertical else (int(cx + u), int(cy + v))
+
+        def poly(points, closed=False):
+            cv2.polylines(img, [np.array([pt(u, v) for u, v in points], np.int32)], closed, 0, t)
+
+        if poi.type == POITypes.Resistor:
+            zig = [(-h, 0)] + [(-h + (2 * i + 1) * h / 6, w if i % 2 == 0 else -w) for i in range(6)] + [(h, 0)]
+            poly(zig)
+        elif poi.type == POITypes.Capacitor:
+            g = max(t * 2, h // 4)
+            poly([(-h, 0), (-g, 0)])
+            poly([(g, 0), (h, 0)])
+            poly([(-g, -w * 2), (-g, w * 2)])
+            poly([(g, -w * 2), (g, w * 2)])
+        elif poi.type == POITypes.Inductor:
+            r = h / 4
+            for i in range(4):
+                cu = -h + r * (2 * i + 1)
+                cv2.ellipse(img, pt(cu, 0), (int(r), int(r)), 90 if vertical else 0,
+                            180, 360, 0, t)
+        elif poi.type == POITypes.Diode:
+            poly([(-h, 0), (-h // 2, 0)])
+            poly([(h // 2, 0), (h, 0)])
+            poly([(-h // 2, -w * 2), (-h // 2, w * 2), (h // 2, 0)], closed=True)
+            poly([(h // 2, -w * 2), (h // 2, w * 2)])
+
+        scale = self.partLength / 70
+        thick = max(1, t // 2)
+        lx, ly = (cx + w * 3, cy) if vertical else (cx - h // 2, cy - w * 3)
+        cv2.putText(img, poi.name, (int(lx), int(ly)), cv2.FONT_HERSHEY_SIMPLEX, scale, 0, thick)
+        vx, vy = (cx + w * 3, cy + int(30 * scale)) if vertical else (cx - h // 2, cy + w * 3 + int(25 * scale))
+        cv2.putText(img, poi.text, (int(vx), int(vy)), cv2.FONT_HERSHEY_SIMPLEX, scale * 0.8, 0, thick)
+
+    def __drawGround(self, img: np.ndarray, position: tuple):
+        t = self.lineWidth
+        w = max(6, self.partLength // 3)
+        x, y = position
+        for i, f in enumerate((1.0, 0.6, 0.25)):
+            yy = y + i * t * 3
+            cv2.line(img, (int(x - w * f), yy), (int(x + w * f), yy), 0, t)
+
+    def graph(self) -> list:
+        """
+        BRIEF
+        -----
+        Get the ground truth as loose graph, see
+        `png2spice.graphing.CGraph.looseGraph`.
+        """
+        return self.pois
+
+    def asc(self, offset: int=0, gridStep: int=None) -> str:
+        """
+        BRIEF
+        -----
+        Get the ground truth as `.asc` content.
+
+        PARAMETERS
+        ----------
+        `offset`:
+            `int`. Added to all coordinates, e.g. `imagePaddingScaled` to
+            compare with the output of the pipeline.
+        `gridStep`:
+            `int`. Snap positions like `CGraph.snapToGrid()`. Default is
+            `minGridStep` of `P2SParameters`.
+        """
+        d = P2SParameters.minGridStep if gridStep is None else gridStep
+        original = [p.position for p in self.pois]
+        try:
+            for p in self.pois:
+                x, y = p.position[0] + offset, p.position[1] + offset
+                p.position = ((x + d // 2) // d * d, (y + d // 2) // d * d)
+            return "\n".join(CParser(self.pois).IterAsc()) + "\n"
+        finally:
+            for p, pos in zip(self.pois, original):
+                p.position = pos
+
+    def toJSON(self) -> dict:
+        index = {p: i for i, p in enumerate(self.pois)}
+        return {
+            "parts": self.n,
+            "width": self.width,
+            "height": self.height,
+            "pitch": self.pitch,
+            "scalingFactor": self.scalingFactor,
+            "pois": [{
+                "label": p.value,
+                "type": p.type.name,
+                "position": [int(p.position[0]), int(p.position[1])],
+                "rotation": p.rotation,
+                "name": p.name,
+                "text": p.text,
+                "terminalA": index.get(p.terminalA),
+                "terminalB": index.get(p.terminalB),
+            } for p in self.pois],
+        }
+
+    def save(self, folder: str, name: str) -> dict:
+        """
+        BRIEF
+        -----
+        Write `<name>.png`, the ground truth `<name>.asc` (with the padding
+        of the suggested scaling factor as offset) and `<name>.json`.
+
+        RETURNS
+        -------
+        `dict`. Paths of the written files.
+        """
+        os.makedirs(folder, exist_ok=True)
+        paths = {ext: join(folder, f"{name}.{ext}") for ext in ("png", "asc", "json")}
+        cv2.imwrite(paths["png"], self.render())
+        pad = P2SParameters.freeze(scalingFactor=self.scalingFactor).imagePaddingScaled
+        with open(paths["asc"], "w") as f:
+            f.write(self.asc(pad))
+        with open(paths["json"], "w") as f:
+            json.dump(self.toJSON(), f, indent=2)
+        return paths
+
+
+def main(argv: list=None):
+    ap = argparse.ArgumentParser(description="Render synthetic schematics with ground truth.")
+    ap.add_argument("-n", "--parts", type=int, nargs="+", default=[10, 100, 1000], help="Part counts, one schematic each.")
+    ap.add_argument("-o", "--output", default="synthetic", help="Output folder.")
+    ap.add_argument("--grounds", type=int, default=1)
+    ap.add_argument("--pitch", type=int, default=144, help="Distance between parts in pixels.")
+    ap.add_argument("--vertical", type=float, default=0.1, help="Share of vertical parts.")
+    ap.add_argument("--line-width", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args(argv)
+
+    for n in args.parts:
+        s = CSyntheticSchematic(n, args.grounds, None, args.pitch, args.vertical, args.line_width, args.seed)
+        paths = s.save(args.output, f"synthetic{n}")
+        print(f"{n} parts: {s.width}x{s.height} px, scaling factor {s.scalingFactor:.4f} -> {paths['png']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""
+This submodule of **png2spice** records where time goes for a given
+schematic. Stages and their sub-steps open named spans, which record wall
+time, CPU time, optionally the peak of traced memory and any number of item
+counts (lines found, crops, valid POIs, wires, ...). The spans of a run can be
+exported as JSON or in the Chrome trace format (`chrome://tracing`,
+Perfetto), and selected spans can additionally be captured by `cProfile`.
+
+Tracing is off unless a `CTracer` is activated for the current context:
+
+    tracer = CTracer(memory=True, profile=("stage.lines",))
+    with use(tracer):
+        pipeline.runImage(...)
+    tracer.writeJSON("trace.json")
+    tracer.writeChromeTrace("trace.chrome.json")
+
+Without an active tracer, `span()` returns a shared no-op span, so the
+instrumentation in the other submodules costs next to nothing.
+"""
+
+import contextvars
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from os.path import join
+
+
+class CSpan:
+    def __init__(self, tracer, name: str, counts: dict) -> None:
+        """
+        BRIEF
+        -----
+        A single timed section, created by `CTracer.span()`. Use it as a
+        context manager.
+
+        PARAMETERS
+        ----------
+        `tracer`:
+            `CTracer`. Tracer the span reports to.
+        `name`:
+            `str`. Name of the span, dotted by submodule, e.g. `lines.hough`.
+        `counts`:
+            `dict`. Initial item counts.
+        """
+        self.tracer = tracer
+        self.name = name
+        self.counts = dict(counts)
+        self.attrs = dict()
+        self.parent = None
+        self.memPeak = None
+        self.__token = None
+        self.__memBase = 0
+        self.__memMax = 0
+        self.__profiler = None
+
+    def count(self, name: str, n: int=1):
+        """
+        BRIEF
+        -----
+        Add `n` to the item count `name` of this span.
+        """
+        self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def set(self, **attrs):
+        """
+        BRIEF
+        -----
+        Attach arbitrary JSON-serializable attributes to this span.
+        """
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.parent = _active.get()
+        self.__token = _active.set(self)
+        if self.tracer.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if self.parent is not None:
+                self.parent.__memMax = max(self.parent.__memMax, peak)
+            tracemalloc.reset_peak()
+            self.__memBase = current
+            self.__memMax = current
+        self.__profiler = self.tracer._startProfile(self.name)
+        self.start = time.perf_counter()
+        self.cpuStart = time.thread_time()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.wall = time.perf_counter() - self.start
+        self.cpu = time.thread_time() - self.cpuStart
+        if self.__profiler is not None:
+            self.tracer._stopProfile(self.__profiler)
+        if self.tracer.memory and tracemalloc.is_tracing():
+            _, peak = tracemalloc.get_traced_memory()
+            self.__memMax = max(self.__memMax, peak)
+            self.memPeak = self.__memMax - self.__memBase
+            if self.parent is not None:
+                self.parent.__memMax = max(self.parent.__memMax, self.__memMax)
+            tracemalloc.reset_peak()
+        if excType is not None:
+            self.attrs["error"] = excType.__name__
+        _active.reset(self.__token)
+        self.tracer._record(self)
+        return False
+
+
+class _CNullSpan:
+    """
+    Span returned while no tracer is active. Does nothing.
+    """
+    name = None
+    counts = dict()
+    attrs = dict()
+
+    def count(self, name: str, n: int=1):
+        pass
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        return False
+
+
+NULL_SPAN = _CNullSpan()
+
+
+class CTracer:
+    def __init__(self, memory: bool=False, profile: tuple=()) -> None:
+        """
+        BRIEF
+        -----
+        Collect the spans of one or more runs.
+
+        PARAMETERS
+        ----------
+        `memory`:
+            `bool`. Record the peak of memory allocated by Python (via
+            `tracemalloc`) per span. Starts `tracemalloc` if it is not
+            running yet, which slows down allocation-heavy code noticeably.
+            Default is `False`.
+        `profile`:
+            `tuple`. Names of spans to capture with `cProfile`, e.g.
+            `("stage.classify",)`. All calls of a span name are accumulated
+            into one profile. Only one span is profiled at a time; a profiled
+            span nested into another one is timed but not profiled.
+
+        NOTES
+        -----
+        The per-span memory peak is measured against the traced memory at
+        the start of the span. `tracemalloc` is process-wide, so with spans
+        running concurrently on several threads the peaks overlap.
+        """
+        self.memory = memory
+        self.profile = frozenset(profile)
+        self.profiles = dict()
+        self.spans = list()
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.__profiling = False
+        self.__startedTracemalloc = False
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.__startedTracemalloc = True
+
+    def span(self, name: str, **counts) -> CSpan:
+        """
+        BRIEF
+        -----
+        Create a span. Spans opened while another span of the same context
+        is open become its children.
+
+        PARAMETERS
+        ----------
+        `name`:
+            `str`. Name of the span.
+        `**counts`:
+            Initial item counts, e.g. `lines=12`.
+
+        RETURNS
+        -------
+        `CSpan`. To be used in a `with` statement.
+        """
+        return CSpan(self, name, counts)
+
+    def close(self):
+        """
+        BRIEF
+        -----
+        Stop `tracemalloc` if this tracer started it.
+        """
+        if self.__startedTracemalloc:
+            tracemalloc.stop()
+            self.__startedTracemalloc = False
+
+    def _startProfile(self, name: str):
+        if name not in self.profile:
+            return None
+        with self.lock:
+            if self.__profiling:
+                return None
+            self.__profiling = True
+            profiler = self.profiles.setdefault(name, cProfile.Profile())
+        profiler.enable()
+        return profiler
+
+    def _stopProfile(self, profiler):
+        profiler.disable()
+        with self.lock:
+            self.__profiling = False
+
+    def _record(self, span: CSpan):
+        record = {
+            "name": span.name,
+            "parent": span.parent.name if isinstance(span.parent, CSpan) else None,
+            "start": span.start - self.origin,
+            "wall": span.wall,
+            "cpu": span.cpu,
+            "memPeak": span.memPeak,
+            "counts": span.counts,
+            "attrs": span.attrs,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        with self.lock:
+            self.spans.append(record)
+
+    def extend(self, records: list, offset: float=0.0):
+        """
+        BRIEF
+        -----
+        Add spans recorded by another tracer, e.g. one running in a worker
+        process (see `records()`).
+
+        PARAMETERS
+        ----------
+        `records`:
+            `list`. Span records.
+        `offset`:
+            `float`. Seconds added to the start of every record, to place
+            them on the time axis of this tracer.
+        """
+        with self.lock:
+            for r in records:
+                self.spans.append(dict(r, start=r["start"] + offset))
+
+    def records(self) -> list:
+        """
+        BRIEF
+        -----
+        Get the recorded spans in order of completion.
+
+        RETURNS
+        -------
+        `list`. One `dict` per span with `name`, `parent`, `start` and
+        `wall` (seconds relative to the creation of the tracer), `cpu`
+        (thread CPU seconds), `memPeak` (bytes or `None`), `counts`,
+        `attrs`, `pid` and `tid`.
+        """
+        with self.lock:
+            return [dict(r) for r in self.spans]
+
+    def summary(self) -> dict:
+        """
+        BRIEF
+        -----
+        Aggregate the spans by name.
+
+        RETURNS
+        -------
+        `dict`. Span name to `calls`, total `wall` and `cpu` seconds, the
+        largest `memPeak` and the summed `counts`.
+        """
+        summary = dict()
+        for r in self.records():
+            s = summary.setdefault(r["name"], {"calls": 0, "wall": 0.0, "cpu": 0.0,
+                                               "memPeak": None, "counts": dict()})
+            s["calls"] += 1
+            s["wall"] += r["wall"]
+            s["cpu"] += r["cpu"]
+            if r["memPeak"] is not None:
+                s["memPeak"] = max(s["memPeak"] or 0, r["memPeak"])
+            for k, v in r["counts"].items():
+                s["counts"][k] = s["counts"].get(k, 0) + v
+        return summary
+
+    def toJSON(self) -> dict:
+        return {"spans": self.records(), "summary": self.summary()}
+
+    def writeJSON(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.toJSON(), f, indent=2, default=str)
+
+    def toChromeTrace(self) -> dict:
+        """
+        BRIEF
+        -----
+        Convert the spans into the Chrome trace event format. Every span
+        becomes a complete event (`"ph": "X"`) with its CPU time, memory
+        peak, counts and attributes as `args`.
+        """
+        events = list()
+        for r in sorted(self.records(), key=lambda r: r["start"]):
+            args = {"cpu_ms": r["cpu"] * 1e3}
+            if r["memPeak"] is not None:
+                args["memPeak_bytes"] = r["memPeak"]
+            args.update(r["counts"])
+            args.update(r["attrs"])
+            events.append({
+                "name": r["name"],
+                "cat": r["name"].split(".")[0],
+                "ph": "X",
+                "ts": r["start"] * 1e6,
+                "dur": r["wall"] * 1e6,
+                "pid": r["pid"],
+                "tid": r["tid"],
+                "args": args,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def writeChromeTrace(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.toChromeTrace(), f, default=str)
+
+    def writeProfiles(self, folder: str) -> list:
+        """
+        BRIEF
+        -----
+        Dump the `cProfile` captures as `<span name>.prof` files, to be
+        opened with `pstats` or `snakeviz`.
+
+        RETURNS
+        -------
+        `list`. Paths of the written files.
+        """
+        os.makedirs(folder, exist_ok=True)
+        paths = list()
+        for name, profiler in self.profiles.items():
+            path = join(folder, name + ".prof")
+            profiler.dump_stats(path)
+            paths.append(path)
+        return paths
+
+
+class _CNullTracer:
+    """
+    Tracer active by default. Hands out `NULL_SPAN` and records nothing.
+    """
+    memory = False
+
+    def span(self, name: str, **counts):
+        return NULL_SPAN
+
+    def records(self) -> list:
+        return []
+
+
+NULL_TRACER = _CNullTracer()
+
+_tracer = contextvars.ContextVar("png2spice_tracer", default=NULL_TRACER)
+_active = contextvars.ContextVar("png2spice_span", default=None)
+
+
+def current():
+    """
+    BRIEF
+    -----
+    Get the tracer of the current context, `NULL_TRACER` if none is active.
+    """
+    return _tracer.get()
+
+
+class use:
+    def __init__(self, tracer) -> None:
+        """
+        BRIEF
+        -----
+        Activate `tracer` for the current context while the `with` block
+        runs. Threads start with a fresh context, so worker threads have to
+        activate the tracer themselves.
+        """
+        self.tracer = tracer
+        self.__token = None
+
+    def __enter__(self):
+        self.__token = _tracer.set(self.tracer)
+        return self.tracer
+
+    def __exit__(self, excType, exc, tb):
+        _tracer.reset(self.__token)
+        return False
+
+
+def span(name: str, **counts):
+    """
+    BRIEF
+    -----
+    Open a span on the tracer of the current context, see `CTracer.span()`.
+    """
+    return _tracer.get().span(name, **counts)
+
+
+def count(name: str, n: int=1):
+    """
+    BRIEF
+    -----
+    Add `n` to the item count `name` of the innermost open span, if any.
+    """
+    active = _active.get()
+    if active is not None:
+        active.count(name, n)
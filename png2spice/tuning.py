@@ -0,0 +1,321 @@
+"""
+This submodule of **png2spice** tunes the **P2S parameters** against
+reference `.asc` files. Parameter combinations are evaluated in a process
+pool, and stage outputs are checkpointed by the pipeline DAG under keys
+covering only the parameters each stage depends on (see
+`png2spice.pipeline.CPipeline`). Changing a graph
+threshold therefore only re-runs `CGraph` and `CParser`, while lines,
+SPICEnet and OCR results are reused.
+
+Usage:
+    python tuning.py --images ../testSchematicsPNG --references refs \\
+        --space space.json --workers 8
+
+`space.json` maps parameter names to lists of candidate values, e.g.
+`{"DuplicateVariance": [2400, 2800, 3200], "HLThreshold": [60, 75]}`.
+"""
+
+import argparse
+import glob
+import itertools
+import json
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os.path import join, exists, basename, splitext
+
+import pipeline
+from parameters import P2SParameters
+from parsing import parseAsc
+
+IMAGE_PATTERNS = ("*.png", "*.PNG", "*.jpg", "*.JPG", "*.jpeg", "*.JPEG")
+
+
+def gridSearch(space: dict) -> list:
+    """
+    BRIEF
+    -----
+    Get all combinations of a parameter space.
+
+    PARAMETERS
+    ----------
+    `space`:
+        `dict`. Parameter name to list of candidate values.
+
+    RETURNS
+    -------
+    `list`. List of `dict`s, one per combination.
+    """
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[n] for n in names))]
+
+
+def randomSearch(space: dict, n: int, seed: int=0) -> list:
+    """
+    BRIEF
+    -----
+    Draw `n` distinct random combinations of a parameter space. If the space
+    has fewer combinations, all of them are returned.
+    """
+    combos = gridSearch(space)
+    if n >= len(combos):
+        return combos
+    return random.Random(seed).sample(combos, n)
+
+
+def _f1(nMatched: int, nCandidate: int, nReference: int) -> float:
+    if nCandidate == 0 and nReference == 0:
+        return 1.0
+    return 2 * nMatched / (nCandidate + nReference)
+
+
+def _match(candidates: list, references: list, dist, tolerance: float) -> int:
+    """
+    BRIEF
+    -----
+    Greedily match candidates to references closer than `tolerance`, every
+    reference at most once.
+
+    RETURNS
+    -------
+    `int`. Number of matches.
+    """
+    used = [False] * len(references)
+    matched = 0
+    for c in candidates:
+        best, bestDist = None, tolerance
+        for i, r in enumerate(references):
+            if used[i]:
+                continue
+            d = dist(c, r)
+            if d is not None and d < bestDist:
+                best, bestDist = i, d
+        if best is not None:
+            used[best] = True
+            matched += 1
+    return matched
+
+
+def scoreAsc(candidate: str, reference: str, tolerance: float=48) -> dict:
+    """
+    BRIEF
+    -----
+    Score `.asc` content against a reference. Parts and flags have to match
+    in type and lie within `tolerance`, wires have to match with both end
+    points within `tolerance`.
+
+    PARAMETERS
+    ----------
+    `candidate`:
+        `str`. Content of the produced `.asc` file.
+    `reference`:
+        `str`. Content of the reference `.asc` file.
+    `tolerance`:
+        `float`. Position tolerance in LTSPICE units. Default is one grid
+        step (48).
+
+    RETURNS
+    -------
+    `dict`. F1 scores `parts` and `wires` and their mean `score`.
+    """
+    c, r = parseAsc(candidate), parseAsc(reference)
+
+    def partDist(a, b):
+        if a[0] != b[0]:
+            return None
+        return math.dist(a[1:3], b[1:3])
+
+    def wireDist(a, b):
+        return min(max(math.dist(a[0:2], b[0:2]), math.dist(a[2:4], b[2:4])),
+                   max(math.dist(a[0:2], b[2:4]), math.dist(a[2:4], b[0:2])))
+
+    cParts = [(s[0], s[1], s[2]) for s in c["symbols"]] + [("FLAG" + f[0], f[1], f[2]) for f in c["flags"]]
+    rParts = [(s[0], s[1], s[2]) for s in r["symbols"]] + [("FLAG" + f[0], f[1], f[2]) for f in r["flags"]]
+    parts = _f1(_match(cParts, rParts, partDist, tolerance), len(cParts), len(rParts))
+    wires = _f1(_match(c["wires"], r["wires"], wireDist, tolerance), len(c["wires"]), len(r["wires"]))
+    return {"parts": parts, "wires": wires, "score": (parts + wires) / 2}
+
+
+_model = None
+_modelPath = None
+_cache = None
+
+
+def _initWorker(modelPath: str, cacheDir: str):
+    global _modelPath, _cache, _model
+    _modelPath = modelPath
+    _cache = pipeline.CStageCache(cacheDir)
+    _model = None
+
+
+class _LazyModel:
+    """
+    Loads SPICEnet on first use, so workers whose upstream stages are all
+    cached never pay for importing `tensorflow`.
+    """
+    @property
+    def path(self):
+        return _modelPath
+
+    def predict(self, *args, **kwargs):
+        global _model
+        if _model is None:
+            from inference import CSPICEnet
+            _model = CSPICEnet(_modelPath)
+        return _model.predict(*args, **kwargs)
+
+
+def _evaluateGroup(task: dict) -> list:
+    """
+    BRIEF
+    -----
+    Evaluate all combinations sharing the same upstream parameters on one
+    image. Runs in a worker process.
+    """
+    results = list()
+    for index, combo in task["combos"]:
+        params = P2SParameters.freeze(scalingFactor=task["scalingFactor"], **combo)
+        t = time.perf_counter()
+        try:
+            out = pipeline.runCached(task["image"], task["workDir"], _LazyModel(), params,
+                                     _cache, task["imageId"], task["ocr"])
+            asc, _ = pipeline.stageExport(out["graph"])
+            score = scoreAsc(asc, task["reference"], task["tolerance"])
+            error = None
+        except Exception as e:
+            score = {"parts": 0.0, "wires": 0.0, "score": 0.0}
+            error = f"{type(e).__name__}: {e}"
+        results.append((index, task["image"], score, time.perf_counter() - t, error))
+    return results
+
+
+def tune(images: list, references: dict, combos: list, workers: int=os.cpu_count(),
+         cacheDir: str=join(".temp", "tuning"), modelPath: str="SPICEnet",
+         tolerance: float=48, ocr: bool=True) -> list:
+    """
+    BRIEF
+    -----
+    Evaluate parameter combinations on a set of images.
+
+    PARAMETERS
+    ----------
+    `images`:
+        `list`. Paths to schematic images.
+    `references`:
+        `dict`. Image path to content of its reference `.asc` file.
+    `combos`:
+        `list`. Parameter combinations, see `gridSearch()` and
+        `randomSearch()`.
+    `workers`:
+        `int`. Number of worker processes.
+    `cacheDir`:
+        `str`. Folder for stage outputs and POI snapshots. It may be reused
+        across tuning sessions.
+    `modelPath`:
+        `str`. Folder containing `SPICEnet.h5` and `CLASSLIST.json`.
+    `tolerance`:
+        `float`. See `scoreAsc()`.
+    `ocr`:
+        `bool`. Perform OCR in the classification stage.
+
+    RETURNS
+    -------
+    `list`. One `dict` per combination with the mean `score`, the
+    per-image scores, the run time and errors, sorted best first.
+    """
+    for combo in combos:
+        P2SParameters.freeze(**combo)  # fail early on unknown names
+    cache = pipeline.CStageCache(cacheDir)
+
+    tasks = list()
+    for image in images:
+        imageId = pipeline.hashFile(image)
+        key = "scaling-" + imageId
+        scalingFactor = cache.get(key)
+        if scalingFactor is None:
+            scalingFactor = pipeline.estimateScalingFactor(image)
+            cache.put(key, scalingFactor)
+
+        groups = dict()
+        for index, combo in enumerate(combos):
+            params = P2SParameters.freeze(scalingFactor=scalingFactor, **combo)
+            groups.setdefault(pipeline.stageKey("classify", imageId, params), []).append((index, combo))
+        for groupKey, members in groups.items():
+            tasks.append({
+                "image": image,
+                "imageId": imageId,
+                "scalingFactor": scalingFactor,
+                "combos": members,
+                "workDir": join(cacheDir, "work", groupKey),
+                "reference": references[image],
+                "tolerance": tolerance,
+                "ocr": ocr,
+            })
+
+    results = [{"params": combo, "images": dict(), "seconds": 0.0, "errors": dict()} for combo in combos]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker,
+                             initargs=(modelPath, cacheDir)) as pool:
+        futures = [pool.submit(_evaluateGroup, task) for task in tasks]
+        for future in as_completed(futures):
+            for index, image, score, seconds, error in future.result():
+                results[index]["images"][image] = score
+                results[index]["seconds"] += seconds
+                if error is not None:
+                    results[index]["errors"][image] = error
+
+    for r in results:
+        scores = [s["score"] for s in r["images"].values()]
+        r["score"] = sum(scores) / len(scores) if scores else 0.0
+    return sorted(results, key=lambda r: r["score"], reverse=True)
+
+
+def findImages(folder: str) -> list:
+    found = list()
+    for pattern in IMAGE_PATTERNS:
+        found.extend(glob.glob(join(folder, pattern)))
+    return sorted(set(found))
+
+
+def main(argv: list=None):
+    ap = argparse.ArgumentParser(description="Tune P2S parameters against reference .asc files.")
+    ap.add_argument("--images", default=join("..", "testSchematicsPNG"), help="Folder of schematic images.")
+    ap.add_argument("--references", required=True, help="Folder of reference .asc files named like the images.")
+    ap.add_argument("--space", required=True, help="JSON file or string mapping parameter names to value lists.")
+    ap.add_argument("--random", type=int, default=0, help="Evaluate N random combinations instead of the full grid.")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--workers", type=int, default=os.cpu_count())
+    ap.add_argument("--cache-dir", default=join(".temp", "tuning"))
+    ap.add_argument("--model", default="SPICEnet", help="Folder containing SPICEnet.h5 and CLASSLIST.json.")
+    ap.add_argument("--tolerance", type=float, default=48)
+    ap.add_argument("--no-ocr", action="store_true")
+    ap.add_argument("--output", default="tuning.json", help="Report file.")
+    args = ap.parse_args(argv)
+
+    if exists(args.space):
+        with open(args.space) as f:
+            space = json.load(f)
+    else:
+        space = json.loads(args.space)
+    combos = randomSearch(space, args.random, args.seed) if args.random else gridSearch(space)
+
+    references = dict()
+    for image in findImages(args.images):
+        ref = join(args.references, splitext(basename(image))[0] + ".asc")
+        if exists(ref):
+            with open(ref) as f:
+                references[image] = f.read()
+        else:
+            print(f"[TUNING WARN]: No reference for {image}, skipped")
+
+    results = tune(sorted(references), references, combos, args.workers, args.cache_dir,
+                   args.model, args.tolerance, not args.no_ocr)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    for r in results[:5]:
+        print(f"{r['score']:.3f}  {r['params']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,11 @@ setup(
     author_email='your@email.com',
     description='Assortment of line tracing, object detection and classification for schematic recognition',
     packages=find_packages(),
+    entry_points={
+        'console_scripts': [
+            'png2spice=png2spice.cli:main',
+        ],
+    },
     install_requires=[
         'numpy',
     ],
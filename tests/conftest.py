@@ -0,0 +1,5 @@
+import sys
+from os.path import abspath, dirname, join
+
+# The submodules of png2spice import each other by their plain names
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "png2spice"))
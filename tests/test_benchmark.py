@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+benchmark = pytest.importorskip("benchmark")
+import lines
+
+
+def image():
+    rng = np.random.default_rng(3)
+    return rng.integers(0, 256, (120, 160), dtype=np.uint8)
+
+
+def test_stub_dense_matches_crops():
+    model = benchmark.CStubSPICEnet()
+    img, points = image(), [(40, 40), (100, 60), (5, 110)]
+    crops = [lines.cropImageAtPos(img, x, y, 24) for x, y in points]
+    dense = model.predictDense(img, points, 24)
+    assert dense.shape == (3, len(model.classlist))
+    np.testing.assert_array_equal(dense, model.predictArrays(crops))
+    preds = model.predsToDict(dense, ["0A", "1A", "2B"])
+    assert list(preds) == ["0A", "1A", "2B"]
+    assert list(preds["0A"]) == model.classlist
+
+
+def test_stub_rotations_pick_most_confident_variant():
+    model = benchmark.CStubSPICEnet()
+    crops = [lines.cropImageAtPos(image(), 60, 60, 32)]
+    preds, degrees = model.predictRotations(crops)
+    variants = model.predictArrays([np.rot90(crops[0], k) for k in range(4)])
+    assert degrees[0] in (0, 90, 180, 270)
+    np.testing.assert_array_equal(preds[0], variants[degrees[0] // 90])
+    assert preds[0].max() == variants.max()
+
+
+def test_stub_handles_no_crops():
+    model = benchmark.CStubSPICEnet()
+    assert model.predictArrays([]).shape == (0, len(model.classlist))
+    preds, degrees = model.predictRotations([])
+    assert preds.shape == (0, len(model.classlist)) and degrees == []
+
+
+def test_stub_reads_crop_store(tmp_path):
+    cropstore = pytest.importorskip("cropstore")
+    model = benchmark.CStubSPICEnet()
+    crops = [lines.cropImageAtPos(image(), x, 60, 32) for x in (40, 100)]
+    with cropstore.CCropStore(str(tmp_path / "crops.bin"), 32, "w") as store:
+        for label, crop in zip(("0A", "0B"), crops):
+            store.add(crop, label)
+    with cropstore.CCropStore(str(tmp_path / "crops.bin")) as store:
+        preds = model.predictStore(store, ocr=False)
+    assert preds == model.predsToDict(model.predictArrays(crops), ["0A", "0B"])
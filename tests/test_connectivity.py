@@ -0,0 +1,60 @@
+from connectivity import GROUND_NET, CNets, CUnionFind
+from POI import POI, POITypes
+
+
+def makePOI(label, typ, pos=(0, 0)):
+    return POI(label, pos, typ, None)
+
+
+def test_union_find_merges_and_registers_on_first_use():
+    uf = CUnionFind()
+    for i in range(6):
+        uf.add(i)
+    uf.union(0, 1)
+    uf.union(2, 3)
+    uf.union(1, 3)
+    assert uf.find(0) == uf.find(2) == uf.find(3)
+    assert uf.find(4) != uf.find(0)
+    assert uf.find("new") == "new"
+    assert uf.size[uf.find(0)] == 4
+
+
+def test_union_find_union_returns_representative():
+    uf = CUnionFind()
+    root = uf.union("a", "b")
+    assert root == uf.find("a") == uf.find("b")
+    assert uf.union("a", "b") == root
+
+
+def test_nets_short_wiring_and_number_ground_zero():
+    # R.A -- GND, R.B -- corner -- C.B, C.A -- GND
+    r = makePOI("0A", POITypes.Resistor)
+    corner = makePOI("0B", POITypes.Corner)
+    c = makePOI("1B", POITypes.Capacitor)
+    gnd1 = makePOI("2B", POITypes.GND)
+    gnd2 = makePOI("3B", POITypes.GND)
+    r.terminalA, r.terminalB = gnd1, corner
+    corner.terminalB = c
+    c.terminalA = gnd2
+    nets = CNets([r, corner, c, gnd1, gnd2])
+
+    assert nets.netOf(r, "A") == GROUND_NET
+    assert nets.netOf(c, "A") == GROUND_NET
+    assert nets.netOf(r, "B") == nets.netOf(corner, "A") == nets.netOf(c, "B")
+    assert nets.netOf(r, "B") == 1
+    assert nets.components() == [r, c]
+    assert nets.componentTable() == {GROUND_NET: [(r, "A"), (c, "A")], 1: [(r, "B"), (c, "B")]}
+
+
+def test_nets_without_ground_start_at_one_and_skip_duplicate_wires():
+    r = makePOI("0A", POITypes.Resistor)
+    l = makePOI("0B", POITypes.Inductor)
+    r.terminalB = l
+    l.terminalB = r
+    nets = CNets([r, l])
+
+    assert len(nets.edges) == 1
+    assert nets.netOf(r, "A") == 1
+    assert nets.netOf(r, "B") == nets.netOf(l, "B") == 2
+    assert nets.netOf(l, "A") == 3
+    assert GROUND_NET not in nets.table
@@ -0,0 +1,105 @@
+import numpy as np
+
+from graphing import CGraph
+from parameters import P2SParameters
+from POI import POI, POITypes
+
+PARAMS = P2SParameters.freeze(scalingFactor=0.01)
+
+# All positions lie on the grid and no two POIs share a row or column band,
+# so that snapping and alignment do not move anything.
+LINES = np.array([
+    (96, 96, 480, 288),     # R -> corner
+    (480, 288, 864, 672),   # corner -> C
+    (864, 672, 288, 1056),  # C -> GND
+    (96, 96, 288, 1056),    # R -> GND
+    (1248, 1248, 672, 864), # free wire end
+])
+
+TYPES = {"0A": POITypes.Resistor, "0B": POITypes.Corner, "1B": POITypes.Capacitor, "2B": POITypes.GND}
+
+
+def pred(typ):
+    return {t.name: float(t == typ) for t in POITypes}
+
+
+def build(types=TYPES):
+    graph = CGraph(LINES, {label: pred(typ) for label, typ in types.items()}, None, PARAMS)
+    graph.rmDuplicates()
+    graph.link()
+    graph.analyzeRotations()
+    graph.snapToGrid()
+    graph.alignToGrid()
+    graph.extractNets()
+    return graph
+
+
+def position(poi):
+    return None if poi is None else tuple(int(v) for v in poi.position)
+
+
+def signature(graph):
+    """
+    Compare graphs by their POIs' positions, independently of the labels and
+    the order of the POIs.
+    """
+    pois = {position(p): (p.type, p.rotation, position(p.terminalA), position(p.terminalB))
+            for p in graph.looseGraph}
+    nets = graph.extractNets()
+    members = {frozenset((position(p), t) for p, t in m) for m in nets.table.values()}
+    return pois, members
+
+
+def find(graph, label):
+    return next(p for p in graph.looseGraph if p.value == label)
+
+
+def test_reference_graph_is_linked():
+    graph = build()
+    r, corner, c = find(graph, "0A"), find(graph, "0B"), find(graph, "1B")
+    assert len(graph.looseGraph) == 4
+    assert r.terminalB is corner
+    assert corner.terminalB is c
+    assert c.terminalB is find(graph, "2B")
+    assert r.terminalA is find(graph, "2B")
+
+
+def test_add_matches_rebuild():
+    graph = build({k: v for k, v in TYPES.items() if k != "1B"})
+    graph.addPOI(POI("1B", LINES[1][2:4], POITypes.Capacitor, None))
+    assert signature(graph) == signature(build())
+
+
+def test_add_duplicate_returns_present_poi():
+    graph = build()
+    c = find(graph, "1B")
+    assert graph.addPOI(POI("9A", (870, 670), POITypes.Capacitor, None)) is c
+    assert signature(graph) == signature(build())
+
+
+def test_remove_matches_rebuild():
+    graph = build()
+    graph.removePOI(find(graph, "1B"))
+    assert signature(graph) == signature(build({k: v for k, v in TYPES.items() if k != "1B"}))
+
+
+def test_retype_matches_rebuild():
+    graph = build()
+    graph.retypePOI(find(graph, "1B"), POITypes.Inductor)
+    assert signature(graph) == signature(build(dict(TYPES, **{"1B": POITypes.Inductor})))
+
+
+def test_move_matches_rebuild():
+    graph = build()
+    graph.movePOI(find(graph, "1B"), LINES[4][2:4])
+    moved = {k: v for k, v in TYPES.items() if k != "1B"}
+    moved["4B"] = POITypes.Capacitor
+    assert signature(graph) == signature(build(moved))
+
+
+def test_move_and_back_restores_graph():
+    graph = build()
+    c = find(graph, "1B")
+    graph.movePOI(c, LINES[4][2:4])
+    graph.movePOI(c, LINES[1][2:4])
+    assert signature(graph) == signature(build())
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+incremental = pytest.importorskip("incremental")
+from parameters import P2SParameters
+
+
+class CRecordingSession(incremental.CIncrementalSession):
+    def run(self, gray, params=None, ocr=True, cancel=None):
+        self.started = params
+        return None
+
+
+def session(baseParams=None):
+    s = CRecordingSession(tileSize=8)
+    params = P2SParameters.freeze(scalingFactor=0.005)
+    gray = np.full((64, 64), 255, np.uint8)
+    img = incremental.lines.normalizeImageData(gray, params)
+    s.remember(gray, img, params, np.zeros((0, 4)), dict(), dict(), baseParams)
+    return s
+
+
+def test_fallback_for_other_size_estimates_scaling_again():
+    s = session()
+    s.update(np.full((32, 32), 255, np.uint8))
+    assert s.started.scalingFactor == 0
+
+
+def test_fallback_for_other_schematic_estimates_scaling_again():
+    s = session()
+    s.update(np.zeros((64, 64), np.uint8))
+    assert s.started.scalingFactor == 0
+
+
+def test_fallback_keeps_explicit_scaling():
+    s = session(P2SParameters.freeze(scalingFactor=0.005))
+    s.update(np.full((32, 32), 255, np.uint8))
+    assert s.started.scalingFactor == 0.005
+
+
+def endpoints(HLs):
+    return {label: (int(x), int(y)) for i, line in enumerate(HLs)
+            for label, (x, y) in ((f"{i}A", line[0:2]), (f"{i}B", line[2:4]))}
+
+
+def test_update_only_classifies_around_the_edit():
+    benchmark = pytest.importorskip("benchmark")
+    synthetic = pytest.importorskip("synthetic")
+    cv2 = pytest.importorskip("cv2")
+    schematic = synthetic.CSyntheticSchematic(16, seed=1)
+    gray = schematic.render()
+    params = P2SParameters.freeze(scalingFactor=schematic.scalingFactor, POIProposals="both")
+    s = incremental.CIncrementalSession(benchmark.CStubSPICEnet())
+    full = s.run(gray, params, ocr=False)
+
+    # A new wire in the empty bottom left corner
+    edited = gray.copy()
+    cv2.line(edited, (60, 750), (260, 750), 0, 3)
+    res = s.update(edited, ocr=False)
+    assert res["incremental"]
+    assert 0 < res["classified"] <= 4 < full["classified"]
+    assert len(res["lines"]) == len(full["lines"]) + 1
+    assert res["reused"] == len(full["preds"])
+
+    before, after = (incremental.lines.normalizeImageData(g, params) for g in (gray, edited))
+    ys, xs = np.nonzero(cv2.absdiff(before, after))
+    changed = np.stack([xs, ys], axis=1)
+    previous = {pos: label for label, pos in endpoints(full["lines"]).items()}
+    far = 0
+    for label, pos in endpoints(res["lines"]).items():
+        if np.abs(changed - pos).max(axis=1).min() <= params.imageSliceSizeScaled:
+            continue
+        # Same objects, taken over from the last run instead of classified again
+        assert res["preds"][label] is full["preds"][previous[pos]]
+        far += 1
+    # All but the few old wire ends next to the new wire
+    assert far >= 0.9 * 2 * len(full["lines"])
+    for label, pred in full["preds"].items():
+        if label.startswith("P"):
+            assert res["preds"][label] is pred
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+import lines
+from parameters import P2SParameters
+from pipeline import stageGraph
+from POI import POITypes
+
+PARAMS = P2SParameters.freeze(scalingFactor=0.05, POIProposals="both")
+
+
+def schematic():
+    # A lone symbol at (200, 200) and a wire whose left end touches a second
+    # symbol at (500, 200)
+    img = np.full((400, 800), 255, np.uint8)
+    cv2.rectangle(img, (184, 184), (213, 213), 0, -1)
+    cv2.rectangle(img, (484, 184), (513, 213), 0, -1)
+    cv2.line(img, (530, 300), (700, 300), 0, 2)
+    return img
+
+
+LINES = np.array([(530, 210, 650, 210)])
+
+
+def test_symbol_without_end_points_is_proposed():
+    clusters = lines.clusterEndpoints(schematic(), LINES, PARAMS)
+    assert clusters["P200_200"] == "P200_200"
+    assert clusters["0A"] == "P500_200"
+    assert clusters["0B"] == "0B"
+    assert "P500_200" not in clusters
+    assert list(clusters.centers) == ["P500_200", "0B", "P200_200"]
+
+
+def test_end_points_only_without_proposals():
+    clusters = lines.clusterEndpoints(schematic(), LINES, PARAMS.replace(POIProposals="endpoints"))
+    assert dict(clusters) == {"0A": "0A", "0B": "0B"}
+
+
+def test_unknown_proposal_mode_is_rejected():
+    with pytest.raises(ValueError):
+        lines.clusterEndpoints(schematic(), LINES, PARAMS.replace(POIProposals="components"))
+
+
+def pred(typ):
+    return {t.name: float(t == typ) for t in POITypes}
+
+
+@pytest.mark.parametrize("partition", (False, True))
+def test_proposals_become_pois(partition):
+    clusters = lines.clusterEndpoints(schematic(), LINES, PARAMS)
+    reps = {"P500_200": pred(POITypes.Resistor), "0B": pred(POITypes.Corner),
+            "P200_200": pred(POITypes.Capacitor)}
+    preds = lines.expandClusters(reps, clusters)
+    graph = stageGraph(LINES, preds, None, PARAMS, partition=partition, workers=1)
+    assert [(p.value, p.type) for p in graph.looseGraph] == [
+        ("0A", POITypes.Resistor), ("0B", POITypes.Corner), ("P200_200", POITypes.Capacitor)]
+    # Snapped to the grid of 48
+    assert tuple(graph.looseGraph[-1].position) == (192, 192)
+    assert graph.looseGraph[0].terminalB is graph.looseGraph[1]
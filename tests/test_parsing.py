@@ -0,0 +1,98 @@
+import os
+import shutil
+import stat
+
+import pytest
+
+from parsing import CParser, parseAsc, validateCir
+from POI import POI, POITypes
+
+
+def divider():
+    # GND -- R1 -- corner -- R2 (10k) -- GND
+    r1 = POI("0A", (96, 96), POITypes.Resistor, "R1")
+    corner = POI("0B", (480, 96), POITypes.Corner, None)
+    r2 = POI("1B", (480, 480), POITypes.Resistor, None)
+    r2.text = "10k"
+    gnd1 = POI("2B", (96, 480), POITypes.GND, None)
+    gnd2 = POI("3B", (480, 864), POITypes.GND, None)
+    r1.terminalA, r1.terminalB = gnd1, corner
+    corner.terminalB = r2
+    r2.terminalA = gnd2
+    return [r1, corner, r2, gnd1, gnd2]
+
+
+def test_cir_flags_placeholder_values():
+    parser = CParser(divider())
+    assert list(parser.IterCir()) == [
+        "* png2spice netlist",
+        "* R1: value not read from the schematic, placeholder 1k",
+        "R1 0 N001 1k",
+        "R2 0 N001 10k",
+        ".op",
+        ".end",
+    ]
+    assert parser.placeholderCount == 1
+
+
+def fakeSimulator(tmp_path, output, code=0):
+    exe = tmp_path / "fakespice"
+    exe.write_text(f"#!/bin/sh\necho '{output}'\nexit {code}\n")
+    exe.chmod(exe.stat().st_mode | stat.S_IEXEC)
+    return str(exe)
+
+
+@pytest.mark.skipif(os.name != "posix", reason="shell script simulator")
+def test_validate_cir_detects_errors(tmp_path):
+    cir = tmp_path / "output.cir"
+    cir.write_text("* empty\n.end\n")
+    assert validateCir(str(cir), fakeSimulator(tmp_path, "No errors here"))[0]
+    assert not validateCir(str(cir), fakeSimulator(tmp_path, "Error on line 2 :"))[0]
+    assert not validateCir(str(cir), fakeSimulator(tmp_path, "done", 1))[0]
+    assert validateCir(str(cir), "no-such-simulator") is None
+
+
+@pytest.mark.skipif(shutil.which("ngspice") is None, reason="ngspice is not installed")
+def test_exported_netlist_runs_in_ngspice(tmp_path):
+    parts = divider()
+    parts.append(POI("4A", (864, 96), POITypes.Diode, "D1"))
+    parts[1].terminalA = parts[-1]
+    parts[-1].terminalB = parts[3]
+    path = tmp_path / "output.cir"
+    CParser(parts).Graph2Cir(str(path))
+    ok, output = validateCir(str(path))
+    assert ok, output
+
+
+def test_parse_asc_is_order_independent():
+    a = "SHEET 1 1000 1000\nSYMBOL res 96 96 R0\nWIRE 480 112 112 112\nFLAG 112 480 0\n"
+    b = "SHEET 1 1000 1000\nFLAG 112 480 0\nWIRE 112 112 480 112\nSYMBOL res 96 96 R0\n"
+    assert parseAsc(a) == parseAsc(b) == {
+        "symbols": [("res", 96, 96, "R0")],
+        "flags": [("0", 112, 480)],
+        "wires": [(112, 112, 480, 112)],
+    }
+
+
+def test_parse_asc_skips_malformed_lines():
+    text = "WIRE 1 2 x 4\nSYMBOL cap\nTEXT 0 0 Left 2 !.op\n\nWIRE 16.0 0 0 0\n"
+    assert parseAsc(text) == {"symbols": [], "flags": [], "wires": [(0, 0, 16, 0)]}
+
+
+def test_parse_asc_reads_exported_graph():
+    parts = divider()
+    text = "\n".join(CParser(parts).IterAsc())
+    parsed = parseAsc(text)
+    assert parsed["symbols"] == [("res", 96, 96, "R90"), ("res", 480, 480, "R90")]
+    assert parsed["flags"] == [("0", 112, 480), ("0", 496, 864)]
+    assert len(parsed["wires"]) == 4
+
+
+@pytest.mark.parametrize("rotation, nodes", ((0, "N001 0"), (90, "0 N001"), (180, "0 N001"), (270, "N001 0")))
+def test_cir_lists_diode_anode_first(rotation, nodes):
+    parts = divider()
+    diode = POI("4A", (864, 96), POITypes.Diode, "D1")
+    diode.rotation = rotation
+    parts[1].terminalA, diode.terminalB = diode, parts[3]
+    parts.append(diode)
+    assert f"D1 {nodes} D" in list(CParser(parts).IterCir())
@@ -0,0 +1,102 @@
+import os
+import time
+
+import pytest
+
+pipeline = pytest.importorskip("pipeline")
+
+
+def files(path):
+    return sorted(f for _, _, names in os.walk(path) for f in names)
+
+
+def age(cache, key, seconds):
+    fname = os.path.join(cache.path, key[:2], key + ".pkl")
+    t = time.time() - seconds
+    os.utime(fname, (t, t))
+
+
+def test_cache_evicts_least_recently_used_above_size(tmp_path):
+    cache = pipeline.CStageCache(str(tmp_path), maxBytes=None, maxAge=None)
+    keys = [f"{i:040x}" for i in range(6)]
+    for i, key in enumerate(keys):
+        cache.put(key, b"x" * 1000)
+        age(cache, key, 100 - i)
+    size = os.path.getsize(os.path.join(str(tmp_path), keys[0][:2], keys[0] + ".pkl"))
+    cache.maxBytes = 3 * size
+    assert cache.prune() == 3
+    assert files(str(tmp_path)) == [k + ".pkl" for k in keys[3:]]
+    assert set(cache.memory) == set(keys[3:])
+
+
+def test_cache_evicts_by_age_and_keeps_used_entries(tmp_path):
+    cache = pipeline.CStageCache(str(tmp_path), maxBytes=None, maxAge=60)
+    cache.put("a" * 40, 1)
+    cache.put("b" * 40, 2)
+    age(cache, "a" * 40, 120)
+    age(cache, "b" * 40, 120)
+    # Reading a checkpoint from disk counts as a use
+    fresh = pipeline.CStageCache(str(tmp_path), maxBytes=None, maxAge=None)
+    assert fresh.get("b" * 40) == 2
+    fresh.maxAge = 60
+    assert fresh.prune() == 1
+    assert files(str(tmp_path)) == ["b" * 40 + ".pkl"]
+
+
+def test_memory_cache_is_not_pruned():
+    cache = pipeline.CStageCache()
+    cache.put("key", 1)
+    assert cache.prune() == 0
+    assert cache.get("key") == 1
+
+
+def test_memory_keeps_only_recently_used_entries(tmp_path):
+    cache = pipeline.CStageCache(maxEntries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert list(cache.memory) == ["a", "c"]
+    assert cache.get("b") is None
+    # With a directory, dropped entries are read from disk again
+    cache = pipeline.CStageCache(str(tmp_path), maxEntries=1)
+    cache.put("a" * 40, 1)
+    cache.put("b" * 40, 2)
+    assert list(cache.memory) == ["b" * 40]
+    assert cache.get("a" * 40) == 1
+    assert list(cache.memory) == ["a" * 40]
+
+
+class CFixedRotations:
+    def predictRotations(self, crops, imgResize=None, batchSize=32, cancel=None):
+        return None, [270] * len(crops)
+
+
+def test_all_rotations_keep_only_the_axis_of_symmetric_parts():
+    np = pytest.importorskip("numpy")
+    from parameters import P2SParameters
+    from POI import POITypes
+    params = P2SParameters.freeze(scalingFactor=0.05)
+    img = np.full((400, 800), 255, np.uint8)
+    HLs = np.array([(200, 200, 600, 200)])
+    preds = {"0A": {t.name: float(t == POITypes.Resistor) for t in POITypes},
+             "0B": {t.name: float(t == POITypes.Diode) for t in POITypes}}
+    rotations = pipeline.stageRotate(CFixedRotations(), img, HLs, preds, params, "all")
+    assert rotations == {"0A": 90, "0B": 270}
+
+
+def test_rotations_reuse_the_clusters_of_the_classification(monkeypatch):
+    np = pytest.importorskip("numpy")
+    from parameters import P2SParameters
+    from POI import POITypes
+    params = P2SParameters.freeze(scalingFactor=0.05)
+    img = np.full((400, 800), 255, np.uint8)
+    HLs = np.array([(200, 200, 600, 200)])
+    clusters = pipeline.lines.clusterEndpoints(img, HLs, params)
+    preds = {"0A": {t.name: float(t == POITypes.Diode) for t in POITypes}}
+
+    def recluster(*args):
+        raise AssertionError("end points clustered again")
+    monkeypatch.setattr(pipeline.lines, "clusterEndpoints", recluster)
+    rotations = pipeline.stageRotate(CFixedRotations(), img, HLs, preds, params, "polarized", clusters=clusters)
+    assert rotations == {"0A": 270}
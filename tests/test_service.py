@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+service = pytest.importorskip("service")
+from benchmark import CStubSPICEnet
+
+
+def crops(n, seed):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, (16, 16), dtype=np.uint8) for _ in range(n)]
+
+
+def test_concurrent_requests_share_one_batch():
+    model = CStubSPICEnet()
+    batcher = service.CMicroBatcher(model, maxBatch=64, maxWait=1.0)
+    try:
+        a, b = crops(3, 1), crops(2, 2)
+        futureA = batcher.submit(a, 32)
+        futureB = batcher.submit(b, 32)
+        np.testing.assert_array_equal(futureA.result(timeout=5), model.predictArrays(a))
+        np.testing.assert_array_equal(futureB.result(timeout=5), model.predictArrays(b))
+        stats = batcher.snapshot()
+        assert (stats["batches"], stats["requests"], stats["crops"]) == (1, 2, 5)
+    finally:
+        batcher.close()
+
+
+class CBrokenSizeModel(CStubSPICEnet):
+    def inputSize(self, imgResize):
+        if imgResize == 0:
+            raise ValueError("no input size")
+        return super().inputSize(imgResize)
+
+
+def test_errors_reach_the_request_and_keep_the_batcher_alive():
+    model = CBrokenSizeModel()
+    batcher = service.CMicroBatcher(model, maxWait=0.0)
+    try:
+        with pytest.raises(ValueError):
+            batcher.submit(crops(1, 3), 0).result(timeout=5)
+        assert batcher.submit(crops(1, 4), 32).result(timeout=5).shape == (1, len(model.classlist))
+    finally:
+        batcher.close()
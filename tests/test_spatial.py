@@ -0,0 +1,48 @@
+import math
+import random
+
+from spatial import CSpatialIndex
+
+
+def randomIndex(n=300, cellSize=25, seed=7):
+    rng = random.Random(seed)
+    index = CSpatialIndex(cellSize)
+    for i in range(n):
+        index.insert(i, (rng.uniform(-200, 200), rng.uniform(-200, 200)))
+    return index
+
+
+def test_query_matches_brute_force():
+    index = randomIndex()
+    for pos, radius in (((0, 0), 30), ((-150, 80), 60), ((199, -199), 5), ((10, 10), 400)):
+        expected = {i for i, p in index.positions.items() if math.dist(pos, p) < radius}
+        assert set(index.query(pos, radius)) == expected
+
+
+def test_query_radius_is_strict():
+    index = CSpatialIndex(10)
+    index.insert("a", (10, 0))
+    assert index.query((0, 0), 10) == []
+    assert index.query((0, 0), 10.5) == ["a"]
+
+
+def test_query_band_matches_brute_force():
+    index = randomIndex()
+    for axis in (0, 1):
+        expected = {i for i, p in index.positions.items() if abs(p[axis] - 42) < 20}
+        assert set(index.queryBand(axis, 42, 20)) == expected
+
+
+def test_remove_and_move():
+    index = CSpatialIndex(10)
+    index.insert("a", (5, 5))
+    index.insert("b", (50, 50))
+    index.move("a", (48, 52))
+    assert set(index.query((50, 50), 5)) == {"a", "b"}
+    assert index.query((5, 5), 5) == []
+    index.remove("b")
+    index.remove("unknown")
+    assert len(index) == 1 and "b" not in index
+    assert index.queryBand(1, 50, 5) == ["a"]
+    index.remove("a")
+    assert not index.cells and not index.rows and not index.cols